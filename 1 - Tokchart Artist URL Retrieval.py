@@ -1,21 +1,80 @@
 # 1. Retrieve top artists from Tokchart
 
-import requests
 from bs4 import BeautifulSoup
 import csv
+import instrumentation
+from canonical import canonical_url, unique
+from delta_crawl import Snapshot, crawl_pages
+from fetch import fetch_all, close_session
+
+# Label the timers and JSON-lines log records of this stage
+instrumentation.configure(stage_name='1-artist-urls')
 
 base_url = "https://tokchart.com/dashboard/lists/artists/most-popular?page="
-artist_urls = []
 
-# Loop through pages 1 to 100
-for page in range(1, 101):
-    url = base_url + str(page)
-    response = requests.get(url)
+# Delta mode: pages are fetched a few at a time and paging stops at the first page without a new
+# artist; only new artists and artists that climbed rank_tolerance places or more are written for
+# stage 2. With delta_mode = False all pages are fetched and every artist is written, as before.
+# The snapshot is saved as pending and stage 2 makes it current once it has read the artists.
+delta_mode = True
+rank_tolerance = 10
+snapshot_path = 'Tokchart Artists Snapshot.json'
+snapshot = Snapshot(snapshot_path)
+
+# Function to get the canonical artist URLs linked on a list page
+def page_artists(page, response):
     soup = BeautifulSoup(response.text, 'html.parser')
-    
+    urls = []
     for a_tag in soup.find_all('a', href=True):
-        if a_tag['href'].startswith("https://tokchart.com/dashboard/artists"):
-            artist_urls.append(a_tag['href'])
+        href = canonical_url(a_tag['href'])
+        if href.startswith("https://tokchart.com/dashboard/artists"):
+            urls.append(href)
+    return urls
+
+# Fetch pages 1 to 100 concurrently over pooled connections (results stay in page order)
+crawled = crawl_pages(lambda pages: fetch_all([base_url + str(page) for page in pages]),
+                      page_artists, lambda url: url not in snapshot,
+                      last_page=100, batch_size=5 if delta_mode else 100, stop_when_unchanged=delta_mode)
+close_session()
+
+# The same artist is linked several times on a list page, keep each one once (in row order)
+failed_pages = [page for page, urls in crawled if urls is None]
+page_rows = [(page, unique(urls)) for page, urls in crawled if urls is not None]
+instrumentation.count('duplicates', sum(len(urls) for page, urls in crawled if urls) - sum(len(rows) for _, rows in page_rows))
+rows_per_page = max((len(rows) for _, rows in page_rows), default=0)
+
+# Compare with the previous run: rank comes from the page number and the row on the page, so a
+# page that failed to load does not move the artists after it. Artists on or after a failed page
+# are not compared by rank (the list may have shifted into the gap), only checked for being new.
+artist_urls = []
+seen_urls = set()
+counts = {'new': 0, 'climbed': 0, 'unchanged': 0}
+for page, rows in page_rows:
+    after_failure = any(page > failed for failed in failed_pages)
+    for row, url in enumerate(rows, start=1):
+        if url in seen_urls:
+            continue
+        seen_urls.add(url)
+        rank = (page - 1) * rows_per_page + row
+        previous = snapshot.get(url)
+        snapshot.update(url, {'rank': rank})
+        if previous is None:
+            counts['new'] += 1
+        elif not after_failure and previous['rank'] - rank >= rank_tolerance:
+            counts['climbed'] += 1
+        else:
+            counts['unchanged'] += 1
+            if delta_mode:
+                continue
+        artist_urls.append(url)
+
+# A partial crawl would save wrong ranks (or, without delta mode, drop every artist it missed), so
+# the snapshot is only saved when every page loaded
+if failed_pages:
+    print(f"Snapshot not updated, failed to load page(s) {', '.join(map(str, failed_pages))}")
+else:
+    snapshot.save(keep_unseen=delta_mode)
+print(f"Fetched {len(page_rows)} pages: {counts['new']} new artists, {counts['climbed']} climbed {rank_tolerance}+ places, {counts['unchanged']} unchanged")
 
 # Write the URLs to a CSV file
 with open('Tokchart Artist URLs.csv', 'w', newline='') as file:
@@ -24,4 +83,5 @@ with open('Tokchart Artist URLs.csv', 'w', newline='') as file:
     for url in artist_urls:
         writer.writerow([url])
 
-print(f"Collected {len(artist_urls)} artist URLs.")
\ No newline at end of file
+print(f"Collected {len(artist_urls)} artist URLs.")
+instrumentation.report()
\ No newline at end of file
@@ -1,20 +1,42 @@
 # 2. Retrieve top Sounds from top Artists
 
 import csv
-import requests
-from bs4 import BeautifulSoup
 import pandas as pd
+import http_cache
+import instrumentation
+from canonical import canonical_url, dedupe_key
+from delta_crawl import Snapshot, promote
+from extract import sound_table_rows, SOUND_ANCHOR_CLASS, SOUND_TITLE_CLASS
+from fetch import fetch, map_ordered, close_session
 
 # Define the paths to the input and output CSV files
 input_csv_path = # path to 'Tokchart Artist URLs.csv'
 output_csv_path = # path to 'Tokchart Sound URLs.csv'
 log_file_path = # path to 'Tokchart_skipped_artists.log'
+cache_dir_path = # path to 'HTTP Cache' folder
+snapshot_path = # path to 'Tokchart Sounds Snapshot.json'
+artists_snapshot_path = # path to 'Tokchart Artists Snapshot.json'
+
+# Delta mode: only sounds that are new or whose Total Views changed since the last run are written
+# (with a 'Change' column); with delta_mode = False every sound is written, as before
+delta_mode = True
+
+# Keep fetched pages on disk so reruns are mostly local reads
+# (set offline_only=True to work from the cache without touching the network)
+# In delta mode the Total Views are compared with the last run, so pages are revalidated after
+# 12 hours instead of a week: a weekly refresh must not read last week's views from the cache
+http_cache.configure(cache_dir_path, ttl_seconds=12 * 3600 if delta_mode else 7 * 24 * 3600, offline_only=False)
+
+# Label the timers and JSON-lines log records of this stage; per-sound messages go to the log
+# (set events=True to print them as well)
+instrumentation.configure(stage_name='2-sound-urls', events=False)
 
 def get_sounds_info(artist, url):
     try:
-        response = requests.get(url)
+        response = fetch(url)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # Only the sound table is parsed, not the whole page
+        sound_rows = sound_table_rows(response.text)
     except Exception as e:
         print(f"Error fetching URL for artist {artist}: {e}")
         with open(log_file_path, mode='a', encoding='utf-8') as log_file:
@@ -23,25 +45,20 @@ def get_sounds_info(artist, url):
 
     sounds_info = []
 
-    # Find all rows in the table body
-    sound_rows = soup.select('tbody > tr')
-
     for row in sound_rows:
         try:
             # Find the sound URL
-            sound_anchor = row.find('a', class_='block shrink-0 w-12 h-12 rounded-full mr-2 sm:mr-3 bg-indigo-500 overflow-hidden')
+            sound_anchor = row.find('a', class_=SOUND_ANCHOR_CLASS)
             if not sound_anchor:
                 continue
-            sound_url = sound_anchor['href']
-            print(f"Found sound URL: {sound_url}")
-            
+            sound_url = canonical_url(sound_anchor['href'])
+
             # Find the sound title
-            title_element = row.find('a', class_='hover:underline font-medium text-gray-800')
+            title_element = row.find('a', class_=SOUND_TITLE_CLASS)
             if not title_element:
                 print(f"Title element not found for sound URL: {sound_url}")
                 continue
             sound_title = title_element.text.strip()
-            print(f"Found sound title: {sound_title}")
 
             # Find all <td> elements
             td_elements = row.find_all('td')
@@ -55,11 +72,13 @@ def get_sounds_info(artist, url):
                 print(f"Views element not found for sound URL: {sound_url}")
                 continue
             views = views_div.text.strip()
-            print(f"Found views: {views}")
+            instrumentation.event('sound', f"Found sound: {sound_title} - {views} views - {sound_url}",
+                                  artist=artist, sound_url=sound_url, title=sound_title, views=views)
 
             sounds_info.append((artist, sound_title, sound_url, views))
         except Exception as e:
             print(f"Error processing sound for artist {artist}: {e}")
+            instrumentation.count('failures')
             with open(log_file_path, mode='a', encoding='utf-8') as log_file:
                 log_file.write(f"Error processing sound for artist {artist} at URL {url}: {e}\n")
 
@@ -72,24 +91,60 @@ with open(input_csv_path, mode='r', encoding='latin1') as file:
     next(reader)  # Skip the header
     for row in reader:
         try:
-            artists.append((row[0], row[1]))
+            artists.append((row[0], canonical_url(row[1])))
         except Exception as e:
             print(f"Error reading row {row}: {e}")
             with open(log_file_path, mode='a', encoding='utf-8') as log_file:
                 log_file.write(f"Error reading row {row}: {e}\n")
 
-# Scrape the data for each artist
-all_sounds_info = []
-for artist, url in artists:
+# Each artist is scraped once, even if it is listed several times
+seen_artists = set()
+artists = [(artist, url) for artist, url in artists if not (url in seen_artists or seen_artists.add(url))]
+
+# Scrape the data for each artist concurrently (results come back in artist order)
+def scrape_artist(artist_row):
+    artist, url = artist_row
     print(f"Processing artist: {artist}, URL: {url}")
-    sounds_info = get_sounds_info(artist, url)
+    return get_sounds_info(artist, url)
+
+all_sounds_info = []
+seen_sounds = set()
+results = map_ordered(scrape_artist, artists)
+close_session()
+for (artist, url), sounds_info in zip(artists, results):
     if sounds_info:
-        all_sounds_info.extend(sounds_info)
+        # A sound listed under several artists (features, collaborations) is kept once, under the first
+        for sound_info in sounds_info:
+            key = dedupe_key(sound_info[2])
+            if key in seen_sounds:
+                instrumentation.count('duplicates')
+                continue
+            seen_sounds.add(key)
+            all_sounds_info.append(sound_info)
     else:
         print(f"No sounds found for artist {artist}")
 
-# Create a DataFrame and save to a new CSV file
+# Compare every sound with the previous run's snapshot
+snapshot = Snapshot(snapshot_path)
+changes = []
+for artist, title, sound_url, views in all_sounds_info:
+    changes.append(snapshot.change(sound_url, {'views': views}))
+    snapshot.update(sound_url, {'artist': artist, 'title': title, 'views': views})
+print(f"{changes.count('new')} new sounds, {changes.count('changed')} with changed Total Views, {changes.count('unchanged')} unchanged")
+
+# Create a DataFrame and save to a new CSV file (in delta mode, only the new and changed sounds)
 df = pd.DataFrame(all_sounds_info, columns=['Artist', 'Title', 'Sound URL', 'Total Views'])
+if delta_mode:
+    df['Change'] = changes
+    df = df[df['Change'] != 'unchanged']
 df.to_csv(output_csv_path, index=False)
 
+# The snapshot keeps the sounds of artists not scraped this time (stage 1 only passes on the
+# artists that are new or moved up); it is saved as pending and stage 4 makes it current
+snapshot.save(keep_unseen=True)
+
 print(f"Data successfully saved to {output_csv_path}")
+
+# Stage 1's artists have been read, so its pending snapshot becomes the one the next run compares with
+promote(artists_snapshot_path)
+instrumentation.report()
@@ -3,8 +3,11 @@
 import os
 import re
 import pandas as pd
-import requests
-import mimetypes
+import instrumentation
+from downloader import download_all
+
+# Label the timers and JSON-lines log records of this stage
+instrumentation.configure(stage_name='3-sound-mp3s')
 
 # Define the input Excel file path
 input_excel_path = # path to 'Tokchart Sound URLs.csv'
@@ -16,42 +19,27 @@ df = pd.read_excel(input_excel_path)
 output_dir = # path to 'Downloaded Audio Files'
 os.makedirs(output_dir, exist_ok=True)
 
+# Number of files downloaded at the same time
+download_workers = 8
+
 # Function to clean the filename
 def clean_filename(filename):
     return re.sub(r'[\\/*?:"<>|]', "", filename)
 
-# Function to download the audio file
-def download_audio_file(url, save_path):
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        # Determine the file extension from the MIME type
-        content_type = response.headers.get('content-type')
-        extension = mimetypes.guess_extension(content_type.split(';')[0])
-        if not extension:
-            extension = ".mp3"  # Default extension if MIME type is not recognized
-        
-        # Save the file with the appropriate extension
-        save_path = save_path + extension
-        with open(save_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"Downloaded: {save_path}")
-    except Exception as e:
-        print(f"Error downloading {url}: {e}")
-
-# Process each row in the DataFrame
+# Build the list of downloads from the DataFrame
+jobs = []
 for index, row in df.iterrows():
     number = row['Number']
     title = row['Title']
     source_url = row['Source sound URL']
-    
-    # Generate the filename
+
+    # Generate the filename (the extension is added from the MIME type once downloaded)
     filename = f"{number} - {clean_filename(title)}"
     save_path = os.path.join(output_dir, filename)
-    
-    # Download the audio file
-    download_audio_file(source_url, save_path)
+    jobs.append((source_url, save_path))
+
+# Download in parallel: complete files are skipped, partial ones are resumed
+download_all(jobs, workers=download_workers)
 
-print("All files downloaded.")
\ No newline at end of file
+print("All files downloaded.")
+instrumentation.report()
\ No newline at end of file
@@ -1,29 +1,51 @@
 # 4. Retrieve TikTok Sound URLs from Tokchart Sound URLs
 
-import requests
-from bs4 import BeautifulSoup
 import pandas as pd
+import http_cache
+import instrumentation
+from canonical import canonical_url
+from delta_crawl import promote
+from extract import tiktok_sound_url
+from fetch import fetch, map_ordered, close_session
+from intermediate_store import IntermediateStore
 
 # Define the paths to the input and output Excel files
 input_excel_path = # path to 'Tokchart Sound URLs.csv''
+store_path = # path to 'Pipeline Store.sqlite'
 output_excel_path = # path to 'TikTok Sound URLs.xlsx'
 log_file_path = # path to 'Tokchart_skipped_sounds.log'
+cache_dir_path = # path to 'HTTP Cache' folder
+snapshot_path = # path to 'Tokchart Sounds Snapshot.json'
+
+# The results go to the intermediate store (read by stage 5); the Excel file is optional
+export_excel = False
+
+# Sounds whose TikTok URL is already in the store are not fetched again (set refresh=True to fetch all)
+refresh = False
+
+# Keep fetched pages on disk so reruns are mostly local reads
+# (set offline_only=True to work from the cache without touching the network)
+http_cache.configure(cache_dir_path, ttl_seconds=7 * 24 * 3600, offline_only=False)
+
+# Label the timers and JSON-lines log records of this stage; per-sound messages go to the log
+# (set events=True to print them as well)
+instrumentation.configure(stage_name='4-tiktok-sound-urls', events=False)
 
 def get_tiktok_url(tokchart_url):
     try:
-        response = requests.get(tokchart_url)
+        response = fetch(tokchart_url)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        soup = BeautifulSoup(response.text, 'html.parser')
-        tiktok_anchor = soup.find('a', class_='t-btn bg-cadet bg-cadet hover:bg-cadet-900 active:bg-cadet-900')
-        if tiktok_anchor:
-            tiktok_url = tiktok_anchor['href']
-            print(f"Found TikTok URL: {tiktok_url}")
-            return tiktok_url
+        # Pull out just the TikTok button's href instead of parsing the whole page
+        tiktok_url = tiktok_sound_url(response.text)
+        if tiktok_url:
+            instrumentation.event('tiktok_url', f"Found TikTok URL: {tiktok_url}", tokchart_url=tokchart_url, tiktok_url=tiktok_url)
+            return canonical_url(tiktok_url)
         else:
             print(f"No TikTok URL found for: {tokchart_url}")
             return None
     except Exception as e:
         print(f"Error fetching URL {tokchart_url}: {e}")
+        instrumentation.count('failures')
         with open(log_file_path, mode='a', encoding='utf-8') as log_file:
             log_file.write(f"Error fetching URL {tokchart_url}: {e}\n")
         return None
@@ -34,14 +56,38 @@ df = pd.read_excel(input_excel_path)
 # Add a new column for the TikTok sound URL
 df['TikTok Sound URL'] = ""
 
-# Process each row in the DataFrame
-for index, row in df.iterrows():
-    print(f"Processing row {index + 1} of {len(df)}")
-    tokchart_url = row['Sound Tokchart URL']
-    tiktok_url = get_tiktok_url(tokchart_url)
+# Tokchart URLs seen with another spelling (tracking parameters, www., trailing slash) are one sound
+df['Sound Tokchart URL'] = df['Sound Tokchart URL'].map(canonical_url)
+
+# TikTok URLs already found in an earlier run, by Tokchart URL
+store = IntermediateStore(store_path)
+known = {}
+if not refresh:
+    known_df = store.read('tiktok_sounds', where='tiktok_sound_url IS NOT NULL')
+    known = dict(zip(known_df['Sound Tokchart URL'].map(canonical_url), known_df['TikTok Sound URL']))
+
+# Fetch every remaining Tokchart URL once, concurrently, and give its result to every row listing it
+pending = [url for url in dict.fromkeys(df['Sound Tokchart URL'].dropna()) if url not in known]
+print(f"Fetching {len(pending)} sound pages ({len(known)} known from earlier runs, {len(df) - len(pending)} rows reuse a result)")
+tiktok_urls = dict(known)
+tiktok_urls.update(zip(pending, map_ordered(get_tiktok_url, pending)))
+close_session()
+for index, tokchart_url in zip(df.index, df['Sound Tokchart URL']):
+    tiktok_url = tiktok_urls.get(tokchart_url)
     df.at[index, 'TikTok Sound URL'] = tiktok_url if tiktok_url else ""
 
-# Save the results to a new Excel file
-df.to_excel(output_excel_path, index=False)
+# Save the results to the intermediate store (sounds without a TikTok URL are stored as NULL)
+store.append('tiktok_sounds', [{'number': row['Number'], 'sound_tokchart_url': row['Sound Tokchart URL'], 'tiktok_sound_url': row['TikTok Sound URL'] or None}
+                               for _, row in df.iterrows()])
+store.close()
+print(f"Data successfully saved to {store_path}")
+
+# Stage 2's sounds are in the store, so its pending snapshot becomes the one the next run compares with
+promote(snapshot_path)
+
+# Optionally save the results to a new Excel file as well
+if export_excel:
+    df.to_excel(output_excel_path, index=False)
+    print(f"Data successfully saved to {output_excel_path}")
 
-print(f"Data successfully saved to {output_excel_path}")
\ No newline at end of file
+instrumentation.report()
\ No newline at end of file
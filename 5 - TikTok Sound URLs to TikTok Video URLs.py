@@ -1,70 +1,82 @@
 # 5. Run simulated browser requests to retrieve TikTok videos from TikTok Sound URLs
 
-import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from webdriver_manager.chrome import ChromeDriverManager
-import time
-
-# Setup Chrome options for headless mode
-chrome_options = Options()
-chrome_options.add_argument("--headless")
-chrome_options.add_argument("--disable-gpu")
-chrome_options.add_argument("--window-size=1920,1080")
-
-# Initialize WebDriver with the ChromeDriverManager to handle driver installation
-service = Service(ChromeDriverManager().install())
-driver = webdriver.Chrome(service=service, options=chrome_options)
-
-# Read the input Excel file
-input_excel_path = # path to 'TikTok Sound URLs.xlsx'
-df = pd.read_excel(input_excel_path)
-
-# Create a new Excel writer object
+import browser_pool
+import instrumentation
+from canonical import unique, group_duplicates
+from intermediate_store import IntermediateStore
+
+# Pool settings: number of headless Chrome drivers and pages per driver before it is replaced
+browser_pool.pool_size = 4
+browser_pool.recycle_after = 25
+
+# Harvest all /video/ links in one in-page call; optionally also read video IDs
+# from the page's item-list API responses (Chrome performance log)
+browser_pool.harvest_mode = 'script'
+browser_pool.capture_network = False
+
+# Label the timers and JSON-lines log records of this stage; the per-video URLs go to the log
+# (set events=True to print them as well)
+instrumentation.configure(stage_name='5-video-urls', events=False)
+
+# Read the sounds that have a TikTok Sound URL from the intermediate store (written by stage 4)
+store_path = # path to 'Pipeline Store.sqlite'
+store = IntermediateStore(store_path)
+df = store.read('tiktok_sounds', where='tiktok_sound_url IS NOT NULL')
+
+# The video URLs go to the intermediate store (read by stage 6); the Excel file is optional
 output_excel_path = # path to 'TikTok Video URLs.xlsx'
-writer = pd.ExcelWriter(output_excel_path, engine='xlsxwriter')
+export_excel = False
 
-# Process each row in the DataFrame
-for index, row in df.iterrows():
+# Several Tokchart sounds can point to the same TikTok sound: scrape each TikTok sound once
+# and give its videos to every row listing it
+sound_urls = list(df['TikTok Sound URL'])
+groups = group_duplicates(sound_urls)
+
+# Function to append a sound's video URLs to the store
+def save_sound(row, video_urls):
     number = row['Number']
     tiktok_url = row['TikTok Sound URL']
-    print(f"Processing row {index + 1} of {len(df)}: {tiktok_url}")
-
-    try:
-        # Open TikTok Sound URL
-        driver.get(tiktok_url)
-
-        # Allow the page to load
-        time.sleep(5)
-
-        # Scroll to load more content three times
-        scroll_pause_time = 2
-
-        for _ in range(8):
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(scroll_pause_time)
-
-        # Get all URLs on the page containing '/video/'
-        all_urls = driver.find_elements(By.TAG_NAME, 'a')
-        video_urls = {url.get_attribute('href') for url in all_urls if '/video/' in (url.get_attribute('href') or '')}
-
-        # Print the collected URLs for the current TikTok Sound URL
-        print(f"Found {len(video_urls)} unique video URLs for {tiktok_url}")
-        for url in video_urls:
-            print(url)
-
-        # Create a DataFrame for the video URLs and write to a new sheet in the Excel file
-        video_urls_df = pd.DataFrame(list(video_urls), columns=['Video URL'])
-        video_urls_df.to_excel(writer, sheet_name=str(number), index=False)
-    except Exception as e:
-        print(f"Error processing URL {tiktok_url}: {e}")
-
-# Save and close the Excel file
-writer.close()
-
-# Close WebDriver
-driver.quit()
 
-print(f"Data successfully saved to {output_excel_path}")
\ No newline at end of file
+    if video_urls is None or isinstance(video_urls, Exception):
+        print(f"Error processing URL {tiktok_url}: {video_urls or 'not scraped'}")
+        instrumentation.count('failures')
+        return
+
+    # Keep one canonical URL per video (share links of the same video differ only in their query)
+    video_urls = unique(video_urls)
+
+    # Report the collected URLs for the current TikTok Sound URL
+    print(f"Found {len(video_urls)} unique video URLs for {tiktok_url}")
+    for url in video_urls:
+        instrumentation.event('video_url', url, tiktok_sound_url=tiktok_url, video_url=url)
+
+    # Replace the sound's previous video URLs with the ones found now
+    store.append('video_urls', [{'sound_number': number, 'position': position, 'video_url': url}
+                                for position, url in enumerate(video_urls)],
+                 replace_where='sound_number = ?', params=(int(number),))
+
+# Function to save a scraped sound page for every row listing it, as soon as it is done
+group_indexes = list(groups.values())
+def on_result(group, video_urls):
+    for index in group_indexes[group]:
+        save_sound(df.iloc[index], video_urls)
+
+# Scrape all TikTok Sound URLs in parallel; each page is scrolled until no new videos load, and
+# its videos are stored while the other pages are still loading (an interrupted run keeps them)
+print(f"Processing {len(groups)} sound URLs with {browser_pool.pool_size} browsers ({len(sound_urls) - len(groups)} duplicates)")
+unique_results = browser_pool.scrape_all([sound_urls[indexes[0]] for indexes in group_indexes], on_result=on_result)
+
+# Sounds that were never scraped (a worker thread died) are reported as failed
+for group, video_urls in enumerate(unique_results):
+    if video_urls is None:
+        on_result(group, None)
+
+print(f"Data successfully saved to {store_path}")
+
+# Optionally write one sheet per sound to an Excel file, as before
+if export_excel:
+    store.export_excel('video_urls', output_excel_path, order_by='sound_number, position', sheet_column='Number', drop=['Position'])
+    print(f"Data successfully saved to {output_excel_path}")
+
+store.close()
+instrumentation.report()
\ No newline at end of file
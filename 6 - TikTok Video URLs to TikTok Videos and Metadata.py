@@ -12,38 +12,137 @@ drive.mount('/content/drive')
 !pip install xlsxwriter
 
 import os
-import json
+import sys
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import yt_dlp
+from yt_dlp.networking.exceptions import TransportError
 import pandas as pd
-from bs4 import BeautifulSoup
 from datetime import datetime
-import time
 
-def download_tiktok_video(url, folder_name, tab_number, video_id, retries=3):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+# Make the shared helper modules (fetch.py, ...) importable from Drive
+sys.path.append('/content/drive/My Drive/Code')
+import http_cache
+import instrumentation
+import rate_limit
+from fetch import fetch
+from extract import rehydration_text, item_struct_from_payload
+from canonical import unique, video_id as canonical_video_id
+from intermediate_store import IntermediateStore
+
+# Keep fetched video pages on Drive so a rerun after a crash does not download them again
+# (set offline_only=True to work from the cache without touching the network)
+http_cache.configure('/content/drive/My Drive/HTTP Cache', ttl_seconds=7 * 24 * 3600, offline_only=False)
+
+# Label the timers and JSON-lines log records of this stage; the per-video metadata goes to the
+# log (set events=True to print it as well, log_file=... to keep the log on Drive)
+instrumentation.configure(stage_name='6-videos-and-metadata', events=False)
+
+# Number of videos processed at the same time within each tab
+video_workers = 4
+
+# Videos longer than this (in seconds, from the page metadata) are not downloaded; None downloads everything
+max_video_duration = 30
+
+# The metadata goes to the intermediate store; the per-sound Excel files are still written by
+# default because the metadata Google Sheets of stages 7-9 are made from them
+export_excel = True
+
+# Each worker thread keeps one YoutubeDL instance for all of its videos
+_worker = threading.local()
+_ydl_instances = []
+_ydl_lock = threading.Lock()
+
+# Errors of yt-dlp worth retrying: dropped connections and timeouts. Throttled (429) and 5xx
+# answers are retried by rate_limit.call from their HTTP status; anything else (a private or
+# removed video, a page yt-dlp cannot parse) fails at once
+YTDLP_RETRY_ERRORS = (OSError, TransportError)
+
+# Function to get this worker thread's YoutubeDL instance
+def get_ydl():
+    ydl = getattr(_worker, 'ydl', None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
+        _worker.ydl = ydl
+        with _ydl_lock:
+            _ydl_instances.append(ydl)
+    return ydl
+
+# Function to close every worker's YoutubeDL instance
+def close_ydl_instances():
+    with _ydl_lock:
+        for ydl in _ydl_instances:
+            ydl.close()
+        _ydl_instances.clear()
+
+
+# Function to run a yt-dlp call, raising the network error behind a DownloadError (if there is
+# one) so rate_limit.call can tell it from a permanent failure
+def ydl_call(func):
+    try:
+        return func()
+    except yt_dlp.utils.DownloadError as e:
+        cause = e
+        for _ in range(3):
+            exc_info = getattr(cause, 'exc_info', None)
+            cause = getattr(cause, 'cause', None) or (exc_info[1] if exc_info else None)
+            if isinstance(cause, YTDLP_RETRY_ERRORS):
+                raise cause from e
+        raise
+
+# Function to build an itemStruct-like dict from yt-dlp's info dict (used when the video
+# page could not be read; it has no music ID, diversification labels or location)
+def item_struct_from_info(info):
+    return {
+        'desc': info.get('description', 'N/A'),
+        'createTime': info.get('timestamp', 'N/A'),
+        'music': {'title': info.get('track', 'N/A')},
+        'video': {'duration': info.get('duration')},
     }
 
-    for attempt in range(retries):
-        try:
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, "html.parser")
-            break
-        except (requests.RequestException, requests.Timeout) as e:
-            print(f"Attempt {attempt + 1} failed for URL {url}: {e}")
-            if attempt + 1 == retries:
-                print(f"Giving up on URL {url} after {retries} attempts")
-                return "N/A", [], "N/A", [], "N/A", "N/A", "N/A", "N/A"
-            time.sleep(5)
-
-    script_tag = soup.find("script", id="__UNIVERSAL_DATA_FOR_REHYDRATION__")
-    if script_tag:
-        try:
-            data = json.loads(script_tag.string)
-            video_info = data['__DEFAULT_SCOPE__']['webapp.video-detail']['itemInfo']['itemStruct']
+# Function to fetch the video page ourselves and read its itemStruct (no download)
+# Throttled and failed requests are retried with backoff by fetch (rate_limit.py)
+def fetch_item_struct(url, retries=3):
+    try:
+        response = fetch(url, timeout=10, attempts=retries)
+        response.raise_for_status()
+        page = response.content
+    except requests.RequestException as e:
+        print(f"Giving up on URL {url}: {e}")
+        instrumentation.count('failures', url=url, step='page')
+        return None
+
+    # Cut out the rehydration <script> and decode only its itemStruct
+    payload = rehydration_text(page)
+    if payload is None:
+        return None
+    try:
+        return item_struct_from_payload(payload)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Error parsing video info for URL {url}: {e}")
+        instrumentation.count('parse_failures')
+        return None
+
+# Function to read the video duration (seconds) from an itemStruct, or None if unknown
+def video_duration(video_info):
+    try:
+        return int((video_info or {}).get('video', {}).get('duration')) or None
+    except (TypeError, ValueError):
+        return None
+
+# Function to check whether a video was deliberately not downloaded for being too long
+def skipped_as_long(duration):
+    try:
+        return max_video_duration is not None and float(duration) > max_video_duration
+    except (TypeError, ValueError):
+        return False  # 'N/A' or unknown
 
+# Function to read the spreadsheet fields from an itemStruct
+def parse_video_info(url, video_info):
+    if video_info:
+        try:
             captions_text = video_info.get('desc', 'N/A')
             hashtags_text = [tag for tag in captions_text.split() if tag.startswith('#')]
             create_time = video_info.get('createTime', 'N/A')
@@ -53,6 +152,7 @@ def download_tiktok_video(url, folder_name, tab_number, video_id, retries=3):
             music_id = music_info.get('id', 'N/A')
             music_title = music_info.get('title', 'N/A')
             location_created = video_info.get('locationCreated', 'N/A')
+            duration = video_duration(video_info) or 'N/A'
         except (KeyError, TypeError, ValueError) as e:
             print(f"Error parsing video info for URL {url}: {e}")
             captions_text = "N/A"
@@ -62,6 +162,7 @@ def download_tiktok_video(url, folder_name, tab_number, video_id, retries=3):
             music_id = "N/A"
             music_title = "N/A"
             location_created = "N/A"
+            duration = "N/A"
     else:
         captions_text = "N/A"
         hashtags_text = []
@@ -70,63 +171,165 @@ def download_tiktok_video(url, folder_name, tab_number, video_id, retries=3):
         music_id = "N/A"
         music_title = "N/A"
         location_created = "N/A"
+        duration = "N/A"
 
-    print("Captions:", captions_text)
-    print("Hashtags:", hashtags_text)
-    print("Date:", date)
-    print("Diversification Labels:", diversification_labels)
-    print("Music ID:", music_id)
-    print("Music Title:", music_title)
-    print("Location Created:", location_created)
+    instrumentation.event('metadata', f"{url} - {date} - {music_title} ({music_id}) - {duration} seconds",
+                          url=url, captions=captions_text, hashtags=hashtags_text, date=date,
+                          diversification_labels=diversification_labels, music_id=music_id,
+                          music_title=music_title, location_created=location_created, duration=duration)
 
-    ydl_opts = {
-        'outtmpl': os.path.join(folder_name, f"{tab_number}-{video_id}.mp4"),
-    }
+    return captions_text, hashtags_text, date, diversification_labels, music_id, music_title, location_created, duration
+
+def download_tiktok_video(url, folder_name, tab_number, video_id, retries=3, max_duration=None):
+    video_path = os.path.join(folder_name, f"{tab_number}-{video_id}.mp4")
+
+    # Skip the download if the video is already in the folder, only read its metadata
+    if os.path.exists(video_path):
+        print(f"Already downloaded {video_path}")
+        return parse_video_info(url, fetch_item_struct(url, retries))
+
+    ydl = get_ydl()
+    ydl.params['outtmpl']['default'] = video_path
+
+    # The metadata comes from the video page's itemStruct (through the HTTP cache); yt-dlp's public
+    # info dict is only used if the page cannot be read
+    video_info = fetch_item_struct(url, retries)
+    info = None
+
+    # The page and the video file are fetched within the rate limits of their hosts; throttled
+    # (HTTP 429), 5xx and network errors are retried with exponential backoff instead of a fixed sleep
+    try:
+        if video_info is None:
+            info = rate_limit.call(url, lambda: ydl_call(lambda: ydl.extract_info(url, download=False)),
+                                   attempts=retries, retry_on=YTDLP_RETRY_ERRORS)
+            video_info = item_struct_from_info(info)
+            print(f"Using yt-dlp's metadata for URL {url}: no music ID, diversification labels or location")
+            instrumentation.count('metadata_fallbacks', url=url)
+
+        # Skip long videos before spending bandwidth on them
+        duration = video_duration(video_info)
+        if max_duration is not None and duration and duration > max_duration:
+            print(f"Skipping download of {url}: {duration} seconds is longer than {max_duration} seconds")
+            instrumentation.count('downloads_skipped')
+        else:
+            with instrumentation.timer('video_download'):
+                if info is None:
+                    rate_limit.call(url, lambda: ydl_call(lambda: ydl.extract_info(url, download=True)),
+                                    attempts=retries, retry_on=YTDLP_RETRY_ERRORS)
+                else:
+                    rate_limit.call(info.get('url') or url, lambda: ydl_call(lambda: ydl.process_ie_result(info, download=True)),
+                                    attempts=retries, retry_on=YTDLP_RETRY_ERRORS)
+    except Exception as e:
+        print(f"Giving up on video download for URL {url}: {e}")
+        instrumentation.count('failures', url=url, step='download')
+
+    return parse_video_info(url, video_info)
 
-    for attempt in range(retries):
+def process_tiktok_urls(store, output_file_base):
+    # One tab per sound, read from the video URLs stage 5 stored
+    tabs = [(str(number), store.read('video_urls', where='sound_number = ?', params=(number,), order_by='position'))
+            for number in store.distinct('video_urls', 'sound_number')]
+
+    # Videos already fetched for a sound folder (in this or an earlier run), by video ID
+    artifacts = {row['Video ID']: row for row in store.read('video_artifacts').to_dict('records')}
+
+    # One pool for the whole run, so each worker keeps its YoutubeDL instance across tabs
+    with ThreadPoolExecutor(max_workers=video_workers) as executor:
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            break
-        except Exception as e:
-            print(f"Attempt {attempt + 1} failed to download video for URL {url}: {e}")
-            if attempt + 1 == retries:
-                print(f"Giving up on video download for URL {url} after {retries} attempts")
-                break
-            time.sleep(5)
+            for tab, df in tabs:
+                process_tab(executor, store, tab, df, output_file_base, artifacts)
+        finally:
+            close_ydl_instances()
+
+# Function to get the stored metadata row of a video fetched for another sound folder, or None
+# Only artifacts whose file is still where it was saved (or that were skipped for being too long) are shared
+def shared_metadata(store, artifact, tab):
+    if artifact is None or artifact['Number'] == int(tab):
+        return None
+    if artifact['Path'] and not os.path.exists(artifact['Path']):
+        return None
+    rows = store.read('video_metadata', where='sound_number = ? AND video_url = ?', params=(int(artifact['Number']), artifact['Video URL']))
+    if rows.empty:
+        return None
+    metadata = rows.iloc[0].to_dict()
+    if not artifact['Path'] and not skipped_as_long(metadata['Video Duration']):
+        return None  # Its download failed, this folder tries again
+    return metadata
 
-    return captions_text, hashtags_text, date, diversification_labels, music_id, music_title, location_created
+# Function to give a sound folder a video fetched for another folder: copy the file, reuse the metadata
+def share_video(url, artifact, metadata, folder_name, tab_number, video_id):
+    video_path = os.path.join(folder_name, f"{tab_number}-{video_id}.mp4")
+    if artifact['Path'] and not os.path.exists(video_path):
+        shutil.copyfile(artifact['Path'], video_path)
+    instrumentation.count('videos_shared')
+    fields = ["Captions", "Hashtags", "Date", "Diversification Labels", "Music ID", "Music Title", "Location Created", "Video Duration"]
+    return [url] + ["N/A" if metadata[field] is None or metadata[field] != metadata[field] else metadata[field] for field in fields]
 
-def process_tiktok_urls(input_file, output_file_base):
-    data = pd.read_excel(input_file, sheet_name=None)
-    tabs = list(data.items())
+def process_tab(executor, store, tab, df, output_file_base, artifacts):
+    output_file = f"{output_file_base}_{tab}.xlsx"
 
-    for tab, df in tabs:
-        output_file = f"{output_file_base}_{tab}.xlsx"
-        writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
+    folder_name = os.path.join('/content/drive/My Drive/TikToks', str(tab))
+    if not os.path.exists(folder_name):
+        os.makedirs(folder_name)
+
+    # One canonical URL per video; videos another folder already has are copied instead of fetched
+    urls = unique(df['Video URL'].dropna())
+    video_ids = [canonical_video_id(url) or url.split('/')[-1] for url in urls]
+    shared = {}
+    for video_id in video_ids:
+        metadata = shared_metadata(store, artifacts.get(video_id), tab)
+        if metadata is not None:
+            shared[video_id] = metadata
+
+    def process_url(url, video_id):
+        try:
+            if video_id in shared:
+                return share_video(url, artifacts[video_id], shared[video_id], folder_name, tab, video_id)
+            captions, hashtags, date, diversification_labels, music_id, music_title, location_created, duration = download_tiktok_video(url, folder_name, tab, video_id, max_duration=max_video_duration)
+            return [url, captions, "; ".join(hashtags), date, "; ".join(diversification_labels), music_id, music_title, location_created, duration]
+        except Exception as e:
+            print(f"Failed to process URL {url}: {e}")
+            instrumentation.count('failures', url=url, step='process')
+            return [url, "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A"]
 
-        folder_name = os.path.join('/content/drive/My Drive/TikToks', str(tab))
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+    # Process the tab's videos on the worker pool, rows stay in the original order
+    urls_data = list(executor.map(process_url, urls, video_ids))
+    if shared:
+        print(f"Copied {len(shared)} videos of tab {tab} from other sound folders")
 
-        urls_data = []
+    # Remember the videos fetched for this tab for the next folders: the downloaded ones, and the
+    # ones skipped for being too long (without a file). Failed downloads are left out, so the next
+    # folder listing the same video tries again.
+    new_artifacts = []
+    for url, video_id, row in zip(urls, video_ids, urls_data):
+        video_path = os.path.join(folder_name, f"{tab}-{video_id}.mp4")
+        if video_id in shared:
+            continue
+        if os.path.exists(video_path):
+            new_artifacts.append({'video_id': video_id, 'sound_number': int(tab), 'video_url': url, 'path': video_path})
+        elif skipped_as_long(row[8]):
+            new_artifacts.append({'video_id': video_id, 'sound_number': int(tab), 'video_url': url, 'path': None})
 
-        for url in df['Video URL'].dropna():
-            try:
-                video_id = url.split('/')[-1]
-                captions, hashtags, date, diversification_labels, music_id, music_title, location_created = download_tiktok_video(url, folder_name, tab, video_id)
-                urls_data.append([url, captions, "; ".join(hashtags), date, "; ".join(diversification_labels), music_id, music_title, location_created])
-            except Exception as e:
-                print(f"Failed to process URL {url}: {e}")
-                urls_data.append([url, "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", "N/A"])
+    output_df = pd.DataFrame(urls_data, columns=["Video URL", "Captions", "Hashtags", "Date", "Diversification Labels", "Music ID", "Music Title", "Location Created", "Video Duration"])
+    output_df['Number'] = int(tab)
 
-        output_df = pd.DataFrame(urls_data, columns=["Video URL", "Captions", "Hashtags", "Date", "Diversification Labels", "Music ID", "Music Title", "Location Created"])
-        output_df.to_excel(writer, sheet_name=tab, index=False)
+    # Replace the tab's rows in the store in one transaction ('N/A' durations are stored as NULL)
+    store.append('video_metadata', output_df.to_dict('records'), replace_where='sound_number = ?', params=(int(tab),))
+    store.append('video_artifacts', new_artifacts)
+    artifacts.update({artifact['video_id']: {'Video ID': artifact['video_id'], 'Number': artifact['sound_number'],
+                                             'Video URL': artifact['video_url'], 'Path': artifact['path']}
+                      for artifact in new_artifacts})
+    print(f"Metadata of tab {tab} saved to the intermediate store")
 
-        writer.close()
+    if export_excel:
+        store.export_excel('video_metadata', output_file, where='sound_number = ?', params=(int(tab),), order_by='rowid',
+                           sheet_name=tab, fill_value='N/A', drop=['Number'])
         print(f"Metadata saved to {output_file}")
 
 # File paths
-input_file = '/content/drive/My Drive/TikTok Video URLs.xlsx'
+store_path = '/content/drive/My Drive/Pipeline Store.sqlite'
 output_file_base = '/content/drive/My Drive/TikTok Video Metadata/TikTok_Video_URLs_with_metadata'
-process_tiktok_urls(input_file, output_file_base)
\ No newline at end of file
+store = IntermediateStore(store_path)
+process_tiktok_urls(store, output_file_base)
+store.close()
+instrumentation.report()
\ No newline at end of file
@@ -1,6 +1,6 @@
 # 7. Filter out videos over 30 seconds by placing them in a separate folder
 
-!pip install --upgrade gspread google-auth google-auth-oauthlib google-auth-httplib2 pandas moviepy
+!pip install --upgrade gspread google-auth google-auth-oauthlib google-auth-httplib2 pandas
 
 from google.colab import auth
 auth.authenticate_user()
@@ -13,9 +13,22 @@ import gspread
 from gspread_dataframe import set_with_dataframe
 from google.auth import default
 import os
-from moviepy.editor import VideoFileClip
+import sys
 import numpy as np
 
+# Make the shared helper modules (video_probe.py, ...) importable from Drive
+sys.path.append('/content/drive/My Drive/Code')
+from video_probe import probe_durations
+from drive_index import DriveIndex
+from sheet_writer import SheetWriter
+from pipeline import Task, Manifest, run_task
+import instrumentation
+import rate_limit
+
+# Label the timers and JSON-lines log records of this stage; per-video durations go to the log
+# (set events=True to print them as well)
+instrumentation.configure(stage_name='7-long-video-filter', events=False)
+
 # Mount Google Drive
 drive.mount('/content/drive')
 drive.mount("/content/drive", force_remount=True)
@@ -25,45 +38,20 @@ creds, _ = default()
 gc = gspread.authorize(creds)
 drive_service = build('drive', 'v3', credentials=creds)
 
-# Function to move file to a new folder
-def move_file(file_id, folder_id):
-    try:
-        file = drive_service.files().get(fileId=file_id, fields='parents').execute()
-        previous_parents = ",".join(file.get('parents'))
-        file = drive_service.files().update(fileId=file_id,
-                                            addParents=folder_id,
-                                            removeParents=previous_parents,
-                                            fields='id, parents').execute()
-        print(f"Moved file {file_id} to folder {folder_id}")
-    except Exception as e:
-        print(f"Error moving file {file_id}: {e}")
+# Index of Drive folders: each folder is listed once, moves and folder creations are batched
+drive_index = DriveIndex(drive_service)
 
-# Create a new folder
-def create_folder(folder_name, parent_folder_id):
-    try:
-        file_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [parent_folder_id]
-        }
-        folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-        print(f"Created folder {folder_name} with ID {folder.get('id')}")
-        return folder.get('id')
-    except Exception as e:
-        print(f"Error creating folder {folder_name}: {e}")
-        return None
+# Function to move file to a new folder (queued, sent in a batch by drive_index.flush_moves())
+def move_file(file_id, folder_id):
+    drive_index.queue_move(file_id, folder_id)
 
 # Function to get the ID of a folder by name
 def get_folder_id(folder_name, parent_folder_id='root'):
     try:
-        query = f"name='{folder_name}' and '{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder'"
-        results = drive_service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-        items = results.get('files', [])
-        if not items:
+        folder_id = drive_index.get_folder_id(folder_name, parent_folder_id)
+        if not folder_id:
             print(f'No folder found for {folder_name} in {parent_folder_id}')
-            return None
-        else:
-            return items[0]['id']
+        return folder_id
     except Exception as e:
         print(f"Error getting folder ID for {folder_name}: {e}")
         return None
@@ -71,28 +59,22 @@ def get_folder_id(folder_name, parent_folder_id='root'):
 # Function to get file ID from file name
 def get_file_id(file_name, parent_folder_id):
     try:
-        query = f"name='{file_name}' and '{parent_folder_id}' in parents"
-        results = drive_service.files().list(q=query, spaces='drive', fields='files(id, name, mimeType)').execute()
-        items = results.get('files', [])
-        if not items:
+        file_id, mime_type = drive_index.get_file_id(file_name, parent_folder_id)
+        if not file_id:
             print(f'No file found for {file_name}')
-            return None, None
-        else:
-            return items[0]['id'], items[0]['mimeType']
+        return file_id, mime_type
     except Exception as e:
         print(f"Error getting file ID for {file_name}: {e}")
         return None, None
 
-# Function to get the duration of a video file
-def get_video_duration(file_path):
-    try:
-        clip = VideoFileClip(file_path)
-        duration = clip.duration
-        clip.close()
-        return duration
-    except Exception as e:
-        print(f"Error getting video duration for {file_path}: {e}")
-        return None
+# Cache of probed durations, keyed by file path, size and modification time
+duration_cache_path = '/content/drive/My Drive/TikToks/video_durations.json'
+
+# Videos longer than this (in seconds) are moved to 'Long Videos'
+max_video_duration = 30
+
+# Folder of the pipeline manifests (which folders are done, and with which inputs)
+pipeline_manifest_folder = '/content/drive/My Drive/Pipeline Manifest'
 
 # Specify the range of folder IDs to process
 start_folder_id = 1
@@ -116,34 +98,37 @@ if not tikToks_folder_id:
 folders = [str(f) for f in range(start_folder_id, end_folder_id + 1) if os.path.isdir(os.path.join(f'/content/drive/My Drive/TikToks', str(f)))]
 print(f"Found {len(folders)} folders in TikToks within the range {start_folder_id} to {end_folder_id}.")
 
-# Process each folder in TikToks
-for folder in folders:
+# Look up every folder's ID from the single TikToks listing
+folder_ids = {folder: get_folder_id(folder, tikToks_folder_id) for folder in folders}
+
+# Function to filter the long videos of one folder and update its sheet (one pipeline item)
+def filter_folder(folder):
     print(f"Processing folder {folder}")
 
-    folder_id = get_folder_id(folder, tikToks_folder_id)
+    # Raising (instead of returning) records the folder as failed, so the next run tries it again
+    folder_id = folder_ids[folder]
     if not folder_id:
-        print(f"Folder ID not found for {folder}")
-        continue
+        raise RuntimeError(f"Folder ID not found for {folder}")
 
-    # Create 'Long Videos' folder
-    long_videos_folder_id = create_folder('Long Videos', folder_id)
+    # Create (or reuse) the folder's 'Long Videos' folder, only for folders that are processed
+    long_videos_folder_id = drive_index.ensure_folders([('Long Videos', folder_id)])[0]
     if not long_videos_folder_id:
-        print(f"Failed to create 'Long Videos' folder in {folder}")
-        continue
+        raise RuntimeError(f"Failed to create 'Long Videos' folder in {folder}")
 
     # Get the ID of the Google Sheets file (not the .xlsx file)
     metadata_file_name = f'TikTok_Video_URLs_with_metadata_{folder}'
     spreadsheet_id, mime_type = get_file_id(metadata_file_name, metadata_folder_id)
     if not (spreadsheet_id and mime_type == 'application/vnd.google-apps.spreadsheet'):
-        print(f"Spreadsheet ID not found or not a Google Sheets file for {metadata_file_name}")
-        continue
+        raise RuntimeError(f"Spreadsheet ID not found or not a Google Sheets file for {metadata_file_name}")
 
     print(f"Loading metadata spreadsheet with ID: {spreadsheet_id}")
-    spreadsheet = gc.open_by_key(spreadsheet_id)
-    worksheet = spreadsheet.get_worksheet(0)
+    # Sheets calls go through the shared rate limiter, which retries 429s and 5xx errors with backoff
+    spreadsheet = rate_limit.call(rate_limit.SHEETS_HOST, lambda: gc.open_by_key(spreadsheet_id))
+    worksheet = rate_limit.call(rate_limit.SHEETS_HOST, lambda: spreadsheet.get_worksheet(0))
+    sheet_writer = SheetWriter(worksheet)  # Buffers the highlight formats of this folder
 
     # Convert the sheet to a DataFrame
-    data = worksheet.get_all_records()
+    data = rate_limit.call(rate_limit.SHEETS_HOST, worksheet.get_all_records)
     df = pd.DataFrame(data)
 
     # Add Video Duration column if it doesn't exist
@@ -153,17 +138,21 @@ for folder in folders:
     # List all mp4 files in the folder
     video_files = [f for f in os.listdir(f'/content/drive/My Drive/TikToks/{folder}') if f.endswith('.mp4')]
 
-    for video_file in video_files:
-        video_path = f'/content/drive/My Drive/TikToks/{folder}/{video_file}'
-        duration = get_video_duration(video_path)
+    # Probe all durations of the folder at once on a process pool
+    video_paths = [f'/content/drive/My Drive/TikToks/{folder}/{video_file}' for video_file in video_files]
+    durations = probe_durations(video_paths, cache_path=duration_cache_path)
+
+    for video_file, video_path in zip(video_files, video_paths):
+        duration = durations[video_path]
 
         # Always add the video duration to the metadata
-        print(f"Video {video_file} duration: {duration} seconds")
+        instrumentation.event('duration', f"Video {video_file} duration: {duration} seconds", folder=folder, video=video_file, duration=duration)
         file_id, _ = get_file_id(video_file, folder_id)
 
-        # Move videos longer than 30 seconds to 'Long Videos'
-        if duration and duration > 30:
-            print(f"Video {video_file} is longer than 30 seconds, moving to 'Long Videos'")
+        # Move videos longer than max_video_duration seconds to 'Long Videos'
+        if duration and duration > max_video_duration:
+            print(f"Video {video_file} is longer than {max_video_duration} seconds, moving to 'Long Videos'")
+            instrumentation.count('long_videos')
             if file_id:
                 move_file(file_id, long_videos_folder_id)
 
@@ -174,16 +163,33 @@ for folder in folders:
             row_index = row_index[0]
             df.at[row_index, 'Video Duration'] = duration  # Add duration to the DataFrame
 
-            # Highlight the row if the video is longer than 30 seconds
-            if duration and duration > 30:
-                cell_range = f'A{row_index+2}:H{row_index+2}'  # Adjust for header row and 0-based index
+            # Highlight the row if the video is longer than max_video_duration seconds
+            if duration and duration > max_video_duration:
+                # Adjust for header row and 0-based index; the range spans every column written back
+                # by set_with_dataframe below, including 'Video Duration'
+                cell_range = sheet_writer.row_range(row_index + 2, len(df.columns))
                 print(f"Highlighting cells {cell_range} in darker red")
                 format_darker_red = {"backgroundColor": {"red": 0.8, "green": 0.2, "blue": 0.2}}
-                worksheet.format(cell_range, format_darker_red)
+                sheet_writer.format_range(cell_range, format_darker_red)
+
+    # Send this folder's moves to Drive in batched requests
+    drive_index.flush_moves()
 
     # Handle NaN and infinite values before updating the Google Sheet
     df = df.replace([np.inf, -np.inf], np.nan).fillna('')
 
     # Update the Google Sheet with the new data
-    set_with_dataframe(worksheet, df)
+    rate_limit.call(rate_limit.SHEETS_HOST, lambda: set_with_dataframe(worksheet, df))
+    sheet_writer.flush()
     print(f"Updated metadata spreadsheet for folder {folder}")
+
+# Stage 7 as a pipeline task: a folder is only filtered again if its videos or the
+# duration limit changed since it was last completed (or its last run failed)
+long_video_task = Task(
+    '7-long-video-filter',
+    items=folders,
+    run=filter_folder,
+    inputs=lambda folder: [f'/content/drive/My Drive/TikToks/{folder}'],
+    params={'max_video_duration': max_video_duration})
+run_task(long_video_task, Manifest(pipeline_manifest_folder))
+instrumentation.report()
\ No newline at end of file
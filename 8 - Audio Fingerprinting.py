@@ -1,6 +1,6 @@
 # 8. Filter out Sounds using audio fingerprinting
 
-!pip install gspread gspread-formatting pydub librosa fastdtw
+!pip install gspread librosa
 !apt-get install -y ffmpeg
 
 from google.colab import auth
@@ -10,17 +10,29 @@ from googleapiclient.discovery import build
 from google.colab import drive
 import gspread
 from google.auth import default
-from gspread_formatting import CellFormat, format_cell_range, Color
 import os
-import subprocess
+import sys
 import shutil
 import numpy as np
 import librosa
 import matplotlib.pyplot as plt
-from pydub import AudioSegment
-from fastdtw import fastdtw
-from scipy.spatial.distance import euclidean
-import pandas as pd
+
+# Make the shared helper modules (drive_index.py, ...) importable from Drive
+sys.path.append('/content/drive/My Drive/Code')
+from drive_index import DriveIndex
+from audio_matching import match_mfcc
+from feature_store import FeatureStore
+from audio_loader import load_pcm
+from fingerprint_pool import match_videos
+from sheet_writer import SheetWriter
+import landmark_index
+import rate_limit
+from pipeline import Task, Manifest, run_task
+import instrumentation
+
+# Label the timers and JSON-lines log records of this stage (the match workers send theirs back
+# with each result); per-video matches go to the log, set events=True to print them as well
+instrumentation.configure(stage_name='8-audio-fingerprinting', events=False)
 
 # Mount Google Drive
 drive.mount('/content/drive')
@@ -30,24 +42,10 @@ creds, _ = default()
 gc = gspread.authorize(creds)
 drive_service = build('drive', 'v3', credentials=creds)
 
-# Function to extract audio from video using subprocess
-def extract_audio(video_path, audio_path):
-    try:
-        command = ['ffmpeg', '-i', video_path, '-q:a', '0', '-map', 'a', audio_path, '-y']
-        subprocess.run(command, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error extracting audio from {video_path}: {e}")
-        raise
-
-# Function to load audio and convert to a numpy array
+# Function to load the audio of an mp3 or video as a mono float32 numpy array
+# ffmpeg decodes, downmixes and resamples to target_sr in one pass, straight into memory
 def load_audio(file_path, target_sr=11025):
-    audio = AudioSegment.from_file(file_path)
-    samples = np.array(audio.get_array_of_samples())
-    frame_rate = audio.frame_rate
-    # Downsample the audio
-    samples = librosa.resample(samples.astype(float), orig_sr=frame_rate, target_sr=target_sr)
-    duration = len(samples) / target_sr
-    return samples, target_sr
+    return load_pcm(file_path, target_sr=target_sr, sidecar_dir=pcm_sidecar_folder)
 
 # Function to compute MFCC features with retry mechanism
 def compute_mfcc_with_retry(audio, sr, n_mfcc=13, retries=1):
@@ -58,192 +56,225 @@ def compute_mfcc_with_retry(audio, sr, n_mfcc=13, retries=1):
     return None
 
 # Function to compute MFCC features
+@instrumentation.timed('mfcc')
 def compute_mfcc(audio, sr, n_mfcc=13):
     max_val = np.max(np.abs(audio))
     if max_val == 0:
         return None
-    y = audio.astype(float) / max_val
+    y = audio.astype(np.float32) / max_val
     mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=n_mfcc)
     return mfccs
 
-# Function to check if two audio segments match and return the match score using rolling window
-def audio_match_with_rolling_window(audio1, sr1, audio2, sr2, step=50, n_mfcc=13):
-    mfcc1 = compute_mfcc_with_retry(audio1, sr1, n_mfcc)
+# Function to match a video against precomputed reference MFCCs (from the feature store)
+def audio_match_with_reference_features(mfcc1, audio2, sr2, n_mfcc=13):
     mfcc2 = compute_mfcc_with_retry(audio2, sr2, n_mfcc)
 
     if mfcc1 is None or mfcc2 is None:
         return None, None, None
 
-    best_match_score = float('-inf')
-    best_match_position = None
-
-    # Use a rolling window over MFCC1 to find the best matching segment
-    for i in range(0, mfcc1.shape[1] - mfcc2.shape[1] + 1, step):
-        mfcc1_segment = mfcc1[:, i:i + mfcc2.shape[1]]
-        distance, _ = fastdtw(mfcc1_segment.T, mfcc2.T, dist=euclidean)
-        match_score = -distance  # Invert distance to match similarity
-        if match_score > best_match_score:
-            best_match_score = match_score
-            best_match_position = i
-
-    # Calculate start and end times based on the best matching position
-    if best_match_position is not None:
-        start_time = best_match_position / mfcc1.shape[1]
-        end_time = (best_match_position + mfcc2.shape[1]) / mfcc1.shape[1]
-    else:
-        start_time = None
-        end_time = None
-
-    return best_match_score, start_time, end_time
-
-# Function to add columns to the Google Sheet if they don't exist
-def add_columns_if_not_exist(sheet, columns):
-    existing_columns = sheet.row_values(1)
-    for column in columns:
-        if column not in existing_columns:
-            existing_columns.append(column)
-    sheet.update([existing_columns])
+    return match_mfcc(mfcc1, mfcc2)
+
+# Function to compute the MFCCs of a reference sound file (used by the feature store)
+def compute_reference_mfcc(sound_path, n_mfcc=13):
+    samples, sr = load_audio(sound_path)
+    return compute_mfcc_with_retry(samples, sr, n_mfcc)
 
 # Function to update Google Sheet for matched or mismatched videos
+# sheet is a SheetWriter: changes are buffered and sent per folder by flush_metadata_sheet
 def update_sheet(sheet, video_id, start_time=None, end_time=None, highlight=False):
-    cell = None
     try:
-        # Load the sheet data into a DataFrame
-        df = pd.DataFrame(sheet.get_all_records())
-        row_index = df.index[df['Video URL'].str.endswith(video_id)].tolist()
-        if row_index:
-            row_index = row_index[0]
-            cell = sheet.cell(row_index + 2, 1)  # Adjust for header row
+        row = sheet.find_row('Video URL', video_id)
     except Exception as e:
-        pass
+        row = None
 
-    if cell:
-        cell_range = f'A{cell.row}:I{cell.row}'
+    if row:
+        cell_range = sheet.row_range(row)
 
         if highlight:
-            format_orange = CellFormat(
-                backgroundColor=Color(1, 0.65, 0)
-            )
-            format_cell_range(sheet, cell_range, format_orange)
+            format_orange = {"backgroundColor": {"red": 1, "green": 0.65, "blue": 0}}
+            sheet.format_range(cell_range, format_orange)
 
         # Update start and end times if provided
         if start_time is not None and end_time is not None:
-            add_columns_if_not_exist(sheet, ['Start Time', 'End Time'])
-            start_time_col = sheet.row_values(1).index('Start Time') + 1
-            end_time_col = sheet.row_values(1).index('End Time') + 1
-            sheet.update_cell(row_index + 2, start_time_col, start_time)
-            sheet.update_cell(row_index + 2, end_time_col, end_time)
+            sheet.set_values(row, {'Start Time': start_time, 'End Time': end_time})
+
+# Index of Drive folders: each folder is listed once and looked up in memory afterwards
+drive_index = DriveIndex(drive_service)
 
 # Function to get folder ID by name
 def get_folder_id(folder_name, parent_id='root'):
-    results = drive_service.files().list(
-        q=f"'{parent_id}' in parents and name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
-        fields="files(id, name)"
-    ).execute()
-    folders = results.get('files', [])
-    if not folders:
-        return None
-    return folders[0]['id']
+    return drive_index.get_folder_id(folder_name, parent_id)
 
 # Function to get file ID by name and type
 def get_file_id(file_name, parent_id='root'):
-    results = drive_service.files().list(
-        q=f"'{parent_id}' in parents and name='{file_name}' and trashed=false",
-        fields="files(id, mimeType)"
-    ).execute()
-    files = results.get('files', [])
-    if not files:
-        return None, None
-    return files[0]['id'], files[0]['mimeType']
+    return drive_index.get_file_id(file_name, parent_id)
 
 # Path settings
 sound_folder = "/content/drive/My Drive/Sound MP3s"
 tiktok_folder = "/content/drive/My Drive/TikToks"
 metadata_folder_path = "/content/drive/My Drive/TikTokVideoMetadata"
-output_folder = "/content/drive/My Drive/Extracted Audio"
+feature_folder = "/content/drive/My Drive/Sound Features"
+landmark_index_path = "/content/drive/My Drive/Sound Features/landmark_index.npz"
+pipeline_manifest_folder = "/content/drive/My Drive/Pipeline Manifest"
 
-# Ensure the output folder exists
-os.makedirs(output_folder, exist_ok=True)
+# Optional folder to keep decoded audio as .npy sidecars (None keeps nothing on disk)
+pcm_sidecar_folder = None
 
 # Range of numbers to process
 start_range = 1
 end_range = 428
 
-# Threshold for considering a match
-threshold = -25000
+# Threshold for considering a match (-25000 for the old fastdtw scores, scaled to the subsequence
+# DTW scores of audio_matching.py, which are about 0.88 times as large)
+threshold = -22000
+
+# Minimum number of agreeing landmark hashes to trust the identified sound of a mismatched video
+landmark_min_votes = 10
 
-# Dictionary to store fingerprinted sounds
-sound_fingerprints = {}
+# Reference sound MFCCs, computed once per file and parameters and kept on Drive
+sound_fingerprints = FeatureStore(feature_folder, compute_reference_mfcc, {'sr': 11025, 'n_mfcc': 13, 'feature': 'mfcc', 'loader': 'ffmpeg-pcm-mono'})
 
-# Fingerprint sound files within the specified range
+# Register sound files within the specified range (features are loaded lazily per sound_id)
 for file_name in os.listdir(sound_folder):
     if file_name.endswith(".mp3"):
         try:
             sound_id = int(file_name.split(" - ")[0])
             if start_range <= sound_id <= end_range:
-                sound_path = os.path.join(sound_folder, file_name)
-                samples, sr = load_audio(sound_path)
-                sound_fingerprints[sound_id] = (samples, sr)
+                sound_fingerprints.add(sound_id, os.path.join(sound_folder, file_name))
         except ValueError:
             pass
 
+# Landmark index over every sound in Sound MP3s, used to identify which sound a mismatched video uses
+# It is saved on Drive and rebuilt only when the sound files change
+all_sound_paths = {}
+for file_name in os.listdir(sound_folder):
+    if file_name.endswith(".mp3"):
+        try:
+            all_sound_paths[int(file_name.split(" - ")[0])] = os.path.join(sound_folder, file_name)
+        except ValueError:
+            pass
+landmarks = landmark_index.load_or_build(landmark_index_path, all_sound_paths, load_audio)
+
 # Load metadata spreadsheet once
 metadata_spreadsheets = {}
-
-for sound_id in range(start_range, end_range + 1):
-    try:
-        tiktok_path = os.path.join(tiktok_folder, str(sound_id))
-        if os.path.isdir(tiktok_path):
-            mismatch_folder = os.path.join(tiktok_path, "Wrong Fingerprinting")
-            os.makedirs(mismatch_folder, exist_ok=True)
-            for video_file in sorted(os.listdir(tiktok_path)):
-                if video_file.endswith(".mp4"):
-                    video_path = os.path.join(tiktok_path, video_file)
-                    audio_path = os.path.join(output_folder, f"{sound_id}_audio_{video_file}.mp3")
-                    try:
-                        extract_audio(video_path, audio_path)
-                        video_samples, video_sr = load_audio(audio_path)
-                        original_samples, original_sr = sound_fingerprints[sound_id]
-                        match_score, start_time, end_time = audio_match_with_rolling_window(original_samples, original_sr, video_samples, video_sr)
-                        if match_score is not None and match_score >= threshold:
-                            print(f"Match - {video_file} - {match_score}")
-                            # Update sheet with match details
-                            metadata_file_name = f'TikTok_Video_URLs_with_metadata_{sound_id}'
-                            if metadata_file_name not in metadata_spreadsheets:
-                                spreadsheet_id, mime_type = get_file_id(metadata_file_name, get_folder_id('TikTokVideoMetadata'))
-                                if spreadsheet_id and mime_type == 'application/vnd.google-apps.spreadsheet':
-                                    metadata_spreadsheets[metadata_file_name] = gc.open_by_key(spreadsheet_id).sheet1
-                                else:
-                                    continue
-                            sheet = metadata_spreadsheets[metadata_file_name]
-                            update_sheet(sheet, video_file.split('-')[-1].split('.')[0], start_time, end_time, highlight=False)
-                        else:
-                            print(f"Non Match - {video_file} - {match_score}")
-                            shutil.move(video_path, os.path.join(mismatch_folder, video_file))
-                            mismatched_video_id = video_file.split('-')[-1].split('.')[0]
-                            metadata_file_name = f'TikTok_Video_URLs_with_metadata_{sound_id}'
-                            if metadata_file_name not in metadata_spreadsheets:
-                                spreadsheet_id, mime_type = get_file_id(metadata_file_name, get_folder_id('TikTokVideoMetadata'))
-                                if spreadsheet_id and mime_type == 'application/vnd.google-apps.spreadsheet':
-                                    metadata_spreadsheets[metadata_file_name] = gc.open_by_key(spreadsheet_id).sheet1
-                                else:
-                                    continue
-                            sheet = metadata_spreadsheets[metadata_file_name]
-                            update_sheet(sheet, mismatched_video_id, highlight=True)
-
-                    except Exception as e:
-                        print(f"Error processing {video_path}: {e}")
-                        shutil.move(video_path, os.path.join(mismatch_folder, video_file))
-                        mismatched_video_id = video_file.split('-')[-1].split('.')[0]
-                        metadata_file_name = f'TikTok_Video_URLs_with_metadata_{sound_id}'
-                        if metadata_file_name not in metadata_spreadsheets:
-                            spreadsheet_id, mime_type = get_file_id(metadata_file_name, get_folder_id('TikTokVideoMetadata'))
-                            if spreadsheet_id and mime_type == 'application/vnd.google-apps.spreadsheet':
-                                metadata_spreadsheets[metadata_file_name] = gc.open_by_key(spreadsheet_id).sheet1
-                            else:
-                                continue
-                        sheet = metadata_spreadsheets[metadata_file_name]
-                        update_sheet(sheet, mismatched_video_id, highlight=True)
-
-    except ValueError:
-        pass
\ No newline at end of file
+metadata_folder_id = get_folder_id('TikTokVideoMetadata')
+
+# Function to get the metadata sheet of a sound folder (opened once), or None
+def get_metadata_sheet(sound_id):
+    metadata_file_name = f'TikTok_Video_URLs_with_metadata_{sound_id}'
+    if metadata_file_name not in metadata_spreadsheets:
+        spreadsheet_id, mime_type = get_file_id(metadata_file_name, metadata_folder_id)
+        if spreadsheet_id and mime_type == 'application/vnd.google-apps.spreadsheet':
+            worksheet = rate_limit.call(rate_limit.SHEETS_HOST, lambda: gc.open_by_key(spreadsheet_id).sheet1)
+            metadata_spreadsheets[metadata_file_name] = SheetWriter(worksheet)
+        else:
+            return None
+    return metadata_spreadsheets[metadata_file_name]
+
+# Function to send a folder's buffered sheet changes in one batch
+def flush_metadata_sheet(sound_id):
+    sheet = metadata_spreadsheets.get(f'TikTok_Video_URLs_with_metadata_{sound_id}')
+    if sheet is not None:
+        try:
+            sheet.flush()
+        except Exception as e:
+            print(f"Error updating metadata sheet for {sound_id}: {e}")
+
+# Function to move a video to 'Wrong Fingerprinting' and highlight it in the sheet
+# identified is (sound_id, offset, votes) from the landmark index; a trusted result is written to the sheet
+def record_mismatch(sound_id, video_path, video_file, mismatch_folder, identified=None):
+    shutil.move(video_path, os.path.join(mismatch_folder, video_file))
+    mismatched_video_id = video_file.split('-')[-1].split('.')[0]
+    sheet = get_metadata_sheet(sound_id)
+    if sheet is not None:
+        update_sheet(sheet, mismatched_video_id, highlight=True)
+        if is_trusted_identification(identified):
+            row = sheet.find_row('Video URL', mismatched_video_id)
+            if row:
+                sheet.set_values(row, {'Identified Sound ID': identified[0],
+                                       'Identified Sound Offset': round(identified[1], 2)})
+
+# Function to identify the sound a video uses with the landmark index: (sound_id, offset, votes)
+def identify_sound(video_samples):
+    return landmarks.identify(video_samples)
+
+# Function to check that an identification has enough agreeing hashes to be trusted
+def is_trusted_identification(identified):
+    return identified is not None and identified[0] is not None and identified[2] >= landmark_min_votes
+
+# Function run in the worker processes: match one video against the reference MFCCs
+# Videos that do not match are also looked up in the landmark index
+def match_video_file(reference_mfcc, video_path):
+    video_samples, video_sr = load_audio(video_path)
+    match_score, start_time, end_time = audio_match_with_reference_features(reference_mfcc, video_samples, video_sr)
+    identified = None
+    if match_score is None or match_score < threshold:
+        identified = identify_sound(video_samples)
+    return match_score, start_time, end_time, identified
+
+# Number of processes matching videos in parallel (1 matches in this process)
+match_workers = os.cpu_count()
+
+# Function to match every video of one sound folder (one pipeline item)
+def fingerprint_folder(sound_id):
+    tiktok_path = os.path.join(tiktok_folder, str(sound_id))
+    if not os.path.isdir(tiktok_path):
+        # Recorded as failed (not done), so the folder is matched once it appears
+        raise FileNotFoundError(f"No video folder for sound {sound_id}")
+
+    mismatch_folder = os.path.join(tiktok_path, "Wrong Fingerprinting")
+    os.makedirs(mismatch_folder, exist_ok=True)
+    video_files = [video_file for video_file in sorted(os.listdir(tiktok_path)) if video_file.endswith(".mp4")]
+    video_paths = [os.path.join(tiktok_path, video_file) for video_file in video_files]
+
+    # Match all videos of the folder in parallel; the workers get this sound's MFCCs once
+    # A video's own errors come back as its result; anything else (a missing sound file, a broken
+    # pool) is raised, so the folder is recorded as failed and matched again on the next run
+    original_mfcc = sound_fingerprints.get(sound_id)
+    results = match_videos(video_paths, original_mfcc, match_video_file, workers=match_workers)
+
+    # File moves and sheet updates all happen here, in the coordinating process
+    for video_file, video_path, result in zip(video_files, video_paths, results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            match_score, start_time, end_time, identified = result
+            if match_score is not None and match_score >= threshold:
+                instrumentation.event('match', f"Match - {video_file} - {match_score}", sound_id=sound_id, video=video_file,
+                                      score=match_score, start_time=start_time, end_time=end_time)
+                instrumentation.count('matches')
+                # Update sheet with match details
+                sheet = get_metadata_sheet(sound_id)
+                if sheet is not None:
+                    update_sheet(sheet, video_file.split('-')[-1].split('.')[0], start_time, end_time, highlight=False)
+            else:
+                if is_trusted_identification(identified):
+                    instrumentation.event('non_match', f"Non Match - {video_file} - {match_score} - uses sound {identified[0]} at {identified[1]:.1f}s ({identified[2]} votes)",
+                                          sound_id=sound_id, video=video_file, score=match_score, identified_sound_id=identified[0],
+                                          identified_offset=identified[1], votes=identified[2])
+                else:
+                    instrumentation.event('non_match', f"Non Match - {video_file} - {match_score}", sound_id=sound_id, video=video_file, score=match_score)
+                instrumentation.count('non_matches')
+                record_mismatch(sound_id, video_path, video_file, mismatch_folder, identified)
+
+        except Exception as e:
+            print(f"Error processing {video_path}: {e}")
+            instrumentation.count('failures', video=video_path)
+            record_mismatch(sound_id, video_path, video_file, mismatch_folder)
+
+    flush_metadata_sheet(sound_id)
+
+    # This sound's features are not needed for the next folders
+    sound_fingerprints.release(sound_id)
+
+# Stage 8 as a pipeline task: a folder is only matched again if its videos, its sound file
+# or the matching parameters changed since it was last completed (or its last run failed)
+fingerprinting_task = Task(
+    '8-audio-fingerprinting',
+    items=range(start_range, end_range + 1),
+    run=fingerprint_folder,
+    inputs=lambda sound_id: [os.path.join(tiktok_folder, str(sound_id))] + ([all_sound_paths[sound_id]] if sound_id in all_sound_paths else []),
+    params={'threshold': threshold, 'features': sound_fingerprints.params_key, 'landmark_min_votes': landmark_min_votes},
+    depends_on=['7-long-video-filter'])
+run_task(fingerprinting_task, Manifest(pipeline_manifest_folder))
+instrumentation.report()
\ No newline at end of file
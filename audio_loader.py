@@ -0,0 +1,49 @@
+# Direct ffmpeg -> NumPy audio loading for stage 8
+#
+# ffmpeg decodes the audio track, downmixes it to mono and resamples it to the
+# target rate in one pass, writing raw PCM to a pipe that is read straight into
+# a NumPy array. No intermediate mp3 is written and no second resample is done.
+# Decoded audio can optionally be kept as a .npy sidecar for later runs.
+
+import os
+import subprocess
+
+import numpy as np
+
+import instrumentation
+
+# Raw PCM formats ffmpeg can write and the matching NumPy dtypes
+PCM_FORMATS = {
+    'float32': ('f32le', np.float32),
+    'int16': ('s16le', np.int16),
+}
+
+
+# Function to get the sidecar path for a media file, or None if sidecars are off
+def sidecar_path(file_path, target_sr, dtype, sidecar_dir):
+    if not sidecar_dir:
+        return None
+    base_name = os.path.basename(file_path)
+    return os.path.join(sidecar_dir, f"{base_name}.{target_sr}.{dtype}.npy")
+
+# Function to decode the audio of any media file into a mono NumPy array at target_sr
+# Returns (samples, target_sr); raises subprocess.CalledProcessError if ffmpeg fails
+@instrumentation.timed('decode')
+def load_pcm(file_path, target_sr=11025, dtype='float32', sidecar_dir=None):
+    sidecar = sidecar_path(file_path, target_sr, dtype, sidecar_dir)
+    if sidecar and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(file_path):
+        return np.load(sidecar), target_sr
+
+    pcm_format, numpy_dtype = PCM_FORMATS[dtype]
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', file_path,
+               '-vn', '-ac', '1', '-ar', str(target_sr), '-f', pcm_format, 'pipe:1']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    samples = np.frombuffer(result.stdout, dtype=numpy_dtype)
+
+    if sidecar:
+        os.makedirs(sidecar_dir, exist_ok=True)
+        tmp_path = sidecar[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, samples)
+        os.replace(tmp_path, sidecar)
+
+    return samples, target_sr
@@ -0,0 +1,139 @@
+# Micro-benchmark: full BeautifulSoup trees vs. the targeted extraction in extract.py
+#
+# Usage: python benchmarks/bench_extract.py [folder with saved pages] [repeats]
+#
+# Saved pages are picked up by file name: artist_*.html (Tokchart artist pages,
+# stage 2), sound_*.html (Tokchart sound pages, stage 4) and video_*.html (TikTok
+# video pages, stage 6). Kinds without a saved page are benchmarked on a
+# synthetic page of the same structure.
+
+import os
+import sys
+import json
+import glob
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extract
+
+
+# Function to build a synthetic Tokchart artist page with a sound table
+def synthetic_artist_page(rows=50, filler=400):
+    body = ['<html><head><title>Artist</title></head><body><nav>']
+    body += [f'<a href="https://tokchart.com/nav/{i}" class="nav-link">Link {i}</a>' for i in range(filler)]
+    body.append('</nav><table><thead><tr><th>#</th><th>Sound</th><th>Views</th></tr></thead><tbody>')
+    for i in range(rows):
+        body.append(
+            f'<tr><td>{i + 1}</td><td><a href="https://tokchart.com/dashboard/sounds/{i}" class="{extract.SOUND_ANCHOR_CLASS}"><img src="x.jpg"></a>'
+            f'<a href="https://tokchart.com/dashboard/sounds/{i}" class="{extract.SOUND_TITLE_CLASS}">Sound {i}</a></td>'
+            f'<td><div class="text-center">{(i + 1) * 1000}</div></td></tr>'
+        )
+    body.append('</tbody></table></body></html>')
+    return ''.join(body)
+
+# Function to build a synthetic Tokchart sound page with the TikTok button
+def synthetic_sound_page(filler=800):
+    body = ['<html><body>']
+    body += [f'<div class="row"><a href="https://tokchart.com/x/{i}" class="link">Item {i}</a></div>' for i in range(filler)]
+    body.append(f'<a href="https://www.tiktok.com/music/sound-123" class="{extract.TIKTOK_ANCHOR_CLASS}">Open in TikTok</a>')
+    body.append('</body></html>')
+    return ''.join(body)
+
+# Function to build a synthetic TikTok video page with a rehydration payload
+def synthetic_video_page(comments=2000):
+    payload = {
+        '__DEFAULT_SCOPE__': {
+            'webapp.app-context': {'language': 'en', 'region': 'GB', 'user': {'uid': '0'}},
+            'webapp.video-detail': {
+                'itemInfo': {
+                    'itemStruct': {
+                        'id': '7300000000000000000',
+                        'desc': 'Dancing #fyp #dance',
+                        'createTime': '1700000000',
+                        'diversificationLabels': ['Dance', 'Entertainment'],
+                        'music': {'id': '7100000000000000000', 'title': 'original sound'},
+                        'locationCreated': 'GB',
+                        'video': {'duration': 15},
+                    }
+                },
+                'shareMeta': {'title': 'video'},
+            },
+            'seo.abtest': {'comments': [{'id': i, 'text': 'comment ' * 5} for i in range(comments)]},
+        }
+    }
+    script = f'<script id="{extract.REHYDRATION_SCRIPT_ID}" type="application/json">{json.dumps(payload)}</script>'
+    filler = ''.join(f'<div class="c{i}"><span>text {i}</span></div>' for i in range(1500))
+    return f'<html><head>{script}</head><body>{filler}</body></html>'
+
+# Functions reproducing the original per-page parsing code
+def baseline_artist(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    return [row.find('a', class_=extract.SOUND_ANCHOR_CLASS) for row in soup.select('tbody > tr')]
+
+def baseline_sound(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    anchor = soup.find('a', class_=extract.TIKTOK_ANCHOR_CLASS)
+    return anchor['href'] if anchor else None
+
+def baseline_video(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    script_tag = soup.find('script', id=extract.REHYDRATION_SCRIPT_ID)
+    data = json.loads(script_tag.string)
+    return data['__DEFAULT_SCOPE__']['webapp.video-detail']['itemInfo']['itemStruct']
+
+# Functions using the targeted extraction layer
+def targeted_artist(html):
+    return [row.find('a', class_=extract.SOUND_ANCHOR_CLASS) for row in extract.sound_table_rows(html)]
+
+def targeted_sound(html):
+    return extract.tiktok_sound_url(html)
+
+def targeted_video(html):
+    return extract.video_item_struct(html)
+
+# Function to load saved pages of one kind, or a synthetic page if there are none
+def load_pages(folder, kind, synthetic):
+    pages = []
+    if folder:
+        for path in sorted(glob.glob(os.path.join(folder, f'{kind}_*.html'))):
+            with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                pages.append(file.read())
+    if not pages:
+        pages = [synthetic()]
+    return pages
+
+# Function to time func over every page, returning milliseconds per page
+def time_per_page(func, pages, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for page in pages:
+            func(page)
+    return (time.perf_counter() - start) * 1000 / (repeats * len(pages))
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else None
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    cases = [
+        ('artist', 'stage 2 sound table', synthetic_artist_page, baseline_artist, targeted_artist),
+        ('sound', 'stage 4 TikTok button', synthetic_sound_page, baseline_sound, targeted_sound),
+        ('video', 'stage 6 itemStruct', synthetic_video_page, baseline_video, targeted_video),
+    ]
+
+    print(f"Parser: {extract.PARSER}")
+    for kind, label, synthetic, baseline, targeted in cases:
+        pages = load_pages(folder, kind, synthetic)
+        # Both paths must agree before their timings mean anything
+        for page in pages:
+            if kind == 'artist':
+                assert [a['href'] for a in baseline(page) if a] == [a['href'] for a in targeted(page) if a]
+            else:
+                assert baseline(page) == targeted(page)
+        baseline_ms = time_per_page(baseline, pages, repeats)
+        targeted_ms = time_per_page(targeted, pages, repeats)
+        print(f"{label:<22} {len(pages):>3} page(s)  full soup {baseline_ms:8.2f} ms/page  targeted {targeted_ms:8.2f} ms/page  speedup {baseline_ms / targeted_ms:6.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Benchmark: stage 8 rolling-window fastdtw vs. the vectorized matcher in audio_matching.py
+#
+# Usage: python benchmarks/bench_matching.py [reference seconds] [video seconds] [pairs]
+#
+# Synthetic MFCC sequences are used (13 coefficients, 11025 Hz, hop 512, as
+# librosa produces in stage 8): the video is a noisy slice of the reference at a
+# known offset, so both the speed and the recovered offset can be compared.
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_matching import match_mfcc
+
+FRAMES_PER_SECOND = 11025 / 512
+
+
+# The original stage 8 matching loop (MFCC computation left out)
+def rolling_window_fastdtw(mfcc1, mfcc2, step=50):
+    from fastdtw import fastdtw
+    from scipy.spatial.distance import euclidean
+
+    best_match_score = float('-inf')
+    best_match_position = None
+    for i in range(0, mfcc1.shape[1] - mfcc2.shape[1] + 1, step):
+        mfcc1_segment = mfcc1[:, i:i + mfcc2.shape[1]]
+        distance, _ = fastdtw(mfcc1_segment.T, mfcc2.T, dist=euclidean)
+        match_score = -distance
+        if match_score > best_match_score:
+            best_match_score = match_score
+            best_match_position = i
+    if best_match_position is None:
+        return best_match_score, None, None
+    return best_match_score, best_match_position / mfcc1.shape[1], (best_match_position + mfcc2.shape[1]) / mfcc1.shape[1]
+
+# Function to build a reference MFCC sequence and a noisy video slice of it
+def synthetic_pair(rng, reference_seconds, video_seconds):
+    n_ref = int(reference_seconds * FRAMES_PER_SECOND)
+    n_query = int(video_seconds * FRAMES_PER_SECOND)
+    reference = np.cumsum(rng.normal(0, 5, size=(13, n_ref)), axis=1)
+    offset = int(rng.integers(0, n_ref - n_query + 1))
+    query = reference[:, offset:offset + n_query] + rng.normal(0, 2, size=(13, n_query))
+    return reference, query, offset / n_ref
+
+def main():
+    reference_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    video_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 15
+    pairs = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    rng = np.random.default_rng(0)
+    cases = [synthetic_pair(rng, reference_seconds, video_seconds) for _ in range(pairs)]
+
+    try:
+        import fastdtw  # noqa: F401
+        have_fastdtw = True
+    except ImportError:
+        have_fastdtw = False
+        print("fastdtw is not installed, only timing the vectorized matcher")
+
+    baseline_seconds = 0.0
+    vectorized_seconds = 0.0
+    for reference, query, true_start in cases:
+        start = time.perf_counter()
+        score, start_time, _ = match_mfcc(reference, query)
+        vectorized_seconds += time.perf_counter() - start
+        print(f"true start {true_start:.4f}  vectorized: score {score:10.1f} start {start_time:.4f}", end='')
+
+        if have_fastdtw:
+            start = time.perf_counter()
+            old_score, old_start_time, _ = rolling_window_fastdtw(reference, query)
+            baseline_seconds += time.perf_counter() - start
+            print(f"  fastdtw step=50: score {old_score:10.1f} start {old_start_time:.4f}", end='')
+        print()
+
+    print(f"vectorized: {vectorized_seconds / pairs * 1000:.1f} ms per pair")
+    if have_fastdtw:
+        print(f"fastdtw:    {baseline_seconds / pairs * 1000:.1f} ms per pair  (speedup {baseline_seconds / vectorized_seconds:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+# Offline benchmark of the per-item work of every stage, against local stand-ins
+#
+# Usage: python benchmarks/bench_pipeline.py [--pages DIR] [--fixtures DIR] [--latency MS]
+#                                            [--cases a,b,...] [--json OUT] [--compare BASELINE]
+#
+# Tokchart and TikTok pages come from a local HTTP server (standins.PageServer),
+# media from generated fixtures (media_fixtures.py) and Drive/Sheets from
+# in-memory fakes. The stage scripts are notebooks and cannot be imported, so
+# each case runs the same shared-module calls as the stage function it is named
+# after. Every case runs in its own process and reports items/sec, latency
+# percentiles and the process's peak RSS. --json saves the results and
+# --compare prints the change against a saved run, to catch regressions before
+# a full production run.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import extract
+import fetch
+import downloader
+import video_probe
+import frame_sampler
+from audio_matching import match_mfcc
+from drive_index import DriveIndex, FOLDER_MIME_TYPE
+from sheet_writer import SheetWriter
+from standins import PageServer, FakeDriveService, FakeWorksheet
+import media_fixtures
+
+STAGE_8_SR = 11025
+
+
+# Stage 2 get_sounds_info: fetch an artist page and read its sound table
+def get_sounds_info(url):
+    response = fetch.fetch(url)
+    response.raise_for_status()
+    sounds_info = []
+    for row in extract.sound_table_rows(response.text):
+        sound_anchor = row.find('a', class_=extract.SOUND_ANCHOR_CLASS)
+        title_element = row.find('a', class_=extract.SOUND_TITLE_CLASS)
+        td_elements = row.find_all('td')
+        if not sound_anchor or not title_element or len(td_elements) < 3:
+            continue
+        views_div = td_elements[2].find('div', class_='text-center')
+        if views_div:
+            sounds_info.append((sound_anchor['href'], title_element.text.strip(), views_div.text.strip()))
+    return sounds_info
+
+# Stage 4 get_tiktok_url: fetch a sound page and read the TikTok button's href
+def get_tiktok_url(url):
+    response = fetch.fetch(url)
+    response.raise_for_status()
+    return extract.tiktok_sound_url(response.text)
+
+# Stage 6 download_tiktok_video: fetch the video page, read its itemStruct and download the mp4
+def download_tiktok_video(job):
+    page_url, media_url, save_path = job
+    response = fetch.fetch(page_url, timeout=10)
+    response.raise_for_status()
+    item_struct = extract.item_struct_from_payload(extract.rehydration_text(response.content))
+    result = downloader.download_file(media_url, save_path, default_extension='.mp4')
+    if result['status'] == 'failed':
+        raise RuntimeError(f"Download of {media_url} failed: {result['error']}")
+    return item_struct
+
+# Stage 8 load_audio: decode to mono float32 at 11025 Hz (with ffmpeg, or from the WAV fixture)
+def load_audio(path, wav_path=None):
+    if media_fixtures.have_ffmpeg():
+        from audio_loader import load_pcm
+        return load_pcm(path, target_sr=STAGE_8_SR)
+    samples, sr = media_fixtures.read_wav(wav_path or path)
+    return samples[::sr // STAGE_8_SR], STAGE_8_SR
+
+# Stage 8 compute_mfcc
+def compute_mfcc(audio, sr, n_mfcc=13):
+    import librosa
+    max_val = np.max(np.abs(audio))
+    if max_val == 0:
+        return None
+    return librosa.feature.mfcc(y=audio.astype(np.float32) / max_val, sr=sr, n_mfcc=n_mfcc)
+
+# Stage 8 audio_match_with_rolling_window
+def audio_match_with_rolling_window(audio1, sr1, audio2, sr2, n_mfcc=13):
+    mfcc1 = compute_mfcc(audio1, sr1, n_mfcc)
+    mfcc2 = compute_mfcc(audio2, sr2, n_mfcc)
+    if mfcc1 is None or mfcc2 is None:
+        return None, None, None
+    return match_mfcc(mfcc1, mfcc2)
+
+
+# Each case builds its items (untimed) and returns (items, func, check)
+# check(results) returns a short accuracy note, or None
+def case_get_sounds_info(context):
+    urls = [f"{context['base_url']}/dashboard/artists/{i}" for i in range(context['pages'])]
+    return urls, get_sounds_info, lambda results: f"{sum(len(r) for r in results)} sounds"
+
+def case_get_tiktok_url(context):
+    urls = [f"{context['base_url']}/dashboard/sounds/{i}" for i in range(context['pages'])]
+    return urls, get_tiktok_url, lambda results: f"{sum(1 for r in results if r)}/{len(results)} URLs found"
+
+def case_download_tiktok_video(context):
+    download_dir = tempfile.mkdtemp(prefix='bench_downloads_')
+    jobs = [(f"{context['base_url']}/@bench/video/{video['video_id']}",
+             f"{context['base_url']}/media/{os.path.basename(video['path'])}",
+             os.path.join(download_dir, str(video['video_id'])))
+            for video in context['fixtures']['videos']]
+
+    def check(results):
+        sizes = sum(os.path.getsize(path + '.mp4') for _, _, path in jobs if os.path.exists(path + '.mp4'))
+        shutil.rmtree(download_dir, ignore_errors=True)
+        return f"{sizes / 1e6:.1f} MB downloaded"
+    return jobs, download_tiktok_video, check
+
+def case_get_video_duration(context):
+    paths = [video['path'] for video in context['fixtures']['videos']]
+    return paths, video_probe.probe_duration, lambda results: f"{sum(1 for r in results if r)}/{len(results)} durations read"
+
+def case_audio_match_with_rolling_window(context):
+    import librosa  # noqa: F401 (the case is skipped without it)
+    fixtures = context['fixtures']
+    sounds = {}
+    for sound in fixtures['sounds']:
+        sounds[sound['id']] = load_audio(sound['path'], sound['path'].rsplit('.', 1)[0] + '.wav')
+    items = []
+    for video in fixtures['videos']:
+        samples, sr = load_audio(video['path'], video['audio_path'])
+        reference, reference_sr = sounds[video['sound_id']]
+        items.append((reference, reference_sr, samples, sr))
+    # librosa compiles its kernels on first use; keep that out of the timings
+    audio_match_with_rolling_window(*items[0])
+
+    def check(results):
+        correct = 0
+        scores = {'match': [], 'non-match': []}
+        for video, (score, start, _) in zip(fixtures['videos'], results):
+            sound_seconds = len(sounds[video['sound_id']][0]) / STAGE_8_SR
+            if video['offset'] is None:
+                scores['non-match'].append(score)
+            else:
+                scores['match'].append(score)
+                correct += start is not None and abs(start * sound_seconds - video['offset']) < 0.5
+        return (f"{correct}/{len(scores['match'])} offsets within 0.5 s, worst match score {min(scores['match']):.0f}, "
+                f"best non-match score {max(scores['non-match']):.0f}")
+    return items, lambda item: audio_match_with_rolling_window(*item), check
+
+def case_identify_sound(context):
+    import landmark_index
+    fixtures = context['fixtures']
+    sound_paths = {sound['id']: sound['path'] for sound in fixtures['sounds']}
+    index = landmark_index.LandmarkIndex.build(
+        sound_paths, lambda path: load_audio(path, path.rsplit('.', 1)[0] + '.wav'))
+    items = [load_audio(video['path'], video['audio_path'])[0] for video in fixtures['videos']]
+
+    def check(results):
+        matches = [(video, result) for video, result in zip(fixtures['videos'], results) if video['offset'] is not None]
+        correct = sum(result[0] == video['sound_id'] for video, result in matches)
+        non_match_votes = [result[2] for video, result in zip(fixtures['videos'], results) if video['offset'] is None]
+        return f"{correct}/{len(matches)} sounds identified, most votes for a non-match {max(non_match_votes)}"
+    return items, index.identify, check
+
+def case_extract_frames(context):
+    paths = [video['path'] for video in context['fixtures']['videos']]
+
+    def extract_frames(path):
+        return list(frame_sampler.sample_frames(path, 1.0, max_size=240, method=context['frame_method']))
+    return paths, extract_frames, lambda results: f"{sum(len(r) for r in results)} frames"
+
+def case_drive_sheet_updates(context):
+    # Stage 8's coordinator work for one folder of videos: look up, queue moves, update the sheet, flush
+    videos_per_folder = 20
+    folders = []
+    for folder_number in range(1, 11):
+        service = FakeDriveService(latency=context['latency'])
+        folder_id = service.add_file(str(folder_number), FOLDER_MIME_TYPE, 'root')
+        mismatch_id = service.add_file('Wrong Fingerprinting', FOLDER_MIME_TYPE, folder_id)
+        names = [f'{folder_number}-{7300000000000000000 + i}.mp4' for i in range(videos_per_folder)]
+        for name in names:
+            service.add_file(name, 'video/mp4', folder_id)
+        rows = [['Video URL', 'Captions']] + [[f'https://www.tiktok.com/@x/video/{name.split("-")[-1][:-4]}', ''] for name in names]
+        folders.append((service, FakeWorksheet(rows, latency=context['latency']), folder_id, mismatch_id, names))
+
+    def update_folder(folder):
+        service, worksheet, folder_id, mismatch_id, names = folder
+        drive_index = DriveIndex(service)
+        sheet = SheetWriter(worksheet)
+        for i, name in enumerate(names):
+            row = sheet.find_row('Video URL', name.split('-')[-1].split('.')[0])
+            if i % 4 == 0:
+                file_id, _ = drive_index.get_file_id(name, folder_id)
+                drive_index.queue_move(file_id, mismatch_id)
+                sheet.format_range(sheet.row_range(row), {"backgroundColor": {"red": 1, "green": 0.65, "blue": 0}})
+            else:
+                sheet.set_values(row, {'Start Time': 0.1, 'End Time': 0.5})
+        drive_index.flush_moves()
+        sheet.flush()
+        return service.calls + worksheet.calls
+
+    return folders, update_folder, lambda results: f"{sum(results) / len(results):.1f} API round trips per folder of {videos_per_folder} videos"
+
+CASES = {
+    'get_sounds_info': case_get_sounds_info,
+    'get_tiktok_url': case_get_tiktok_url,
+    'download_tiktok_video': case_download_tiktok_video,
+    'get_video_duration': case_get_video_duration,
+    'audio_match_with_rolling_window': case_audio_match_with_rolling_window,
+    'identify_sound': case_identify_sound,
+    'extract_frames': case_extract_frames,
+    'drive_sheet_updates': case_drive_sheet_updates,
+}
+
+
+# Function run in a child process: set up one case, time every item and report back
+def run_case(name, context, queue):
+    try:
+        items, func, check = CASES[name](context)
+        latencies = []
+        results = []
+        start = time.perf_counter()
+        for item in items:
+            item_start = time.perf_counter()
+            results.append(func(item))
+            latencies.append(time.perf_counter() - item_start)
+        elapsed = time.perf_counter() - start
+        fetch.close_session()
+        latencies = np.array(latencies) * 1000
+        queue.put({
+            'items': len(items),
+            'items_per_second': len(items) / elapsed if elapsed else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p90_ms': float(np.percentile(latencies, 90)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KB on Linux
+            'note': check(results),
+        })
+    except ImportError as e:
+        queue.put({'skipped': f"missing dependency: {e.name}"})
+    except Exception as e:
+        queue.put({'skipped': f"{type(e).__name__}: {e}"})
+
+def print_results(results, baseline=None):
+    print(f"{'case':<32} {'items':>5} {'items/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak RSS MB':>12}")
+    for name, result in results.items():
+        if 'skipped' in result:
+            print(f"{name:<32} skipped ({result['skipped']})")
+            continue
+        line = (f"{name:<32} {result['items']:>5} {result['items_per_second']:>9.1f} {result['p50_ms']:>9.1f} "
+                f"{result['p90_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['peak_rss_mb']:>12.1f}")
+        previous = (baseline or {}).get(name)
+        if previous and 'skipped' not in previous and previous['items_per_second']:
+            change = (result['items_per_second'] / previous['items_per_second'] - 1) * 100
+            line += f"  throughput {change:+.0f}% vs baseline"
+        print(line)
+        print(f"{'':<32} {result['note']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', help="folder of saved artist_*.html, sound_*.html and video_*.html pages")
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'bench_pipeline_fixtures'),
+                        help="folder for the generated media fixtures (reused between runs)")
+    parser.add_argument('--page-count', type=int, default=50, help="pages fetched by the page cases")
+    parser.add_argument('--latency', type=float, default=0.0, help="added latency per HTTP/API round trip, in ms")
+    parser.add_argument('--frame-method', default='seek', help="frame_sampler method for extract_frames")
+    parser.add_argument('--cases', help="comma-separated cases to run (default: all)")
+    parser.add_argument('--json', help="save the results to this file")
+    parser.add_argument('--compare', help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    names = args.cases.split(',') if args.cases else list(CASES)
+    fixtures = media_fixtures.make_fixtures(args.fixtures)
+    if not fixtures['ffmpeg']:
+        print("ffmpeg is not on the PATH: sounds are WAV files, videos are silent and audio is read from the WAV fixtures")
+
+    server = PageServer(pages_dir=args.pages, media_dir=args.fixtures, latency=args.latency / 1000).start()
+    context = {'base_url': server.base_url, 'pages': args.page_count, 'fixtures': fixtures,
+               'latency': args.latency / 1000, 'frame_method': args.frame_method}
+
+    # fork keeps the server running in this process while each case gets a fresh peak RSS
+    mp_context = multiprocessing.get_context('fork')
+    results = {}
+    try:
+        for name in names:
+            queue = mp_context.Queue()
+            process = mp_context.Process(target=run_case, args=(name, context, queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+    finally:
+        server.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Generated audio and video fixtures for offline benchmarks of stages 3 and 6-9
+#
+# Reference sounds are made of random tone bursts. Every sound gets videos whose
+# audio is a slice of it at a known offset (matches) and one video with
+# unrelated audio (non-match), so stage 8 results can be checked, not only timed.
+# Videos are written with OpenCV; with ffmpeg on the PATH the sounds are encoded
+# to mp3 and the audio is muxed into the videos, otherwise sounds are kept as
+# WAV files and videos are silent.
+
+import os
+import json
+import wave
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+SAMPLE_RATE = 22050
+
+
+def have_ffmpeg():
+    return shutil.which('ffmpeg') is not None
+
+# Function to make a signal of random tone bursts
+def synthetic_audio(seed, seconds, sr=SAMPLE_RATE):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    samples = np.zeros_like(t)
+    for _ in range(int(seconds * 8)):
+        frequency = rng.uniform(200, 4000)
+        start = rng.uniform(0, seconds)
+        length = rng.uniform(0.05, 0.3)
+        burst = (t >= start) & (t < start + length)
+        samples[burst] += np.sin(2 * np.pi * frequency * t[burst])
+    # A quiet noise floor, as in real recordings (digital silence gives degenerate MFCCs)
+    samples += rng.normal(0, 0.05, len(samples))
+    return (samples / max(np.abs(samples).max(), 1e-9) * 0.8).astype(np.float32)
+
+def write_wav(path, samples, sr=SAMPLE_RATE):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sr)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        data = np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+        return data.astype(np.float32) / 32768, wav.getframerate()
+
+def run_ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-y', *args], check=True)
+
+# Function to write a silent mp4 with a moving block and the frame number drawn on every frame
+def write_video(path, seconds, fps=30, size=(320, 568)):
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    try:
+        for index in range(int(seconds * fps)):
+            frame = np.full((height, width, 3), (index * 3) % 255, dtype=np.uint8)
+            x = (index * 5) % (width - 60)
+            cv2.rectangle(frame, (x, height // 3), (x + 60, height // 3 + 60), (0, 0, 255), -1)
+            cv2.putText(frame, str(index), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+# Function to generate (or reuse) the fixtures in folder; returns the fixture description
+# {'sounds': [{'id', 'path'}], 'videos': [{'path', 'audio_path', 'sound_id', 'offset'}], 'ffmpeg': bool}
+# offset is where the video's audio starts in its sound (seconds), None for non-matches
+def make_fixtures(folder, sounds=3, sound_seconds=30, clip_seconds=10, matches_per_sound=2):
+    description_path = os.path.join(folder, 'fixtures.json')
+    settings = [sounds, sound_seconds, clip_seconds, matches_per_sound, have_ffmpeg()]
+    if os.path.exists(description_path):
+        with open(description_path) as f:
+            description = json.load(f)
+        if description.get('settings') == settings:
+            return description
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    ffmpeg = have_ffmpeg()
+    description = {'settings': settings, 'ffmpeg': ffmpeg, 'sounds': [], 'videos': []}
+
+    for sound_id in range(1, sounds + 1):
+        samples = synthetic_audio(sound_id, sound_seconds)
+        wav_path = os.path.join(folder, f'{sound_id} - Sound.wav')
+        write_wav(wav_path, samples)
+        sound_path = wav_path
+        if ffmpeg:
+            sound_path = os.path.join(folder, f'{sound_id} - Sound.mp3')
+            run_ffmpeg('-i', wav_path, '-codec:a', 'libmp3lame', '-b:a', '128k', sound_path)
+        description['sounds'].append({'id': sound_id, 'path': sound_path})
+
+        # Clips taken from the sound at known offsets, plus one clip of unrelated audio
+        clips = []
+        for _ in range(matches_per_sound):
+            offset = round(float(rng.uniform(0, sound_seconds - clip_seconds)), 2)
+            start = int(offset * SAMPLE_RATE)
+            clip = samples[start:start + int(clip_seconds * SAMPLE_RATE)]
+            clips.append((offset, clip + rng.normal(0, 0.02, len(clip)).astype(np.float32)))
+        clips.append((None, synthetic_audio(1000 + sound_id, clip_seconds)))
+
+        for clip_index, (offset, clip) in enumerate(clips):
+            video_id = sound_id * 100 + clip_index
+            name = f'{sound_id}-{video_id}'
+            audio_path = os.path.join(folder, f'{name}.wav')
+            write_wav(audio_path, clip)
+            video_path = os.path.join(folder, f'{name}.mp4')
+            if ffmpeg:
+                silent_path = os.path.join(folder, f'{name}.silent.mp4')
+                write_video(silent_path, clip_seconds)
+                run_ffmpeg('-i', silent_path, '-i', audio_path, '-c:v', 'copy', '-c:a', 'aac', '-shortest', video_path)
+                os.remove(silent_path)
+            else:
+                write_video(video_path, clip_seconds)
+            description['videos'].append({'path': video_path, 'audio_path': audio_path, 'sound_id': sound_id,
+                                          'video_id': video_id, 'offset': offset})
+
+    with open(description_path, 'w') as f:
+        json.dump(description, f, indent=1)
+    return description
@@ -0,0 +1,246 @@
+# Local stand-ins for the services the stages talk to, for offline benchmarks
+#
+# PageServer serves Tokchart list, artist and sound pages, TikTok video pages and
+# media files from a local HTTP server (saved pages if a folder is given,
+# otherwise the synthetic pages of bench_extract.py), with optional added latency.
+# FakeDriveService and FakeWorksheet stand in for the Drive v3 and gspread calls
+# made through drive_index.py and sheet_writer.py; every round trip sleeps for
+# the configured latency and is counted.
+
+import os
+import re
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from bench_extract import load_pages, synthetic_artist_page, synthetic_sound_page, synthetic_video_page
+
+
+# Function to build a synthetic Tokchart "most popular artists" list page (stage 1)
+def synthetic_list_page(base_url, page, artists_per_page=20):
+    body = ['<html><body><nav>']
+    body += [f'<a href="{base_url}/nav/{i}">Link {i}</a>' for i in range(50)]
+    body.append('</nav><table>')
+    for i in range(artists_per_page):
+        number = (page - 1) * artists_per_page + i + 1
+        body.append(f'<tr><td><a href="https://tokchart.com/dashboard/artists/{number}">Artist {number}</a></td></tr>')
+    body.append('</table></body></html>')
+    return ''.join(body)
+
+
+class PageServer:
+    # Routes (all GET):
+    #   /dashboard/lists/artists/most-popular?page=N   Tokchart list page
+    #   /dashboard/artists/<n>                          Tokchart artist page (sound table)
+    #   /dashboard/sounds/<n>                           Tokchart sound page (TikTok button)
+    #   /@bench/video/<id>                              TikTok video page (rehydration payload)
+    #   /media/<file name>                              file from media_dir (Range requests supported)
+    def __init__(self, pages_dir=None, media_dir=None, latency=0.0):
+        self.media_dir = media_dir
+        self.latency = latency
+        self.requests = 0
+        self.pages = {
+            'artist': [page.encode('utf-8') for page in load_pages(pages_dir, 'artist', synthetic_artist_page)],
+            'sound': [page.encode('utf-8') for page in load_pages(pages_dir, 'sound', synthetic_sound_page)],
+            'video': [page.encode('utf-8') for page in load_pages(pages_dir, 'video', synthetic_video_page)],
+        }
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = None
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stand_in.requests += 1
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                url = urlparse(self.path)
+                match = re.fullmatch(r'/dashboard/(artists|sounds)/(\d+)', url.path)
+                if url.path == '/dashboard/lists/artists/most-popular':
+                    page = int(parse_qs(url.query).get('page', ['1'])[0])
+                    self.send_body(synthetic_list_page(stand_in.base_url, page).encode('utf-8'), 'text/html')
+                elif match:
+                    pages = stand_in.pages['artist' if match.group(1) == 'artists' else 'sound']
+                    self.send_body(pages[int(match.group(2)) % len(pages)], 'text/html')
+                elif re.fullmatch(r'/@[^/]+/video/\d+', url.path):
+                    pages = stand_in.pages['video']
+                    self.send_body(pages[int(url.path.rsplit('/', 1)[1]) % len(pages)], 'text/html')
+                elif url.path.startswith('/media/') and stand_in.media_dir:
+                    self.send_file(os.path.join(stand_in.media_dir, os.path.basename(url.path)))
+                else:
+                    self.send_body(b'Not found', 'text/plain', status=404)
+
+            def send_body(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self, path):
+                if not os.path.isfile(path):
+                    self.send_body(b'Not found', 'text/plain', status=404)
+                    return
+                size = os.path.getsize(path)
+                start = 0
+                range_header = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+                if range_header and int(range_header.group(1)) < size:
+                    start = int(range_header.group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'video/mp4' if path.endswith('.mp4') else 'audio/mpeg')
+                self.send_header('Content-Length', str(size - start))
+                self.end_headers()
+                with open(path, 'rb') as file:
+                    file.seek(start)
+                    while True:
+                        chunk = file.read(64 * 1024)
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeRequest:
+    def __init__(self, service, func):
+        self.service = service
+        self.func = func
+
+    def execute(self):
+        self.service.round_trip()
+        return self.func()
+
+
+class FakeBatch:
+    # Batched calls cost one round trip for the whole batch
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback=None):
+        self.requests.append((request, callback))
+
+    def execute(self):
+        self.service.round_trip()
+        for request_id, (request, callback) in enumerate(self.requests):
+            response = request.func()
+            if callback:
+                callback(str(request_id), response, None)
+
+
+class FakeFiles:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, q, pageSize=100, pageToken=None, **kwargs):
+        parent_id = re.match(r"'([^']+)' in parents", q).group(1)
+
+        def run():
+            children = [file for file in self.service.file_records.values() if parent_id in file['parents']]
+            start = int(pageToken or 0)
+            result = {'files': [dict(file) for file in children[start:start + pageSize]]}
+            if start + pageSize < len(children):
+                result['nextPageToken'] = str(start + pageSize)
+            return result
+        return FakeRequest(self.service, run)
+
+    def get(self, fileId, **kwargs):
+        return FakeRequest(self.service, lambda: dict(self.service.file_records[fileId]))
+
+    def create(self, body, **kwargs):
+        return FakeRequest(self.service, lambda: {'id': self.service.add_file(body['name'], body['mimeType'], body['parents'][0])})
+
+    def update(self, fileId, addParents=None, removeParents=None, **kwargs):
+        def run():
+            file = self.service.file_records[fileId]
+            parents = [parent for parent in file['parents'] if parent not in (removeParents or '').split(',')]
+            file['parents'] = parents + ([addParents] if addParents else [])
+            return {'id': fileId, 'parents': file['parents']}
+        return FakeRequest(self.service, run)
+
+
+class FakeDriveService:
+    # In-memory Drive with the files().list/get/create/update and batch calls drive_index.py uses
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.file_records = {}
+        self.next_id = 0
+        self._files = FakeFiles(self)
+
+    def round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_file(self, name, mime_type, parent_id):
+        self.next_id += 1
+        file_id = f'file{self.next_id}'
+        self.file_records[file_id] = {'id': file_id, 'name': name, 'mimeType': mime_type, 'parents': [parent_id]}
+        return file_id
+
+    def files(self):
+        return self._files
+
+    def new_batch_http_request(self):
+        return FakeBatch(self)
+
+
+class FakeWorksheet:
+    # In-memory worksheet with the gspread calls sheet_writer.py uses
+    def __init__(self, rows, latency=0.0):
+        self.rows = [list(row) for row in rows]
+        self.col_count = max(len(row) for row in self.rows) if self.rows else 0
+        self.latency = latency
+        self.calls = 0
+
+    def round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self.round_trip()
+        return [list(row) for row in self.rows]
+
+    def add_cols(self, count):
+        self.round_trip()
+        self.col_count += count
+
+    def batch_update(self, data, value_input_option=None):
+        self.round_trip()
+        for update in data:
+            column_letters, row = re.fullmatch(r'([A-Z]+)(\d+)', update['range']).groups()
+            col = 0
+            for letter in column_letters:
+                col = col * 26 + ord(letter) - ord('A') + 1
+            row = int(row)
+            while len(self.rows) < row:
+                self.rows.append([])
+            while len(self.rows[row - 1]) < col:
+                self.rows[row - 1].append('')
+            self.rows[row - 1][col - 1] = update['values'][0][0]
+
+    def batch_format(self, formats):
+        self.round_trip()
@@ -0,0 +1,215 @@
+# Pool of headless Chrome drivers for stage 5 (TikTok sound pages -> video URLs)
+#
+# Each worker thread owns one driver and takes sound URLs from a shared queue.
+# Instead of a fixed sleep plus a fixed number of scrolls, a page is scrolled
+# until the number of /video/ anchors stops growing (or a hard cap is reached).
+# Drivers are quit and replaced after a number of pages to keep memory bounded.
+#
+# Video URLs are harvested with a single in-page script call rather than one
+# WebDriver round-trip per anchor. Optionally, the page's own item-list API
+# responses are read from Chrome's performance log, which gives video IDs
+# straight from TikTok's data feed.
+
+import json
+import queue
+import threading
+import time
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.chrome.options import Options
+from webdriver_manager.chrome import ChromeDriverManager
+
+# Pool settings (can be changed by the calling script)
+pool_size = 4            # Number of Chrome drivers running at the same time
+recycle_after = 25       # Pages a driver handles before it is replaced
+load_timeout = 10        # Seconds to wait for the first video anchors to appear
+max_scrolls = 8          # Hard cap on scrolls per page (the old fixed count)
+scroll_timeout = 2       # Seconds to wait for new anchors after each scroll
+patience = 2             # Scrolls without new anchors before we stop
+poll_interval = 0.25     # Seconds between anchor count checks
+harvest_mode = 'script'  # 'script' (one in-page call) or 'elements' (one round-trip per anchor)
+capture_network = False  # Also read video IDs from the page's item-list API responses
+item_list_url_part = '/api/music/item_list'
+
+COUNT_VIDEO_ANCHORS_JS = "return document.querySelectorAll('a[href*=\"/video/\"]').length;"
+SCROLL_JS = "window.scrollTo(0, document.body.scrollHeight);"
+HARVEST_VIDEO_URLS_JS = """
+const urls = new Set();
+for (const a of document.querySelectorAll('a[href*="/video/"]')) {
+    urls.add(a.href);
+}
+return Array.from(urls);
+"""
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+# Function to install chromedriver once and share its path between workers
+def get_driver_path():
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            _driver_path = ChromeDriverManager().install()
+        return _driver_path
+
+# Function to start a headless Chrome driver
+def make_driver():
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--window-size=1920,1080")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    if capture_network:
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    service = Service(get_driver_path())
+    return webdriver.Chrome(service=service, options=chrome_options)
+
+# Function to count the /video/ anchors currently on the page
+def count_video_anchors(driver):
+    return driver.execute_script(COUNT_VIDEO_ANCHORS_JS) or 0
+
+# Function to wait until the anchor count grows past previous_count (or time runs out)
+def wait_for_more_anchors(driver, previous_count, timeout):
+    deadline = time.monotonic() + timeout
+    count = count_video_anchors(driver)
+    while count <= previous_count and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        count = count_video_anchors(driver)
+    return count
+
+# Function to scroll until no new anchors load for `patience` scrolls or max_scrolls is hit
+def scroll_until_stable(driver):
+    count = wait_for_more_anchors(driver, 0, load_timeout)
+    scrolls_without_growth = 0
+    for _ in range(max_scrolls):
+        driver.execute_script(SCROLL_JS)
+        new_count = wait_for_more_anchors(driver, count, scroll_timeout)
+        if new_count > count:
+            scrolls_without_growth = 0
+        else:
+            scrolls_without_growth += 1
+            if scrolls_without_growth >= patience:
+                break
+        count = new_count
+    return count
+
+# Function to collect the unique /video/ URLs with one WebDriver call per anchor (original method)
+def collect_video_urls_by_element(driver):
+    all_urls = driver.find_elements(By.TAG_NAME, 'a')
+    return {url.get_attribute('href') for url in all_urls if '/video/' in (url.get_attribute('href') or '')}
+
+# Function to collect the unique /video/ URLs in a single in-page script call
+def collect_video_urls_by_script(driver):
+    return set(driver.execute_script(HARVEST_VIDEO_URLS_JS) or [])
+
+# Function to collect the unique /video/ URLs using the configured harvest mode
+def collect_video_urls(driver):
+    if harvest_mode == 'elements':
+        return collect_video_urls_by_element(driver)
+    return collect_video_urls_by_script(driver)
+
+# Function to build video URLs from the item-list API responses in the performance log
+def collect_video_urls_from_network(driver):
+    video_urls = set()
+    for entry in driver.get_log('performance'):
+        try:
+            message = json.loads(entry['message'])['message']
+            if message.get('method') != 'Network.responseReceived':
+                continue
+            params = message['params']
+            if item_list_url_part not in params['response']['url']:
+                continue
+            body = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': params['requestId']})
+            data = json.loads(body['body'])
+        except Exception:
+            # Bodies can be evicted from Chrome's buffer or not be JSON, skip those
+            continue
+        for item in data.get('itemList') or []:
+            video_id = item.get('id')
+            author = (item.get('author') or {}).get('uniqueId')
+            if video_id and author:
+                video_urls.add(f"https://www.tiktok.com/@{author}/video/{video_id}")
+    return video_urls
+
+# Function to load one TikTok sound page and return its video URLs
+def scrape_sound_page(driver, url):
+    if capture_network:
+        driver.get_log('performance')  # Drop entries left over from the previous page
+    driver.get(url)
+    scroll_until_stable(driver)
+    video_urls = collect_video_urls(driver)
+    if capture_network:
+        video_urls |= collect_video_urls_from_network(driver)
+    return video_urls
+
+# Function to quit a driver, ignoring errors from a browser that already crashed
+def _quit(driver):
+    if driver is None:
+        return
+    try:
+        driver.quit()
+    except Exception as e:
+        print(f"Error closing browser: {e}")
+
+# Function run by each worker thread: one driver, recycled every recycle_after pages
+# A driver that fails to start is recorded as the task's result, so the thread keeps going;
+# every finished task is also put on done for the calling thread
+def _worker(tasks, results, done, scrape):
+    driver = None
+    pages = 0
+    try:
+        while True:
+            try:
+                index, url = tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if driver is None or pages >= recycle_after:
+                    _quit(driver)
+                    driver = None
+                    driver = make_driver()
+                    pages = 0
+                results[index] = scrape(driver, url)
+            except Exception as e:
+                results[index] = e
+                # A crashed page can leave the driver unusable, start a fresh one
+                _quit(driver)
+                driver = None
+            done.put(index)
+            pages += 1
+    finally:
+        _quit(driver)
+
+# Function to scrape many sound URLs with a pool of drivers
+# Returns one entry per URL in input order: a set of video URLs, or the exception raised.
+# on_result(index, result) is called on the calling thread as each URL finishes (in the order
+# they finish), so results can be saved while the other pages are still loading.
+def scrape_all(urls, workers=None, scrape=scrape_sound_page, on_result=None):
+    urls = list(urls)
+    tasks = queue.Queue()
+    for index, url in enumerate(urls):
+        tasks.put((index, url))
+    results = [None] * len(urls)
+    done = queue.Queue()
+
+    threads = [threading.Thread(target=_worker, args=(tasks, results, done, scrape), daemon=True)
+               for _ in range(min(workers or pool_size, len(urls)))]
+    for thread in threads:
+        thread.start()
+    finished = 0
+    while finished < len(urls):
+        try:
+            index = done.get(timeout=1)
+        except queue.Empty:
+            if not any(thread.is_alive() for thread in threads) and done.empty():
+                break
+            continue
+        finished += 1
+        if on_result is not None:
+            on_result(index, results[index])
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,107 @@
+# Canonical forms of Tokchart and TikTok URLs, used to de-duplicate work across stages
+#
+# The same artist, sound or video is often linked with different spellings: with
+# or without "www.", over http, with a trailing slash, or with share/tracking
+# query parameters (is_from_webapp, sender_device, utm_*, ...). canonical_url()
+# maps all of these to one URL, and dedupe_key() reduces TikTok video and sound
+# URLs to their numeric IDs, so two links to the same item compare equal even
+# if the @user or the sound's title slug in the path differs.
+
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'igshid', 'mc_cid', 'mc_eid', 'ref', 'referer_url', 'referer_video_id',
+    'is_from_webapp', 'is_copy_url', 'sender_device', 'sender_web_id', 'share_app_id', 'share_item_id',
+    'share_link_id', 'social_sharing', 'source', 'tt_from', 'u_code', 'user_id', 'preview_pb', 'lang',
+    '_d', '_r', '_t', 'web_id', 'refer',
+}
+
+# Hosts whose item URLs never need a query string, and the host name each site is normalised to
+QUERYLESS_HOSTS = {'tokchart.com', 'www.tiktok.com'}
+HOST_ALIASES = {
+    'www.tokchart.com': 'tokchart.com',
+    'tiktok.com': 'www.tiktok.com',
+    'm.tiktok.com': 'www.tiktok.com',
+}
+
+VIDEO_ID_RE = re.compile(r'/(?:video|v)/(\d+)')
+MUSIC_ID_RE = re.compile(r'/music/(?:[^/?#]*-)?(\d+)')
+VIDEO_PATH_RE = re.compile(r'^/(@[^/]+)/video/(\d+)')
+
+
+# Function to get the canonical form of a URL (None and empty strings are returned as they are)
+# Item URLs of Tokchart and TikTok lose their whole query string; other URLs keep their
+# non-tracking parameters in their order (signed CDN links depend on them), e.g. the ?page=
+# of the Tokchart list pages
+def canonical_url(url):
+    if not url or not isinstance(url, str):
+        return url
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    host = HOST_ALIASES.get(host, host)
+    scheme = 'https' if host in QUERYLESS_HOSTS or parts.scheme.lower() == 'https' else parts.scheme.lower()
+    netloc = host if parts.port in (None, 80, 443) else f'{host}:{parts.port}'
+    path = re.sub(r'/{2,}', '/', parts.path)
+    if len(path) > 1:
+        path = path.rstrip('/')
+
+    query = ''
+    is_item = host in QUERYLESS_HOSTS and not path.startswith('/dashboard/lists/')
+    if not is_item:
+        params = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                  if key.lower() not in TRACKING_PARAMS and not key.lower().startswith('utm_')]
+        query = urlencode(params)
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+# Function to get a TikTok video's numeric ID from its URL, or None
+def video_id(url):
+    match = VIDEO_ID_RE.search(urlsplit(url).path) if url else None
+    return match.group(1) if match else None
+
+# Function to get a TikTok sound's numeric ID from its /music/ URL, or None
+def music_id(url):
+    match = MUSIC_ID_RE.search(urlsplit(url).path) if url else None
+    return match.group(1) if match else None
+
+# Function to get the canonical URL of a TikTok video (https://www.tiktok.com/@user/video/<id>)
+def canonical_video_url(url):
+    url = canonical_url(url)
+    match = VIDEO_PATH_RE.match(urlsplit(url).path) if url else None
+    if match:
+        return f'https://www.tiktok.com/{match.group(1)}/video/{match.group(2)}'
+    return url
+
+# Function to get the key two URLs of the same item share: 'video:<id>', 'music:<id>' or the canonical URL
+def dedupe_key(url):
+    if not url:
+        return url
+    if 'tiktok.com' in (urlsplit(url).hostname or ''):
+        identifier = video_id(url)
+        if identifier:
+            return f'video:{identifier}'
+        identifier = music_id(url)
+        if identifier:
+            return f'music:{identifier}'
+    return canonical_url(url)
+
+# Function to drop repeated URLs, keeping the first (canonical) URL of each item in order
+def unique(urls):
+    seen = set()
+    result = []
+    for url in urls:
+        key = dedupe_key(url)
+        if key and key not in seen:
+            seen.add(key)
+            result.append(canonical_video_url(url) if key.startswith('video:') else canonical_url(url))
+    return result
+
+# Function to group positions by item: {dedupe key: [indexes of the URLs of that item]}, in first-seen order
+def group_duplicates(urls):
+    groups = {}
+    for index, url in enumerate(urls):
+        key = dedupe_key(url)
+        if key:
+            groups.setdefault(key, []).append(index)
+    return groups
@@ -0,0 +1,105 @@
+# Incremental (delta) crawling of the Tokchart rankings for stages 1 and 2
+#
+# A Snapshot keeps what the previous run saw (artists or sounds, keyed by
+# canonical URL) with the fields used to detect changes, such as an artist's
+# rank or a sound's Total Views. A new run compares every item against it as
+# new, changed or unchanged and only hands the new and changed ones to the next
+# stage. crawl_pages() fetches the numbered list pages in small batches and
+# stops at the first page with nothing new on it (or at an empty page), so a
+# weekly refresh costs work in proportion to the churn, not the whole catalogue.
+# A run saves its snapshot next to the current one as a pending file, and the
+# stage that reads the delta promotes it with promote() once it has finished
+# with it. Until then a rerun still compares against the last consumed snapshot
+# and writes the same new and changed items again, so a later stage that failed
+# does not lose them.
+
+import os
+import json
+import time
+
+
+class Snapshot:
+    # JSON file: {'taken': time of the run, 'items': {key: {field: value}}}
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.taken = data.get('taken')
+        self.items = data.get('items', {})
+        self.seen = {}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        return self.items.get(key)
+
+    # Function to compare an item with the previous run: 'new', 'changed' or 'unchanged'
+    # Only the fields named in compare are checked (all of them if compare is None)
+    def change(self, key, fields, compare=None):
+        previous = self.items.get(key)
+        if previous is None:
+            return 'new'
+        for name in compare or fields:
+            if str(previous.get(name)) != str(fields.get(name)):
+                return 'changed'
+        return 'unchanged'
+
+    # Function to record an item seen in this run (saved by save())
+    def update(self, key, fields):
+        self.seen[key] = fields
+
+    # Function to save this run's items as the pending snapshot (made current by promote());
+    # keep_unseen keeps the previous items this run did not reach (a delta run stops early),
+    # otherwise the snapshot is exactly this run's items
+    def save(self, keep_unseen=True):
+        items = {**self.items, **self.seen} if keep_unseen else dict(self.seen)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'taken': time.strftime('%Y-%m-%d %H:%M:%S'), 'items': items}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path + '.pending')
+        self.items, self.seen = items, {}
+
+
+# Function to make a pending snapshot the current one, once its delta has been consumed
+# Returns True if there was a pending snapshot
+def promote(path):
+    if not os.path.exists(path + '.pending'):
+        return False
+    os.replace(path + '.pending', path)
+    return True
+
+
+# Function to crawl numbered list pages until a page has nothing new, an empty page is reached or last_page
+# fetch_batch(pages) returns the pages' responses (or exceptions) in order, page_items(page, response)
+# returns a page's items and is_new(item) tells whether an item was not seen before.
+# Returns [(page, items)] in page order; a page that failed to load is not a stop, it is returned
+# with items None so the caller can tell a partial crawl from a complete one
+def crawl_pages(fetch_batch, page_items, is_new, first_page=1, last_page=100, batch_size=5, stop_when_unchanged=True):
+    crawled = []
+    page = first_page
+    while page <= last_page:
+        pages = list(range(page, min(page + batch_size, last_page + 1)))
+        for number, response in zip(pages, fetch_batch(pages)):
+            if isinstance(response, Exception):
+                print(f"Error fetching page {number}: {response}")
+                crawled.append((number, None))
+                continue
+            items = page_items(number, response)
+            crawled.append((number, items))
+            if not items:
+                print(f"Page {number} is empty, stopping")
+                return crawled
+            if stop_when_unchanged and not any(is_new(item) for item in items):
+                print(f"Page {number} has nothing new, stopping")
+                return crawled
+        page += batch_size
+    return crawled
@@ -0,0 +1,196 @@
+# Parallel, resumable file downloader (used by stage 3 for the sound MP3s)
+#
+# Each file is streamed into "<save_path>.part" and only renamed to its final
+# name once its size matches Content-Length, so a finished file on disk is always
+# complete and is skipped on the next run. An existing .part file is resumed with
+# an HTTP Range request whose If-Range carries the ETag (or Last-Modified) saved
+# when the download started, so a file that changed in between is downloaded
+# again in full instead of being spliced. Downloads run on a bounded thread pool over the shared
+# keep-alive session from fetch.py. A URL listed for several files (the same
+# sound under several Tokchart entries) is downloaded once and copied locally.
+
+import os
+import glob
+import json
+import time
+import shutil
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+from canonical import canonical_url
+from fetch import fetch
+
+PART_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.part.validator'  # Next to the .part file: the validators of what it holds
+
+
+# Function to find an already completed download for save_path (any extension)
+def find_existing(save_path):
+    for path in glob.glob(glob.escape(save_path) + '.*'):
+        if not path.endswith((PART_SUFFIX, VALIDATOR_SUFFIX)):
+            return path
+    return None
+
+# Function to work out the file extension from a MIME type
+def guess_extension(content_type, default_extension='.mp3'):
+    extension = mimetypes.guess_extension((content_type or '').split(';')[0].strip())
+    return extension or default_extension
+
+# Function to save the validators (ETag, Last-Modified) and type of the response a .part file comes from
+def save_validator(save_path, response):
+    validator = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                 'content_type': response.headers.get('content-type')}
+    with open(save_path + VALIDATOR_SUFFIX, 'w') as file:
+        json.dump(validator, file)
+
+# Function to read the saved validators of a .part file ({} if there are none)
+def load_validator(save_path):
+    try:
+        with open(save_path + VALIDATOR_SUFFIX) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+# Function to delete the saved validators once the download is complete
+def discard_validator(save_path):
+    if os.path.exists(save_path + VALIDATOR_SUFFIX):
+        os.remove(save_path + VALIDATOR_SUFFIX)
+
+# Function to get the If-Range value for resuming (a strong ETag, else Last-Modified), or None
+def if_range(validator):
+    etag = validator.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validator.get('last_modified')
+
+# Function to read the full size from a 416 response's Content-Range ("bytes */<size>"), or None
+def unsatisfied_range_size(response):
+    total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+    return int(total) if total.isdigit() else None
+
+# Function to get the full size of the file from a 200 or 206 response
+def expected_size(response, offset):
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        total = content_range.rsplit('/', 1)[-1]
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length) + (offset if response.status_code == 206 else 0)
+    return None
+
+# Function to download one file, resuming a partial download when there is one
+# Returns a dict with the status ('skipped', 'downloaded' or 'failed'), path, bytes and seconds
+def download_file(url, save_path, default_extension='.mp3', chunk_size=64 * 1024, timeout=30):
+    start = time.perf_counter()
+    existing = find_existing(save_path)
+    if existing:
+        return {'status': 'skipped', 'path': existing, 'bytes': 0, 'seconds': 0.0}
+
+    part_path = save_path + PART_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = load_validator(save_path) if offset else {}
+    headers = None
+    if offset and if_range(validator):
+        # The server only sends the rest (206) if the file is still the one the .part came from
+        headers = {'Range': f'bytes={offset}-', 'If-Range': if_range(validator)}
+    else:
+        offset = 0  # Nothing to resume, or no validator to resume it safely
+    received = 0
+
+    try:
+        response = fetch(url, headers=headers, timeout=timeout, stream=True)
+        if response.status_code == 416:
+            response.close()
+            if unsatisfied_range_size(response) == offset:
+                # The .part file already holds the whole file, only the rename was missing
+                final_path = save_path + guess_extension(validator.get('content_type'), default_extension)
+                os.replace(part_path, final_path)
+                discard_validator(save_path)
+                instrumentation.count('downloads_resumed')
+                instrumentation.record_time('download', time.perf_counter() - start, url=url, bytes=0)
+                return {'status': 'downloaded', 'path': final_path, 'bytes': 0, 'seconds': time.perf_counter() - start}
+            # The partial file does not fit the resource any more, start over
+            offset = 0
+            response = fetch(url, timeout=timeout, stream=True)
+        response.raise_for_status()
+
+        with response:
+            if response.status_code != 206:
+                offset = 0  # The file changed (or Range was ignored), write the whole file again
+                save_validator(save_path, response)
+            total = expected_size(response, offset)
+
+            with open(part_path, 'ab' if offset else 'wb') as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    received += len(chunk)
+
+            size = offset + received
+            if total is not None and size != total:
+                raise IOError(f"size mismatch, got {size} of {total} bytes (partial file kept for resuming)")
+
+            final_path = save_path + guess_extension(response.headers.get('content-type'), default_extension)
+        os.replace(part_path, final_path)
+        discard_validator(save_path)
+    except Exception as e:
+        print(f"Error downloading {url}: {e}")
+        instrumentation.count('download_failures')
+        instrumentation.record_time('download', time.perf_counter() - start, url=url, status='failed')
+        return {'status': 'failed', 'path': part_path, 'bytes': received, 'seconds': time.perf_counter() - start, 'error': str(e)}
+
+    if offset:
+        instrumentation.count('downloads_resumed')
+    instrumentation.record_time('download', time.perf_counter() - start, url=url, bytes=received)
+    instrumentation.event('downloaded', f"Downloaded: {final_path}", path=final_path)
+    return {'status': 'downloaded', 'path': final_path, 'bytes': received, 'seconds': time.perf_counter() - start}
+
+# Function to give a duplicate job the file downloaded for the first job with the same URL
+def share_download(result, save_path):
+    existing = find_existing(save_path)
+    if existing:
+        return {'status': 'skipped', 'path': existing, 'bytes': 0, 'seconds': 0.0}
+    if result['status'] == 'failed':
+        return dict(result)
+    final_path = save_path + os.path.splitext(result['path'])[1]
+    shutil.copyfile(result['path'], final_path)
+    return {'status': 'shared', 'path': final_path, 'bytes': 0, 'seconds': 0.0}
+
+# Function to download many (url, save_path) pairs on a bounded thread pool
+# Jobs whose URLs only differ in tracking parameters share one download
+# Prints a throughput summary and returns the results in the order of jobs
+def download_all(jobs, workers=8, default_extension='.mp3'):
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    start = time.perf_counter()
+
+    # First job of every URL -> the later jobs with the same URL
+    duplicates = {}
+    first_job = {}
+    for index, (url, _) in enumerate(jobs):
+        first = first_job.setdefault(canonical_url(url), index)
+        if first != index:
+            duplicates.setdefault(first, []).append(index)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_file, url, save_path, default_extension): index
+                   for index, (url, save_path) in enumerate(jobs) if first_job[canonical_url(url)] == index}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    for first, indexes in duplicates.items():
+        for index in indexes:
+            results[index] = share_download(results[first], jobs[index][1])
+    if duplicates:
+        instrumentation.count('downloads_shared', sum(len(indexes) for indexes in duplicates.values()))
+
+    elapsed = time.perf_counter() - start
+    counts = {status: sum(1 for result in results if result['status'] == status) for status in ('downloaded', 'shared', 'skipped', 'failed')}
+    total_bytes = sum(result['bytes'] for result in results)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"Downloaded {counts['downloaded']}, copied {counts['shared']} duplicates, skipped {counts['skipped']} already complete, {counts['failed']} failed "
+          f"- {megabytes:.1f} MB in {elapsed:.1f} s ({megabytes / elapsed if elapsed else 0:.2f} MB/s, "
+          f"{counts['downloaded'] / elapsed if elapsed else 0:.2f} files/s)")
+    return results
@@ -0,0 +1,166 @@
+# Google Drive access layer for stages 7 and 8
+#
+# Every folder is listed once (all pages) into an in-memory name -> file index,
+# so looking up a file or sub-folder no longer costs a files().list query each
+# time. The listing already includes each file's parents, which lets moves be
+# sent as a single update call; moves and folder creations are queued and sent
+# as batched HTTP requests (up to 100 calls per batch). All calls go through the
+# Drive limiter of rate_limit.py; calls inside a batch that Drive rejects for
+# its rate limit are sent again in a later batch after a backoff.
+
+import time
+
+import instrumentation
+import rate_limit
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+BATCH_LIMIT = 100  # Maximum number of calls Drive accepts in one batch request
+
+
+class DriveIndex:
+    def __init__(self, drive_service, batch_size=BATCH_LIMIT):
+        self.drive_service = drive_service
+        self.batch_size = min(batch_size, BATCH_LIMIT)
+        self.folders = {}       # folder_id -> {name: file}
+        self.files_by_id = {}   # file_id -> file
+        self.pending_moves = []
+
+    # Function to list every (non-trashed) file in a folder once and index it by name
+    def list_folder(self, folder_id, refresh=False):
+        if folder_id in self.folders and not refresh:
+            return self.folders[folder_id]
+
+        index = {}
+        page_token = None
+        while True:
+            request = self.drive_service.files().list(
+                q=f"'{folder_id}' in parents and trashed=false",
+                spaces='drive',
+                fields='nextPageToken, files(id, name, mimeType, parents)',
+                pageSize=1000,
+                pageToken=page_token
+            )
+            with instrumentation.timer('drive_list'):
+                results = rate_limit.call(rate_limit.DRIVE_HOST, request.execute)
+            for file in results.get('files', []):
+                # Keep the first file with a given name, like the old per-name queries did
+                index.setdefault(file['name'], file)
+                self.files_by_id[file['id']] = file
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        self.folders[folder_id] = index
+        return index
+
+    # Function to get a file's (id, mimeType) by name, or (None, None)
+    def get_file_id(self, file_name, parent_folder_id='root'):
+        file = self.list_folder(parent_folder_id).get(file_name)
+        if not file:
+            return None, None
+        return file['id'], file['mimeType']
+
+    # Function to get a sub-folder's ID by name, or None
+    def get_folder_id(self, folder_name, parent_folder_id='root'):
+        file = self.list_folder(parent_folder_id).get(folder_name)
+        if not file or file['mimeType'] != FOLDER_MIME_TYPE:
+            return None
+        return file['id']
+
+    # Function to make sure folders exist, creating the missing ones in batches
+    # Takes a list of (folder_name, parent_folder_id) and returns their IDs in the same order
+    def ensure_folders(self, folders):
+        folder_ids = [self.get_folder_id(name, parent_id) for name, parent_id in folders]
+        missing = [i for i, folder_id in enumerate(folder_ids) if folder_id is None]
+
+        def created(i):
+            def callback(request_id, response, exception):
+                name, parent_id = folders[i]
+                if exception is not None:
+                    print(f"Error creating folder {name}: {exception}")
+                    return
+                file = {'id': response['id'], 'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id]}
+                # Only folders already listed are updated, a partial listing would hide their other files
+                if parent_id in self.folders:
+                    self.folders[parent_id][name] = file
+                self.folders[file['id']] = {}  # A new folder is empty
+                self.files_by_id[file['id']] = file
+                folder_ids[i] = file['id']
+                print(f"Created folder {name} with ID {file['id']}")
+            return callback
+
+        def create_request(i):
+            name, parent_id = folders[i]
+            body = {'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id]}
+            return lambda: self.drive_service.files().create(body=body, fields='id')
+
+        self._send_batches([(create_request(i), created(i)) for i in missing])
+        return folder_ids
+
+    # Function to queue moving a file to another folder (sent by flush_moves)
+    def queue_move(self, file_id, folder_id):
+        self.pending_moves.append((file_id, folder_id))
+
+    # Function to send all queued moves as batched update calls
+    def flush_moves(self):
+        moves, self.pending_moves = self.pending_moves, []
+
+        def moved(file_id, folder_id):
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    print(f"Error moving file {file_id}: {exception}")
+                    return
+                file = self.files_by_id.get(file_id)
+                if file:
+                    for parent_id in file.get('parents', []):
+                        self.folders.get(parent_id, {}).pop(file['name'], None)
+                    file['parents'] = [folder_id]
+                    if folder_id in self.folders:
+                        self.folders[folder_id][file['name']] = file
+                print(f"Moved file {file_id} to folder {folder_id}")
+            return callback
+
+        def update_request(file_id, folder_id):
+            file = self.files_by_id.get(file_id)
+            if file is None:
+                # Not listed through the index, fall back to asking Drive for its parents
+                request = self.drive_service.files().get(fileId=file_id, fields='id, name, parents')
+                file = rate_limit.call(rate_limit.DRIVE_HOST, request.execute)
+            previous_parents = ",".join(file.get('parents', []))
+            return lambda: self.drive_service.files().update(fileId=file_id,
+                                                             addParents=folder_id,
+                                                             removeParents=previous_parents,
+                                                             fields='id, parents')
+
+        self._send_batches([(update_request(file_id, folder_id), moved(file_id, folder_id)) for file_id, folder_id in moves])
+
+    # Function to send calls, given as (function making the request, callback), in batches
+    # Calls rejected for the rate limit are collected and sent again after a backoff
+    def _send_batches(self, calls):
+        limiter = rate_limit.limiter(rate_limit.DRIVE_HOST)
+        for attempt in range(rate_limit.max_attempts):
+            throttled = []
+
+            def retrying(call, callback):
+                def wrapper(request_id, response, exception):
+                    if exception is not None and rate_limit.outcome_of(exception) == 'throttled' and attempt + 1 < rate_limit.max_attempts:
+                        throttled.append((call, callback))
+                        return
+                    callback(request_id, response, exception)
+                return wrapper
+
+            for start in range(0, len(calls), self.batch_size):
+                chunk = calls[start:start + self.batch_size]
+                batch = self.drive_service.new_batch_http_request()
+                for make_request, callback in chunk:
+                    batch.add(make_request(), callback=retrying(make_request, callback))
+                # Drive counts every call in a batch against the quota
+                with instrumentation.timer('drive_write'):
+                    rate_limit.call(rate_limit.DRIVE_HOST, batch.execute, cost=len(chunk))
+
+            if not throttled:
+                return
+            instrumentation.count('throttled', amount=len(throttled), host=limiter.host)
+            limiter.report('throttled')
+            time.sleep(limiter.backoff(attempt))
+            calls = throttled
@@ -0,0 +1,113 @@
+# Targeted HTML extraction for the scraping stages (2, 4 and 6)
+#
+# Instead of building a BeautifulSoup tree for a whole page, each helper cuts out
+# the part of the page the stage actually needs (the sound table, one anchor,
+# one <script> tag) and only parses that. The rehydration payload of a TikTok
+# video page is decoded starting at "itemStruct", so the rest of the (large)
+# JSON blob is never turned into Python objects.
+
+import re
+import json
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+import instrumentation
+
+# Use lxml when it is installed, it is considerably faster than html.parser
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# Class names used on the Tokchart pages
+SOUND_ANCHOR_CLASS = 'block shrink-0 w-12 h-12 rounded-full mr-2 sm:mr-3 bg-indigo-500 overflow-hidden'
+SOUND_TITLE_CLASS = 'hover:underline font-medium text-gray-800'
+TIKTOK_ANCHOR_CLASS = 't-btn bg-cadet bg-cadet hover:bg-cadet-900 active:bg-cadet-900'
+
+REHYDRATION_SCRIPT_ID = '__UNIVERSAL_DATA_FOR_REHYDRATION__'
+
+_TBODY_RE = re.compile(r'<tbody\b.*?</tbody>', re.IGNORECASE | re.DOTALL)
+_ANCHOR_RE = re.compile(r'<a\b[^>]*>', re.IGNORECASE)
+_HREF_RE = re.compile(r'''\bhref\s*=\s*(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+_CLASS_RE = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+_REHYDRATION_RE = re.compile(r'<script\b[^>]*\bid\s*=\s*["\']' + REHYDRATION_SCRIPT_ID + r'["\'][^>]*>', re.IGNORECASE)
+_VIDEO_DETAIL_KEY = '"webapp.video-detail"'
+_ITEM_STRUCT_KEY = '"itemStruct":'
+
+_decoder = json.JSONDecoder()
+
+
+# Function to read an attribute from the raw text of an opening tag
+def _attribute(tag_text, pattern):
+    match = pattern.search(tag_text)
+    if not match:
+        return None
+    value = match.group(1) if match.group(1) is not None else match.group(2)
+    return value.replace('&amp;', '&')
+
+# Function to get the table rows of a Tokchart artist page (stage 2)
+# Only the <tbody> elements are parsed; returns a list of <tr> tags
+@instrumentation.timed('parse')
+def sound_table_rows(html):
+    tbodies = _TBODY_RE.findall(html)
+    if tbodies:
+        soup = BeautifulSoup(''.join(tbodies), PARSER)
+    else:
+        soup = BeautifulSoup(html, PARSER, parse_only=SoupStrainer('tbody'))
+    return soup.find_all('tr')
+
+# Function to get the href of the first anchor with exactly the given class (stage 4)
+@instrumentation.timed('parse')
+def anchor_href_by_class(html, class_name):
+    wanted = class_name.split()
+    for tag_text in _ANCHOR_RE.findall(html):
+        classes = _attribute(tag_text, _CLASS_RE)
+        if classes is not None and classes.split() == wanted:
+            return _attribute(tag_text, _HREF_RE)
+    return None
+
+# Function to get the TikTok sound URL from a Tokchart sound page (stage 4)
+def tiktok_sound_url(html):
+    return anchor_href_by_class(html, TIKTOK_ANCHOR_CLASS)
+
+# Function to cut the raw rehydration JSON text out of a TikTok page
+@instrumentation.timed('parse')
+def rehydration_text(html):
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    match = _REHYDRATION_RE.search(html)
+    if not match:
+        return None
+    end = html.find('</script>', match.end())
+    if end == -1:
+        return None
+    return html[match.end():end]
+
+# Function to decode only the itemStruct object of a rehydration payload
+# Falls back to decoding the full payload if the key cannot be found directly
+@instrumentation.timed('parse')
+def item_struct_from_payload(payload):
+    scope = payload.find(_VIDEO_DETAIL_KEY)
+    position = payload.find(_ITEM_STRUCT_KEY, scope) if scope != -1 else -1
+    if position != -1:
+        start = position + len(_ITEM_STRUCT_KEY)
+        while start < len(payload) and payload[start] in ' \t\r\n':
+            start += 1
+        try:
+            item_struct, _ = _decoder.raw_decode(payload, start)
+            if isinstance(item_struct, dict):
+                return item_struct
+        except ValueError:
+            pass
+
+    data = json.loads(payload)
+    return data['__DEFAULT_SCOPE__']['webapp.video-detail']['itemInfo']['itemStruct']
+
+# Function to get the video's itemStruct from a TikTok page (stage 6)
+# Returns None when the page has no rehydration script
+def video_item_struct(html):
+    payload = rehydration_text(html)
+    if payload is None:
+        return None
+    return item_struct_from_payload(payload)
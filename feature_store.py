@@ -0,0 +1,88 @@
+# Persistent feature store for the stage 8 reference sounds
+#
+# Each reference sound's MFCC matrix is computed once and saved as a .npy file
+# named after the SHA-1 of the audio file and the feature parameters, so a
+# changed file or changed parameters give a new entry automatically. Features
+# are only computed/loaded when a sound_id is first asked for, and are loaded
+# memory-mapped, so startup no longer holds every reference sound in memory.
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+class FeatureStore:
+    # compute(path) must return the feature matrix for an audio file (or None)
+    def __init__(self, store_dir, compute, params):
+        self.store_dir = store_dir
+        self.compute = compute
+        self.params_key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.paths = {}      # sound_id -> audio file path
+        self.loaded = {}     # sound_id -> feature matrix (memory-mapped) or None
+        self.index_path = os.path.join(store_dir, 'index.json')
+        os.makedirs(store_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    # Function to load the {path: [size, mtime, sha1]} index so files are not hashed every run
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, self.index_path)
+
+    # Function to get the SHA-1 of an audio file, reusing the index when size and mtime match
+    def file_hash(self, path):
+        stat = os.stat(path)
+        cached = self.index.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        self.index[path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+        self._save_index()
+        return digest.hexdigest()
+
+    # Function to register the audio file of a sound_id (nothing is computed yet)
+    def add(self, sound_id, path):
+        self.paths[sound_id] = path
+        self.loaded.pop(sound_id, None)
+
+    def __contains__(self, sound_id):
+        return sound_id in self.paths
+
+    # Function to get the features of a sound_id, computing and saving them on first use
+    # Raises KeyError for an unknown sound_id; returns None if no features could be computed
+    def get(self, sound_id):
+        if sound_id in self.loaded:
+            return self.loaded[sound_id]
+
+        path = self.paths[sound_id]
+        feature_path = os.path.join(self.store_dir, f"{self.file_hash(path)}_{self.params_key}.npy")
+        if os.path.exists(feature_path):
+            features = np.load(feature_path, mmap_mode='r')
+        else:
+            features = self.compute(path)
+            if features is not None:
+                features = np.ascontiguousarray(features, dtype=np.float32)
+                tmp_path = feature_path[:-len('.npy')] + '.tmp.npy'
+                np.save(tmp_path, features)
+                os.replace(tmp_path, feature_path)
+                features = np.load(feature_path, mmap_mode='r')
+
+        self.loaded[sound_id] = features
+        return features
+
+    # Function to drop loaded features (e.g. after finishing a sound folder)
+    def release(self, sound_id):
+        self.loaded.pop(sound_id, None)
@@ -0,0 +1,119 @@
+# Shared HTTP fetch layer used by the scraping stages (1, 2, 4 and 6)
+#
+# All requests go through one keep-alive requests.Session, so repeated calls to
+# tokchart.com / tiktok.com reuse pooled TCP+TLS connections instead of doing a
+# new handshake per URL. fetch_all() and map_ordered() run work on a thread pool
+# and always return results in the same order as the input. When http_cache has
+# been configured, GET requests are served from / stored in the on-disk cache.
+# Requests that reach the network go through rate_limit.py: per-host token
+# buckets and concurrency, and retries of 429/5xx responses and dropped
+# connections with backoff (honouring Retry-After).
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_cache
+import instrumentation
+import rate_limit
+
+# Default browser-like headers (same User-Agent stage 6 has always used)
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# Concurrency settings (can be changed by the calling script before fetching)
+max_workers = 16      # Total number of worker threads
+per_host_limit = 8    # Maximum number of requests in flight to a host not listed in rate_limit.HOST_LIMITS
+default_timeout = 10  # Seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+# Errors worth retrying even though the server sent no status
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# Function to get the shared keep-alive session
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+            # Keep enough pooled connections per host for every worker thread
+            adapter = HTTPAdapter(pool_connections=max(per_host_limit, 10), pool_maxsize=max(max_workers, per_host_limit))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+# Function to close the shared session (e.g. at the end of a script)
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+# Function to set the concurrency used by fetch(), fetch_all() and map_ordered()
+def configure(workers=None, per_host=None, timeout=None):
+    global max_workers, per_host_limit, default_timeout
+    if workers is not None:
+        max_workers = workers
+    if per_host is not None:
+        per_host_limit = per_host
+        rate_limit.configure(concurrency=per_host)
+        rate_limit.reset()
+    if timeout is not None:
+        default_timeout = timeout
+    # Rebuild the session so the connection pool matches the new sizes
+    close_session()
+
+# Function to send a GET request through the shared session, within the host's rate limits
+# A 429/5xx response is retried up to attempts times and the last response is returned
+def _get(url, headers=None, timeout=None, attempts=None, **kwargs):
+    session = get_session()
+    return rate_limit.call(url, lambda: session.get(url, headers=headers, timeout=timeout or default_timeout, **kwargs),
+                           attempts=attempts, retry_on=RETRY_ERRORS)
+
+# Function to fetch a single URL (through the on-disk cache when it is enabled)
+def fetch(url, headers=None, timeout=None, use_cache=True, attempts=None, **kwargs):
+    with instrumentation.timer('fetch'):
+        try:
+            if use_cache and http_cache.enabled() and not kwargs.get('stream'):
+                return http_cache.cached_get(url, lambda request_headers: _get(url, request_headers, timeout, attempts, **kwargs), headers)
+            return _get(url, headers, timeout, attempts, **kwargs)
+        except requests.RequestException:
+            instrumentation.count('fetch_errors')
+            raise
+
+# Function to apply func to every item on the thread pool, keeping the input order
+# Exceptions are returned in place of the result when return_exceptions is True
+def map_ordered(func, items, workers=None, return_exceptions=False):
+    items = list(items)
+    if not items:
+        return []
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with ThreadPoolExecutor(max_workers=min(workers or max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
+
+# Function to fetch many URLs concurrently, returning responses in input order
+# A failed request is returned as its exception so one bad URL does not stop the batch
+def fetch_all(urls, headers=None, timeout=None, workers=None, raise_for_status=True):
+    def fetch_one(url):
+        response = fetch(url, headers=headers, timeout=timeout)
+        if raise_for_status:
+            response.raise_for_status()
+        return response
+
+    return map_ordered(fetch_one, urls, workers=workers, return_exceptions=True)
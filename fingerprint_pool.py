@@ -0,0 +1,62 @@
+# Process pool for matching many videos against one reference sound (stage 8)
+#
+# The pool's workers are initialised once with the reference features of the
+# sound being processed, so each task only carries a video path. Results come
+# back to the calling (coordinator) process in the order of the video list;
+# the coordinator does all file moves and spreadsheet updates. The workers'
+# instrumentation timers and counters come back with the results.
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+
+_reference_features = None
+_match_func = None
+
+
+# Function to set the matching function and reference features of this process
+def _set_reference(match_func, reference_features):
+    global _match_func, _reference_features
+    _match_func = match_func
+    _reference_features = reference_features
+
+# Function run once in every worker process
+def _init_worker(match_func, reference_features):
+    _set_reference(match_func, reference_features)
+    instrumentation.init_worker()
+
+# Function run in a worker process for one video; errors are returned, not raised
+# The worker's timers and counters for the video are sent back with the result
+def _match_one(video_path):
+    try:
+        result = _match_func(_reference_features, video_path)
+    except Exception as e:
+        result = e
+    return result, instrumentation.drain()
+
+# Function to merge the workers' timers and counters back into this process
+def _collect(outcomes):
+    results = []
+    for result, drained in outcomes:
+        instrumentation.merge(drained)
+        results.append(result)
+    return results
+
+# Function to match every video against the reference features
+# match_func(reference_features, video_path) must be a module-level function.
+# Returns one entry per video in input order: match_func's result or the exception it raised.
+def match_videos(video_paths, reference_features, match_func, workers=None):
+    video_paths = list(video_paths)
+    workers = min(workers or os.cpu_count() or 1, len(video_paths))
+    if workers <= 1:
+        _set_reference(match_func, reference_features)
+        return _collect(_match_one(video_path) for video_path in video_paths)
+
+    # fork lets workers use functions defined in a notebook's __main__ (Colab)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(match_func, reference_features)) as executor:
+        return _collect(executor.map(_match_one, video_paths))
@@ -0,0 +1,96 @@
+# Sparse frame sampling for stage 9
+#
+# Only the frames that end up in a strip are decoded into images:
+#   - 'seek'   jumps straight to each target frame (CAP_PROP_POS_FRAMES)
+#   - 'grab'   steps through the video with grab() and only retrieve()s target frames
+#   - 'ffmpeg' lets ffmpeg's select and scale filters pick and shrink the frames
+# Frames are shrunk to the thumbnail size right after decoding (inside ffmpeg
+# for 'ffmpeg'), so full-resolution frames are never kept around.
+
+import subprocess
+
+import cv2
+import numpy as np
+
+
+# Function to get the (width, height) a frame is shrunk to so it fits in max_size x max_size
+def thumbnail_size(width, height, max_size):
+    scale = min(max_size / width, max_size / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+# Function to shrink a BGR frame to thumbnail size and convert it to RGB
+def to_thumbnail(image, max_size):
+    height, width = image.shape[:2]
+    size = thumbnail_size(width, height, max_size)
+    if size != (width, height):
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+# Function to sample frames by seeking to every target frame
+def _sample_by_seek(video_cap, target_frames, max_size):
+    for target in target_frames:
+        if not video_cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+            return
+        success, image = video_cap.read()
+        if not success:
+            return
+        yield to_thumbnail(image, max_size)
+
+# Function to sample frames by grabbing (not decoding to images) the frames in between
+def _sample_by_grab(video_cap, interval_frames, max_size):
+    count = 0
+    while video_cap.grab():
+        if count % interval_frames == 0:
+            success, image = video_cap.retrieve()
+            if not success:
+                return
+            yield to_thumbnail(image, max_size)
+        count += 1
+
+# Function to sample frames with ffmpeg's select + scale filters, read as raw RGB
+def _sample_by_ffmpeg(video_path, interval_frames, width, height, max_size):
+    out_width, out_height = thumbnail_size(width, height, max_size)
+    frame_bytes = out_width * out_height * 3
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', video_path,
+               '-vf', f"select='not(mod(n\\,{interval_frames}))',scale={out_width}:{out_height}:flags=area",
+               '-vsync', 'vfr', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(out_height, out_width, 3)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+# Function to yield one thumbnail-sized RGB frame every time_interval seconds
+# Yields nothing (and prints why) if the video's FPS or the interval is not valid
+def sample_frames(video_path, time_interval, max_size=240, method='seek'):
+    video_cap = cv2.VideoCapture(video_path)
+    try:
+        fps = video_cap.get(cv2.CAP_PROP_FPS)
+        if fps <= 0:
+            print(f"Error: FPS value not valid for video {video_path}")
+            return
+
+        interval_frames = int(fps * time_interval)
+        if interval_frames <= 0:
+            print(f"Error: Interval frames value not valid for video {video_path}")
+            return
+
+        if method == 'ffmpeg':
+            width = int(video_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(video_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            video_cap.release()
+            yield from _sample_by_ffmpeg(video_path, interval_frames, width, height, max_size)
+            return
+
+        frame_count = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if method == 'seek' and frame_count > 0:
+            yield from _sample_by_seek(video_cap, range(0, frame_count, interval_frames), max_size)
+        else:
+            yield from _sample_by_grab(video_cap, interval_frames, max_size)
+    finally:
+        video_cap.release()
@@ -0,0 +1,205 @@
+# Persistent on-disk HTTP response cache used by fetch.py
+#
+# Each response body is stored under the SHA-256 of its URL together with a small
+# JSON sidecar holding the headers needed for revalidation (ETag / Last-Modified).
+# Fresh entries (younger than the TTL) are served straight from disk, stale ones
+# are revalidated with a conditional GET, and the least recently used entries are
+# evicted once the cache grows past its size limit. In offline mode only the
+# cache is consulted and a miss raises CacheMiss.
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import instrumentation
+
+# Cache settings (disabled until configure() is called with a cache_dir)
+cache_dir = None
+ttl = 7 * 24 * 3600             # Seconds before an entry must be revalidated
+max_size = 2 * 1024 ** 3        # Bytes on disk before the oldest entries are evicted
+offline = False                 # Serve from the cache only, never touch the network
+
+_lock = threading.Lock()
+_total_size = None
+
+
+class CacheMiss(requests.RequestException):
+    pass
+
+
+# Function to set up the cache (call once at the top of a script)
+def configure(directory=None, ttl_seconds=None, max_bytes=None, offline_only=None):
+    global cache_dir, ttl, max_size, offline, _total_size
+    if directory is not None:
+        cache_dir = directory
+        os.makedirs(cache_dir, exist_ok=True)
+        _total_size = None
+    if ttl_seconds is not None:
+        ttl = ttl_seconds
+    if max_bytes is not None:
+        max_size = max_bytes
+    if offline_only is not None:
+        offline = offline_only
+
+# Function to check whether the cache is switched on
+def enabled():
+    return cache_dir is not None
+
+# Function to get the on-disk paths (body, metadata) for a URL
+def _paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    folder = os.path.join(cache_dir, key[:2])
+    return os.path.join(folder, key + '.body'), os.path.join(folder, key + '.json')
+
+# Function to load a cached entry, returning (metadata, body) or None
+def load(url):
+    body_path, meta_path = _paths(url)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        with open(body_path, 'rb') as file:
+            body = file.read()
+    except (OSError, ValueError):
+        return None
+    # Touch the body so eviction treats it as recently used
+    try:
+        os.utime(body_path)
+    except OSError:
+        pass
+    return meta, body
+
+# Function to write a file atomically (temp file + rename)
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+# Function to store a successful response in the cache
+def save(url, response):
+    body_path, meta_path = _paths(url)
+    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+    old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+    meta = {
+        'url': url,
+        'stored': time.time(),
+        'status_code': response.status_code,
+        'encoding': response.encoding,
+        'headers': dict(response.headers),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    _write_atomic(body_path, response.content)
+    _write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+    _account(len(response.content) - old_size)
+
+# Function to mark an entry as fresh again after a 304 Not Modified
+def _refresh(url, meta):
+    _, meta_path = _paths(url)
+    meta['stored'] = time.time()
+    _write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+# Function to build a requests.Response from a cached entry
+def _to_response(url, meta, body):
+    response = requests.Response()
+    response._content = body
+    response.status_code = meta.get('status_code', 200)
+    response.headers = CaseInsensitiveDict(meta.get('headers', {}))
+    response.encoding = meta.get('encoding')
+    response.url = url
+    response.from_cache = True
+    return response
+
+# Function to get a URL through the cache
+# get_func(headers) performs the real request and must return a requests.Response
+def cached_get(url, get_func, headers=None):
+    entry = load(url)
+
+    if offline:
+        if entry is None:
+            raise CacheMiss(f"Offline mode: {url} is not in the cache")
+        instrumentation.count('cache_hits')
+        return _to_response(url, *entry)
+
+    if entry is not None:
+        meta, body = entry
+        if time.time() - meta.get('stored', 0) < ttl:
+            instrumentation.count('cache_hits')
+            return _to_response(url, meta, body)
+
+        # Stale entry: revalidate with a conditional request when we can
+        conditional_headers = dict(headers or {})
+        if meta.get('etag'):
+            conditional_headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            conditional_headers['If-Modified-Since'] = meta['last_modified']
+        response = get_func(conditional_headers)
+        if response.status_code == 304:
+            instrumentation.count('cache_revalidated')
+            _refresh(url, meta)
+            return _to_response(url, meta, body)
+    else:
+        instrumentation.count('cache_misses')
+        response = get_func(headers)
+
+    if response.status_code == 200:
+        save(url, response)
+    return response
+
+# Function to keep track of the cache size and evict old entries when it is too big
+def _account(delta):
+    global _total_size
+    with _lock:
+        if _total_size is None:
+            _total_size = _scan_size()
+        else:
+            _total_size += delta
+        if _total_size > max_size:
+            _total_size = _evict(_total_size)
+
+# Function to measure the total size of the cached bodies
+def _scan_size():
+    total = 0
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.body'):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+# Function to remove least recently used entries until the cache is 90% of max_size
+def _evict(total):
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.body'):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    target = int(max_size * 0.9)
+    for _, size, body_path in entries:
+        if total <= target:
+            break
+        for path in (body_path, body_path[:-len('.body')] + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+    return total
+
+# Function to delete every cached entry
+def clear():
+    global _total_size
+    with _lock:
+        for root, _, files in os.walk(cache_dir):
+            for name in files:
+                if name.endswith('.body') or name.endswith('.json'):
+                    os.remove(os.path.join(root, name))
+        _total_size = 0
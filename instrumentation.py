@@ -0,0 +1,323 @@
+# Timers, counters, latency histograms and JSON-lines logs for the pipeline
+#
+# The shared modules time their hot paths (fetch, parse, download, decode, DTW,
+# sheet and Drive writes) and count retries and failures through this module,
+# and pipeline.run_task times every item, so the stage scripts do not need
+# editing to be measured. Per-item progress messages go through event(): they
+# are written to the JSON-lines log and only printed if print_events is True.
+#
+# Settings can be given with configure() or, without touching a script, with
+# environment variables:
+#   PIPELINE_LOG=path          append JSON lines to path
+#   PIPELINE_PRINT_EVENTS=1    also print per-item events
+#   PIPELINE_PROFILE=cprofile  profile the stage with cProfile (this thread)
+#   PIPELINE_PROFILE=sample    sample the stacks of every thread instead
+#   PIPELINE_PROFILE_OUTPUT=path   where report() saves the profile
+
+import os
+import sys
+import json
+import time
+import math
+import atexit
+import threading
+import functools
+import collections
+from contextlib import contextmanager
+
+log_path = os.environ.get('PIPELINE_LOG')
+print_events = os.environ.get('PIPELINE_PRINT_EVENTS', '') not in ('', '0')
+profile_mode = os.environ.get('PIPELINE_PROFILE') or None  # None, 'cprofile' or 'sample'
+profile_output = os.environ.get('PIPELINE_PROFILE_OUTPUT')
+sample_interval = 0.01  # Seconds between stack samples in 'sample' mode
+stage = None
+
+_lock = threading.Lock()
+_log_file = None
+_histograms = {}
+_counters = collections.Counter()
+_profiler = None
+_unreported = False  # Something was recorded since the last report()
+
+
+class Histogram:
+    # Latency histogram with logarithmic buckets (4 per doubling, from 0.1 ms)
+    BUCKETS_PER_DOUBLING = 4
+    SMALLEST = 0.0001
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[self._bucket(seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+
+    def _bucket(self, seconds):
+        if seconds <= self.SMALLEST:
+            return 0
+        return int(math.log2(seconds / self.SMALLEST) * self.BUCKETS_PER_DOUBLING) + 1
+
+    def _upper_bound(self, bucket):
+        return self.SMALLEST * 2 ** (bucket / self.BUCKETS_PER_DOUBLING)
+
+    # Function to estimate a percentile (0-100) from the buckets (upper bound of the bucket it falls in)
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 4),
+            'mean_ms': round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 2),
+            'p90_ms': round(self.percentile(90) * 1000, 2),
+            'p99_ms': round(self.percentile(99) * 1000, 2),
+            'max_ms': round(self.max * 1000, 2),
+        }
+
+
+# Function to change settings; arguments left as None keep their current value
+def configure(stage_name=None, log_file=None, events=None, profile=None, profile_file=None):
+    global stage, log_path, print_events, profile_mode, profile_output, _log_file
+    if stage_name is not None:
+        stage = stage_name
+    if log_file is not None and log_file != log_path:
+        with _lock:
+            if _log_file is not None:
+                _log_file.close()
+                _log_file = None
+        log_path = log_file
+    if events is not None:
+        print_events = events
+    if profile is not None:
+        profile_mode = profile
+    if profile_file is not None:
+        profile_output = profile_file
+    if profile_mode and _profiler is None:
+        start_profiler()
+
+# Function to write one JSON line to the log (if a log file is set)
+def log(record):
+    global _log_file
+    if not log_path:
+        return
+    record = {'time': round(time.time(), 3), 'stage': stage, **record}
+    line = json.dumps(record, default=str)
+    with _lock:
+        if _log_file is None:
+            _log_file = open(log_path, 'a', encoding='utf-8', buffering=1)  # Line buffered
+        _log_file.write(line + '\n')
+
+# Function to record a duration (seconds) under a timer name
+def record_time(name, seconds, **fields):
+    global _unreported
+    with _lock:
+        _unreported = True
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+    log({'type': 'timer', 'name': name, 'seconds': round(seconds, 6), **fields})
+
+# Context manager timing a block; the time is recorded even if the block raises
+@contextmanager
+def timer(name, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, time.perf_counter() - start, **fields)
+
+# Decorator timing every call of a function under a timer name
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Function to add to a counter (retries, failures, cache hits, ...)
+def count(name, amount=1, **fields):
+    global _unreported
+    with _lock:
+        _unreported = True
+        _counters[name] += amount
+    if fields:
+        log({'type': 'count', 'name': name, 'amount': amount, **fields})
+
+# Function to report a per-item event: always logged, printed only if print_events is True
+def event(name, message=None, **fields):
+    log({'type': 'event', 'name': name, 'message': message, **fields})
+    if print_events and message:
+        print(message)
+
+
+# Sampling profiler: counts the functions on the stacks of every thread at a fixed interval
+class StackSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.leaf_counts = collections.Counter()
+        self.inclusive_counts = collections.Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+                    if leaf:
+                        self.leaf_counts[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        self.inclusive_counts[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def report(self, limit=25):
+        lines = [f"{self.samples} stack samples every {self.interval * 1000:.0f} ms (all threads)",
+                 f"{'self %':>7} {'total %':>8}  function"]
+        for key, hits in self.inclusive_counts.most_common(limit):
+            lines.append(f"{self.leaf_counts[key] / max(self.samples, 1) * 100:7.1f} {hits / max(self.samples, 1) * 100:8.1f}  {key}")
+        return '\n'.join(lines)
+
+def start_profiler():
+    global _profiler
+    if profile_mode == 'cprofile':
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif profile_mode == 'sample':
+        _profiler = StackSampler(sample_interval)
+        _profiler.start()
+
+# Function to stop the profiler and print (and optionally save) its report
+def stop_profiler(limit=25):
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    if profile_mode == 'cprofile':
+        import pstats
+        profiler.disable()
+        if profile_output:
+            profiler.dump_stats(profile_output)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(limit)
+    else:
+        profiler.stop()
+        text = profiler.report(limit)
+        if profile_output:
+            with open(profile_output, 'w') as f:
+                f.write(text + '\n')
+        print(text)
+
+
+# Function to get the timer and counter totals recorded so far
+def summary():
+    with _lock:
+        return {
+            'timers': {name: histogram.summary() for name, histogram in sorted(_histograms.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+# Function to print the timers and counters (and the profile, if one is running) and log them
+def report():
+    global _unreported
+    stop_profiler()
+    totals = summary()
+    _unreported = False
+    if not totals['timers'] and not totals['counters']:
+        return totals
+    print(f"{'timer':<24} {'count':>7} {'total s':>9} {'mean ms':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>9}")
+    for name, values in totals['timers'].items():
+        print(f"{name:<24} {values['count']:>7} {values['total_s']:>9.1f} {values['mean_ms']:>9.1f} "
+              f"{values['p50_ms']:>8.1f} {values['p90_ms']:>8.1f} {values['p99_ms']:>8.1f} {values['max_ms']:>9.1f}")
+    for name, value in totals['counters'].items():
+        print(f"{name:<24} {value:>7}")
+    log({'type': 'summary', **totals})
+    with _lock:
+        if _log_file is not None:
+            _log_file.flush()
+    return totals
+
+# Function to clear the recorded timers and counters (for example between stages in one process)
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+# Functions for worker processes: a forked worker starts from empty totals and its own log
+# handle, drain() hands its totals back with each result and merge() adds them in the parent
+def init_worker():
+    global _log_file, _profiler
+    with _lock:
+        _log_file = None  # The parent's handle (and its buffer) stays with the parent
+    _profiler = None
+    reset()
+
+def drain():
+    with _lock:
+        drained = {'histograms': dict(_histograms), 'counters': dict(_counters)}
+        _histograms.clear()
+        _counters.clear()
+    return drained
+
+def merge(drained):
+    global _unreported
+    with _lock:
+        _unreported = True
+        for name, histogram in drained['histograms'].items():
+            _histograms.setdefault(name, Histogram()).merge(histogram)
+        _counters.update(drained['counters'])
+
+# The stages call report() themselves; only a run that asked for a log or a profile (PIPELINE_LOG,
+# PIPELINE_PROFILE or configure()) gets what it has not reported yet when it exits, so other
+# scripts that import the shared modules (such as the benchmarks) print nothing extra
+def _report_at_exit():
+    if _profiler is not None or (log_path and _unreported):
+        report()
+
+atexit.register(_report_at_exit)
+
+if profile_mode:
+    start_profiler()
@@ -0,0 +1,144 @@
+# SQLite store for the hand-offs between stages 4, 5 and 6
+#
+# Each stage appends its rows to a typed table as it produces them (one
+# transaction per batch) instead of rewriting an Excel workbook at the end, and
+# the next stage reads only the rows it needs with a filtered query. Rows are
+# keyed, so a rerun replaces rows instead of duplicating them. Tables can still
+# be exported to Excel as a final step. The video_artifacts table is the
+# persistent seen-set of stage 6: every TikTok video is fetched once, and sound
+# folders that list it later get a copy of the file and its metadata.
+
+import os
+import sqlite3
+
+import pandas as pd
+
+# Table definitions: (column, SQL type, title used in DataFrames and Excel files)
+TABLES = {
+    # Stage 4: TikTok sound URL of every Tokchart sound
+    'tiktok_sounds': {
+        'columns': [
+            ('number', 'INTEGER', 'Number'),
+            ('sound_tokchart_url', 'TEXT', 'Sound Tokchart URL'),
+            ('tiktok_sound_url', 'TEXT', 'TikTok Sound URL'),
+        ],
+        'key': ['number'],
+    },
+    # Stage 5: video URLs found on every TikTok sound page
+    'video_urls': {
+        'columns': [
+            ('sound_number', 'INTEGER', 'Number'),
+            ('position', 'INTEGER', 'Position'),
+            ('video_url', 'TEXT', 'Video URL'),
+        ],
+        'key': ['sound_number', 'video_url'],
+    },
+    # Stage 6: metadata of every video
+    'video_metadata': {
+        'columns': [
+            ('sound_number', 'INTEGER', 'Number'),
+            ('video_url', 'TEXT', 'Video URL'),
+            ('captions', 'TEXT', 'Captions'),
+            ('hashtags', 'TEXT', 'Hashtags'),
+            ('date', 'TEXT', 'Date'),
+            ('diversification_labels', 'TEXT', 'Diversification Labels'),
+            ('music_id', 'TEXT', 'Music ID'),
+            ('music_title', 'TEXT', 'Music Title'),
+            ('location_created', 'TEXT', 'Location Created'),
+            ('video_duration', 'INTEGER', 'Video Duration'),
+        ],
+        'key': ['sound_number', 'video_url'],
+    },
+    # Stage 6: the sound folder each video was first fetched for (path is NULL if it was not downloaded)
+    'video_artifacts': {
+        'columns': [
+            ('video_id', 'TEXT', 'Video ID'),
+            ('sound_number', 'INTEGER', 'Number'),
+            ('video_url', 'TEXT', 'Video URL'),
+            ('path', 'TEXT', 'Path'),
+        ],
+        'key': ['video_id'],
+    },
+}
+
+
+# Function to convert a value to the column's type; values that do not fit (such as 'N/A') become NULL
+def _typed(value, sql_type):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()  # NumPy scalars
+    if sql_type == 'INTEGER':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if sql_type == 'REAL':
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+
+class IntermediateStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Google Drive's file system does not support WAL, so the default rollback journal is kept
+        self.connection = sqlite3.connect(path)
+        for table, definition in TABLES.items():
+            columns = ', '.join(f'{name} {sql_type}' for name, sql_type, _ in definition['columns'])
+            key = ', '.join(definition['key'])
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns}, PRIMARY KEY ({key}))')
+        self.connection.commit()
+
+    # Function to append (or replace, by key) rows given as dicts keyed by column name or title
+    # If replace_where is given, the rows matching it are deleted in the same transaction first
+    def append(self, table, rows, replace_where=None, params=()):
+        columns = TABLES[table]['columns']
+        values = []
+        for row in rows:
+            values.append(tuple(_typed(row.get(name, row.get(title)), sql_type) for name, sql_type, title in columns))
+        placeholders = ', '.join('?' for _ in columns)
+        with self.connection:
+            if replace_where:
+                self.connection.execute(f'DELETE FROM {table} WHERE {replace_where}', params)
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO {table} ({", ".join(name for name, _, _ in columns)}) VALUES ({placeholders})', values)
+        return len(values)
+
+    # Function to read rows into a DataFrame with the column titles, optionally filtered with a WHERE clause
+    def read(self, table, where=None, params=(), order_by=None):
+        columns = TABLES[table]['columns']
+        query = f'SELECT {", ".join(name for name, _, _ in columns)} FROM {table}'
+        if where:
+            query += f' WHERE {where}'
+        query += f' ORDER BY {order_by or ", ".join(TABLES[table]["key"])}'
+        rows = self.connection.execute(query, params).fetchall()
+        return pd.DataFrame(rows, columns=[title for _, _, title in columns])
+
+    # Function to get the distinct values of a column, in order
+    def distinct(self, table, column, where=None, params=()):
+        query = f'SELECT DISTINCT {column} FROM {table}'
+        if where:
+            query += f' WHERE {where}'
+        return [row[0] for row in self.connection.execute(query + f' ORDER BY {column}', params)]
+
+    # Function to write (part of) a table to an Excel file, one sheet per value of sheet_column if given
+    def export_excel(self, table, output_path, where=None, params=(), order_by=None, sheet_name='Sheet1',
+                     sheet_column=None, fill_value=None, drop=()):
+        df = self.read(table, where, params, order_by)
+        if fill_value is not None:
+            df = df.astype(object).where(df.notna(), fill_value)
+        writer = pd.ExcelWriter(output_path, engine='xlsxwriter')
+        if sheet_column is None:
+            df.drop(columns=list(drop)).to_excel(writer, sheet_name=sheet_name, index=False)
+        else:
+            for value, group in df.groupby(sheet_column, sort=True):
+                group.drop(columns=[sheet_column] + list(drop)).to_excel(writer, sheet_name=str(value), index=False)
+        writer.close()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,169 @@
+# Landmark (spectral peak pair) fingerprint index over the reference sounds
+#
+# Each sound's spectrogram is reduced to its local peaks; nearby peaks are
+# paired into hashes of (anchor frequency, target frequency, time gap). All
+# hashes of all sounds are kept in one array sorted by hash, so looking up a
+# video is a binary search per hash, whatever the size of the catalogue. The
+# sound whose hashes agree on one consistent time offset the most is the match.
+# The index is saved as a .npz file and rebuilt only when the sound files change.
+
+import os
+import json
+
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+import instrumentation
+
+# Fingerprint parameters (changing them rebuilds the index)
+PARAMS = {
+    'sr': 11025,
+    'n_fft': 1024,
+    'hop': 256,
+    'neighborhood': [15, 11],  # Peak neighbourhood in (frequency bins, frames)
+    'fan_out': 5,              # Target peaks paired with each anchor peak
+    'max_dt': 63,              # Largest time gap (frames) between paired peaks
+    'min_db': -60,             # Peaks quieter than this (relative to the loudest bin) are ignored
+    'peaks_per_second': 30,    # Only the strongest peaks of every second are kept
+}
+
+
+# Function to compute a log-magnitude spectrogram (frequency bins x frames) with NumPy
+def spectrogram(samples, n_fft, hop):
+    samples = np.asarray(samples, dtype=np.float32)
+    if len(samples) < n_fft:
+        samples = np.pad(samples, (0, n_fft - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, n_fft)[::hop]
+    magnitude = np.abs(np.fft.rfft(frames * np.hanning(n_fft).astype(np.float32), axis=1)).T
+    return 20 * np.log10(np.maximum(magnitude, 1e-10) / max(magnitude.max(), 1e-10))
+
+# Function to find the spectral peaks, returned as (frame, frequency bin) sorted by frame
+def find_peaks(spectrum, params=PARAMS):
+    local_max = maximum_filter(spectrum, size=tuple(params['neighborhood']), mode='constant', cval=-np.inf)
+    peaks = (spectrum == local_max) & (spectrum > params['min_db'])
+    frequencies, times = np.nonzero(peaks)
+
+    # Keep the strongest peaks of every one-second block, so noise does not crowd out the landmarks
+    block_frames = max(1, round(params['sr'] / params['hop']))
+    blocks = times // block_frames
+    order = np.lexsort((-spectrum[frequencies, times], blocks))
+    block_starts = np.searchsorted(blocks[order], blocks[order], side='left')
+    keep = order[np.arange(len(order)) - block_starts < params['peaks_per_second']]
+
+    times, frequencies = times[keep], frequencies[keep]
+    order = np.lexsort((frequencies, times))
+    return times[order], frequencies[order]
+
+# Function to turn peaks into (hash, anchor frame) pairs
+def landmark_hashes(samples, params=PARAMS):
+    times, frequencies = find_peaks(spectrogram(samples, params['n_fft'], params['hop']), params)
+    hashes = []
+    offsets = []
+    for step in range(1, params['fan_out'] + 1):
+        dt = times[step:] - times[:-step]
+        valid = (dt > 0) & (dt <= params['max_dt'])
+        anchor_frequencies = frequencies[:-step][valid].astype(np.uint32)
+        target_frequencies = frequencies[step:][valid].astype(np.uint32)
+        # 10 bits per frequency bin (n_fft 1024 gives 513 bins) and 6 bits for the time gap
+        hashes.append((anchor_frequencies << 16) | (target_frequencies << 6) | dt[valid].astype(np.uint32))
+        offsets.append(times[:-step][valid])
+    if not hashes:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int32)
+    return np.concatenate(hashes), np.concatenate(offsets).astype(np.int32)
+
+
+class LandmarkIndex:
+    def __init__(self, hashes, sound_ids, offsets, params=PARAMS):
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.sound_ids = sound_ids[order]
+        self.offsets = offsets[order]
+        self.params = params
+
+    # Function to build the index from {sound_id: audio file path}
+    # load_audio(path) must return (samples, sr) at params['sr']
+    @classmethod
+    def build(cls, sound_paths, load_audio, params=PARAMS):
+        all_hashes, all_ids, all_offsets = [], [], []
+        for sound_id, path in sorted(sound_paths.items()):
+            try:
+                samples, _ = load_audio(path)
+            except Exception as e:
+                print(f"Error fingerprinting {path}: {e}")
+                continue
+            hashes, offsets = landmark_hashes(samples, params)
+            all_hashes.append(hashes)
+            all_offsets.append(offsets)
+            all_ids.append(np.full(len(hashes), sound_id, dtype=np.int32))
+        if not all_hashes:
+            return cls(np.zeros(0, np.uint32), np.zeros(0, np.int32), np.zeros(0, np.int32), params)
+        return cls(np.concatenate(all_hashes), np.concatenate(all_ids), np.concatenate(all_offsets), params)
+
+    # Function to save the index as a .npz file (with the parameters and file manifest)
+    def save(self, path, manifest):
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, hashes=self.hashes, sound_ids=self.sound_ids, offsets=self.offsets,
+                 meta=np.array(json.dumps({'params': self.params, 'manifest': manifest})))
+        os.replace(tmp_path, path)
+
+    # Function to load a saved index if it was built from the same files and parameters, else None
+    @classmethod
+    def load(cls, path, manifest, params=PARAMS):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['params'] != params or meta['manifest'] != manifest:
+                return None
+            index = cls.__new__(cls)
+            index.hashes = data['hashes']
+            index.sound_ids = data['sound_ids']
+            index.offsets = data['offsets']
+            index.params = params
+        return index
+
+    # Function to find the best-matching sound for a clip
+    # Returns (sound_id, offset in seconds into the sound, number of agreeing hashes), or (None, None, 0)
+    @instrumentation.timed('landmark_lookup')
+    def identify(self, samples):
+        hashes, query_offsets = landmark_hashes(samples, self.params)
+        if len(hashes) == 0 or len(self.hashes) == 0:
+            return None, None, 0
+
+        starts = np.searchsorted(self.hashes, hashes, side='left')
+        ends = np.searchsorted(self.hashes, hashes, side='right')
+        counts = ends - starts
+        if counts.sum() == 0:
+            return None, None, 0
+
+        # Expand every query hash into all of its matching index entries
+        query_index = np.repeat(np.arange(len(hashes)), counts)
+        entry_index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        matched_ids = self.sound_ids[entry_index].astype(np.int64)
+        time_shifts = self.offsets[entry_index].astype(np.int64) - query_offsets[query_index]
+
+        # Vote for (sound_id, time shift) pairs; the most consistent pair wins
+        keys = (matched_ids << 32) | (time_shifts & 0xffffffff)
+        unique_keys, votes = np.unique(keys, return_counts=True)
+        best = int(np.argmax(votes))
+        sound_id = int(unique_keys[best] >> 32)
+        shift = int(np.int32(np.uint32(unique_keys[best] & 0xffffffff)))
+        return sound_id, shift * self.params['hop'] / self.params['sr'], int(votes[best])
+
+# Function to describe the sound files (for detecting changes): {sound_id: [name, size, mtime]}
+def sound_manifest(sound_paths):
+    manifest = {}
+    for sound_id, path in sorted(sound_paths.items()):
+        stat = os.stat(path)
+        manifest[str(sound_id)] = [os.path.basename(path), stat.st_size, stat.st_mtime]
+    return manifest
+
+# Function to load the saved index, or build and save it if the sound files changed
+def load_or_build(index_path, sound_paths, load_audio, params=PARAMS):
+    manifest = sound_manifest(sound_paths)
+    index = LandmarkIndex.load(index_path, manifest, params)
+    if index is None:
+        print(f"Building landmark index for {len(sound_paths)} sounds")
+        index = LandmarkIndex.build(sound_paths, load_audio, params)
+        index.save(index_path, manifest)
+    return index
@@ -0,0 +1,145 @@
+# Incremental, resumable runner for the pipeline stages
+#
+# A stage is a Task: a name, its items (sound ids, folders, ...) and a run
+# function for one item, plus the input files, output files and parameters of
+# each item. Every completed item is recorded in the stage's manifest (one JSON
+# file per task) with a fingerprint of its inputs (path, size, modification
+# time), its parameters and the runs of the same item in the upstream tasks it
+# depends on. An item is run again only if that fingerprint changed, one of its
+# outputs is missing or its last run failed. The manifest is saved after every
+# item, so an interrupted run resumes where it stopped. An item that cannot be
+# done (a missing folder, a Drive or Sheets lookup that failed) must raise, so
+# it is recorded as failed and tried again on the next run.
+
+import os
+import json
+import time
+import hashlib
+import traceback
+
+import instrumentation
+
+
+# Function to describe a file or folder for change detection
+# Folders are described by the name, size and modification time of the files directly inside them
+def path_signature(path):
+    try:
+        if os.path.isdir(path):
+            entries = []
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append([entry.name, stat.st_size, stat.st_mtime])
+                else:
+                    entries.append([entry.name + '/'])
+            return entries
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+    except OSError:
+        return None
+
+# Function to hash an item's inputs, parameters and upstream runs into one fingerprint
+def fingerprint(input_paths, params, upstream):
+    description = {
+        'inputs': {str(path): path_signature(path) for path in input_paths},
+        'params': params,
+        'upstream': upstream,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Manifest:
+    # One JSON file per task in manifest_dir: {item: {'fingerprint', 'status', 'version', ...}}
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        self.tasks = {}
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def _path(self, task_name):
+        return os.path.join(self.manifest_dir, f'{task_name}.json')
+
+    # Function to get the records of a task (loaded from disk once)
+    def records(self, task_name):
+        if task_name not in self.tasks:
+            try:
+                with open(self._path(task_name)) as f:
+                    self.tasks[task_name] = json.load(f)
+            except (OSError, ValueError):
+                self.tasks[task_name] = {}
+        return self.tasks[task_name]
+
+    def get(self, task_name, item):
+        return self.records(task_name).get(str(item))
+
+    # Function to record the outcome of one item and save the task's manifest
+    def record(self, task_name, item, item_fingerprint, status, error=None):
+        records = self.records(task_name)
+        previous = records.get(str(item), {})
+        records[str(item)] = {
+            'fingerprint': item_fingerprint,
+            'status': status,
+            'version': previous.get('version', 0) + (status == 'done'),
+            'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'error': error,
+        }
+        self.save(task_name)
+
+    def save(self, task_name):
+        path = self._path(task_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.records(task_name), f, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+class Task:
+    # run(item) does the work for one item; inputs(item) and outputs(item) return lists of paths
+    # depends_on names upstream tasks: rerunning an item there makes the same item stale here
+    def __init__(self, name, items, run, inputs=None, outputs=None, params=None, depends_on=()):
+        self.name = name
+        self.items = items
+        self.run = run
+        self.inputs = inputs or (lambda item: [])
+        self.outputs = outputs or (lambda item: [])
+        self.params = params or {}
+        self.depends_on = list(depends_on)
+
+    # Function to compute the fingerprint of one item
+    def fingerprint(self, item, manifest):
+        upstream = {}
+        for task_name in self.depends_on:
+            record = manifest.get(task_name, item)
+            upstream[task_name] = record and record['version']
+        return fingerprint(self.inputs(item), self.params, upstream)
+
+    # Function to check whether an item has to be (re)run
+    def is_stale(self, item, manifest):
+        record = manifest.get(self.name, item)
+        if record is None or record['status'] != 'done':
+            return True
+        if any(not os.path.exists(path) for path in self.outputs(item)):
+            return True
+        return record['fingerprint'] != self.fingerprint(item, manifest)
+
+# Function to run the stale items of a task; returns the counts of run, skipped and failed items
+# The fingerprint is taken after the item ran, so changes the item makes to its own inputs
+# (such as moving videos out of a folder) do not make it stale on the next run
+def run_task(task, manifest, force=False):
+    counts = {'run': 0, 'skipped': 0, 'failed': 0}
+    for item in task.items:
+        if not force and not task.is_stale(item, manifest):
+            counts['skipped'] += 1
+            instrumentation.count('items_up_to_date')
+            continue
+        try:
+            with instrumentation.timer(task.name, item=str(item)):
+                task.run(item)
+        except Exception as e:
+            print(f"Error in {task.name} for {item}: {e}")
+            instrumentation.count('items_failed', task=task.name, item=str(item))
+            manifest.record(task.name, item, None, 'failed', traceback.format_exc(limit=5))
+            counts['failed'] += 1
+            continue
+        manifest.record(task.name, item, task.fingerprint(item, manifest), 'done')
+        counts['run'] += 1
+    print(f"{task.name}: {counts['run']} run, {counts['skipped']} up to date, {counts['failed']} failed")
+    return counts
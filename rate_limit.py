@@ -0,0 +1,269 @@
+# Per-host rate limiting, retries and adaptive concurrency for every network call
+#
+# Each host (tokchart.com, www.tiktok.com, the Drive and Sheets APIs, ...) gets a
+# HostLimiter with a token bucket (requests per second plus a burst allowance)
+# and a limit on requests in flight. Both adapt to what the host answers: a 429
+# (or a Google "rate limit exceeded" 403, or a 503) halves the rate and the
+# concurrency, a run of successes raises them again step by step up to the
+# configured maximum, and a high share of other errors (5xx, timeouts, dropped
+# connections) lowers the concurrency by one. A Retry-After header pauses the
+# whole host, not just the thread that got it. Failed calls are retried with
+# exponential backoff and full jitter, so throughput settles just under each
+# service's limit instead of alternating between bursts and long fixed sleeps.
+
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import instrumentation
+
+# Hosts of the Google APIs called through googleapiclient (Drive) and gspread (Sheets)
+DRIVE_HOST = 'www.googleapis.com'
+SHEETS_HOST = 'sheets.googleapis.com'
+
+# Starting limits per host: rate (requests/s), burst (bucket size), concurrency (in flight)
+# The rate found by adapting never goes above max_rate (the published quota, where there is
+# one) or else the starting rate times max_rate_factor; hosts without a rate (such as media
+# CDNs) are only limited by their concurrency. Drive charges every call in a batch, so its
+# burst holds a full batch of 100 calls.
+HOST_LIMITS = {
+    'tokchart.com': {'rate': 5.0, 'burst': 10, 'concurrency': 8},
+    'www.tiktok.com': {'rate': 2.0, 'burst': 4, 'concurrency': 4},
+    DRIVE_HOST: {'rate': 200.0, 'max_rate': 200.0, 'burst': 200, 'concurrency': 4},   # Drive: 12,000 queries/min per user
+    SHEETS_HOST: {'rate': 1.0, 'max_rate': 1.0, 'burst': 5, 'concurrency': 2},        # Sheets: 60 reads and 60 writes/min per user
+}
+default_limits = {'rate': None, 'burst': 10, 'concurrency': 8}
+max_rate_factor = 2.0
+
+# Retry settings
+max_attempts = 4       # Attempts per call, including the first
+base_delay = 1.0       # Seconds, doubled on every attempt
+max_delay = 60.0       # Longest backoff between two attempts
+error_threshold = 0.2  # Share of failed calls above which concurrency is lowered
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to take cost tokens, waiting for them if needed; returns the seconds waited
+    # A call costing more than the bucket holds waits for a full bucket and leaves it in debt
+    def acquire(self, cost=1):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                needed = min(cost, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    return waited
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class HostLimiter:
+    def __init__(self, host, rate, burst, concurrency, max_rate=None):
+        self.host = host
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_rate = max_rate or (rate or 0) * max_rate_factor
+        self.min_rate = (rate or 0) / 20
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.successes = 0          # Successes since the limits were last raised or lowered
+        self.error_rate = 0.0       # Moving average of the share of failed calls
+        self.paused_until = 0.0     # Set from Retry-After: no call to the host starts before this
+        self.condition = threading.Condition()
+
+    # Function to wait for a pause to end, a free slot and a token before a call
+    def acquire(self, cost=1):
+        start = time.monotonic()
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= self.concurrency:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+        if self.bucket is not None:
+            self.bucket.acquire(cost)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            instrumentation.record_time('rate_limit_wait', waited, host=self.host)
+
+    # Function to free the slot and adapt the limits to the outcome: 'ok', 'throttled' or 'error'
+    def release(self, outcome, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            self._adapt(outcome, retry_after)
+
+    # Function to adapt the limits to an outcome seen outside call() (e.g. inside a batch request)
+    def report(self, outcome, retry_after=None):
+        with self.condition:
+            self._adapt(outcome, retry_after)
+
+    def _adapt(self, outcome, retry_after):
+        self.error_rate = 0.9 * self.error_rate + 0.1 * (outcome != 'ok')
+        if outcome == 'ok':
+            self.successes += 1
+            # Additive increase: one step for every full window of successes
+            if self.successes >= self.concurrency * 4:
+                self.successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                if self.bucket is not None:
+                    with self.bucket.lock:
+                        self.bucket.rate = min(self.max_rate, self.bucket.rate * 1.1)
+        elif outcome == 'throttled':
+            # Multiplicative decrease of both the rate and the concurrency
+            self.successes = 0
+            self.concurrency = max(1, self.concurrency // 2)
+            if self.bucket is not None:
+                with self.bucket.lock:
+                    self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+                    self.bucket.tokens = min(self.bucket.tokens, 0.0)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        elif self.error_rate > error_threshold:
+            self.successes = 0
+            self.concurrency = max(1, self.concurrency - 1)
+        self.condition.notify_all()
+
+    # Function to work out how long to wait before the next attempt (full jitter, or Retry-After)
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after + random.uniform(0, base_delay))
+        return delay
+
+
+# Function to get the host of a URL (a bare host name is returned as it is)
+def host_of(target):
+    if '//' in target:
+        target = urlsplit(target).netloc
+    return target.lower().split('@')[-1].split(':')[0]
+
+# Function to get the limiter of a host (or of a URL's host), creating it on first use
+def limiter(target):
+    host = host_of(target)
+    with _limiters_lock:
+        host_limiter = _limiters.get(host)
+        if host_limiter is None:
+            limits = {**default_limits, **HOST_LIMITS.get(host, {})}
+            host_limiter = HostLimiter(host, limits['rate'], limits['burst'], limits['concurrency'], limits.get('max_rate'))
+            _limiters[host] = host_limiter
+        return host_limiter
+
+# Function to change the starting limits of a host (or the defaults, if host is None)
+# rate=0 removes the host's rate limit; limiters already in use keep what they learned
+# until reset() starts them over
+def configure(host=None, rate=None, burst=None, concurrency=None):
+    limits = default_limits if host is None else HOST_LIMITS.setdefault(host_of(host), dict(default_limits))
+    for name, value in (('rate', rate), ('burst', burst), ('concurrency', concurrency)):
+        if value is not None:
+            limits[name] = value
+
+# Function to forget every limiter (and what it learned about its host)
+def reset():
+    with _limiters_lock:
+        _limiters.clear()
+
+# Function to get the HTTP status of a response or of an exception from requests,
+# googleapiclient, gspread or yt-dlp, or None if there is none
+def status_of(result):
+    for response in (result, getattr(result, 'response', None), getattr(result, 'resp', None)):
+        if response is None:
+            continue
+        status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+        if isinstance(status, int):
+            return status
+    if isinstance(result, Exception):
+        match = re.search(r'HTTP Error (\d{3})|<HttpError (\d{3})', str(result))
+        if match:
+            return int(match.group(1) or match.group(2))
+    return None
+
+# Function to read Retry-After (seconds or an HTTP date) from a response or exception, in seconds
+def retry_after_of(result):
+    # googleapiclient's HttpError.resp is itself a dict of (lower-case) headers
+    for headers in (getattr(result, 'headers', None), getattr(getattr(result, 'response', None), 'headers', None),
+                    getattr(result, 'resp', None)):
+        if not hasattr(headers, 'get'):
+            continue
+        value = headers.get('Retry-After') or headers.get('retry-after')
+        if not value:
+            continue
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+# Function to classify a response or exception: 'ok', 'throttled' or 'error'
+def outcome_of(result):
+    status = status_of(result)
+    if status in THROTTLE_STATUSES:
+        return 'throttled'
+    if status == 403 and re.search(r'rate ?limit', str(result), re.IGNORECASE):
+        return 'throttled'  # Google APIs report per-user rate limits as 403 rateLimitExceeded
+    if status is not None and status >= 500:
+        return 'error'
+    if isinstance(result, Exception) and status is None:
+        return 'error'
+    return 'ok'
+
+# Function to run func() under the host's limits, retrying throttled and failed calls with backoff
+# func may return a response (status_code) or raise; responses with a retryable status are retried
+# and the last one is returned. Exceptions without an HTTP status are retried if they are
+# instances of retry_on; exceptions with a status only for the statuses in RETRY_STATUSES.
+# cost is the number of tokens the call takes (e.g. the number of calls in a batch request).
+def call(target, func, attempts=None, retry_on=(OSError,), cost=1):
+    host_limiter = limiter(target)
+    attempts = attempts or max_attempts
+    for attempt in range(attempts):
+        host_limiter.acquire(cost)
+        try:
+            result = func()
+        except Exception as e:
+            outcome = outcome_of(e)
+            retry_after = retry_after_of(e)
+            host_limiter.release(outcome, retry_after)
+            status = status_of(e)
+            retryable = outcome == 'throttled' or (status in RETRY_STATUSES if status is not None else isinstance(e, retry_on))
+            if not retryable or attempt + 1 == attempts:
+                raise
+        else:
+            outcome = outcome_of(result)
+            retry_after = retry_after_of(result)
+            host_limiter.release(outcome, retry_after)
+            if status_of(result) not in RETRY_STATUSES or attempt + 1 == attempts:
+                return result
+            if hasattr(result, 'close'):
+                result.close()  # Give the connection back to the pool before retrying
+        instrumentation.count('throttled' if outcome == 'throttled' else 'retries', host=host_limiter.host)
+        time.sleep(host_limiter.backoff(attempt, retry_after))
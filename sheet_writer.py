@@ -0,0 +1,95 @@
+# Buffered writer for the metadata Google Sheets (stages 7 and 8)
+#
+# The sheet's values are read once (on first lookup) and kept in memory. Cell
+# values and cell formats are buffered and sent by flush() as one values
+# batch_update and one batch_format call, instead of a read of the whole sheet
+# plus several update_cell / format calls per video. Every call goes through the
+# Sheets limiter of rate_limit.py, which retries 429s and 5xx errors.
+
+from gspread.utils import rowcol_to_a1
+
+import instrumentation
+import rate_limit
+
+
+class SheetWriter:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._values = None
+        self.pending_values = {}   # (row, col) -> value, both 1-based
+        self.pending_formats = []  # {'range': ..., 'format': ...}
+
+    # Function to get the sheet's values, reading them from Google only once
+    @property
+    def values(self):
+        if self._values is None:
+            with instrumentation.timer('sheet_read'):
+                self._values = rate_limit.call(rate_limit.SHEETS_HOST, self.worksheet.get_all_values)
+        return self._values
+
+    # Function to get the header row (including columns added but not yet flushed)
+    @property
+    def header(self):
+        return self.values[0] if self.values else []
+
+    # Function to find the sheet row (1-based, header is row 1) whose column value ends with suffix
+    def find_row(self, column_name, suffix):
+        if column_name not in self.header:
+            return None
+        col = self.header.index(column_name)
+        for row_index, row in enumerate(self.values[1:]):
+            if col < len(row) and str(row[col]).endswith(suffix):
+                return row_index + 2
+        return None
+
+    # Function to add header columns that do not exist yet; returns their 1-based column numbers
+    def ensure_columns(self, column_names):
+        if not self.values:
+            self._values.append([])
+        header = self.values[0]
+        for column_name in column_names:
+            if column_name not in header:
+                header.append(column_name)
+                self.pending_values[(1, len(header))] = column_name
+        return [header.index(column_name) + 1 for column_name in column_names]
+
+    # Function to buffer cell values for one row, given as {column name: value}
+    def set_values(self, row, values_by_column):
+        columns = self.ensure_columns(list(values_by_column))
+        for col, value in zip(columns, values_by_column.values()):
+            if hasattr(value, 'item'):
+                value = value.item()  # NumPy scalars are not JSON serialisable
+            self.pending_values[(row, col)] = value
+            self._cache_value(row, col, value)
+
+    # Function to keep the in-memory copy of the sheet in step with buffered values
+    def _cache_value(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    # Function to get the A1 range of a whole row, as wide as the header (or width columns)
+    def row_range(self, row, width=None):
+        return f'A{row}:{rowcol_to_a1(row, max(width or len(self.header), 1))}'
+
+    # Function to buffer a format (Sheets API CellFormat dict) for an A1 range
+    def format_range(self, cell_range, cell_format):
+        self.pending_formats.append({'range': cell_range, 'format': cell_format})
+
+    # Function to send all buffered values and formats to Google
+    @instrumentation.timed('sheet_write')
+    def flush(self):
+        if self.pending_values:
+            max_col = max(col for _, col in self.pending_values)
+            if max_col > self.worksheet.col_count:
+                rate_limit.call(rate_limit.SHEETS_HOST, lambda: self.worksheet.add_cols(max_col - self.worksheet.col_count))
+            data = [{'range': rowcol_to_a1(row, col), 'values': [[value]]}
+                    for (row, col), value in sorted(self.pending_values.items())]
+            rate_limit.call(rate_limit.SHEETS_HOST, lambda: self.worksheet.batch_update(data, value_input_option='USER_ENTERED'))
+            self.pending_values = {}
+        if self.pending_formats:
+            rate_limit.call(rate_limit.SHEETS_HOST, lambda: self.worksheet.batch_format(self.pending_formats))
+            self.pending_formats = []
@@ -0,0 +1,123 @@
+# Memory-bounded image composition for stage 9
+#
+# Strips are built by pasting each thumbnail straight onto a preallocated
+# canvas as the frames are decoded, so a video's frames are never all held at
+# once. The consolidated image is written as a streamed PNG: its size is worked
+# out from the saved strips, then the strips are read back one at a time and
+# their rows compressed into the file. Peak memory is one strip (per worker),
+# however many videos or frames a folder has.
+
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image as PILImage
+
+import instrumentation
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IDAT_SIZE = 256 * 1024  # Bytes of compressed data per IDAT chunk
+
+
+# Function to paste thumbnail frames (RGB arrays) side by side onto a preallocated canvas
+# expected_frames sizes the canvas up front; it grows if more frames arrive. Returns a PIL image or None.
+def compose_strip(frames, expected_frames=10):
+    canvas = None
+    x_offset = 0
+    strip_height = 0
+
+    for frame in frames:
+        height, width = frame.shape[:2]
+        if canvas is None:
+            canvas = np.zeros((height, max(expected_frames, 1) * width, 3), dtype=np.uint8)
+        if height > canvas.shape[0] or x_offset + width > canvas.shape[1]:
+            grown = np.zeros((max(height, canvas.shape[0]), max(x_offset + width, canvas.shape[1] * 2), 3), dtype=np.uint8)
+            grown[:canvas.shape[0], :canvas.shape[1]] = canvas
+            canvas = grown
+        canvas[:height, x_offset:x_offset + width] = frame
+        x_offset += width
+        strip_height = max(strip_height, height)
+
+    if canvas is None:
+        return None
+    return PILImage.fromarray(canvas[:strip_height, :x_offset])
+
+
+class StreamingPNGWriter:
+    # Writes an 8-bit RGB PNG row by row, without holding the whole image in memory
+    def __init__(self, path, width, height):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.compressor = zlib.compressobj(6)
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(tag)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def _add_compressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self._write_chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    # Function to append rows, given as a (rows, width, 3) uint8 array
+    def write_rows(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=np.uint8)
+        # Each PNG row starts with a filter-type byte (0 = none)
+        filtered = np.zeros((rows.shape[0], 1 + self.width * 3), dtype=np.uint8)
+        filtered[:, 1:] = rows.reshape(rows.shape[0], -1)
+        self._add_compressed(self.compressor.compress(filtered.tobytes()))
+
+    def close(self):
+        self._add_compressed(self.compressor.flush())
+        if self.pending:
+            self._write_chunk(b'IDAT', b''.join(self.pending))
+        self._write_chunk(b'IEND', b'')
+        self.file.close()
+
+    # Function to close the file without finishing the image (it is left without IEND)
+    def abort(self):
+        self.file.close()
+
+# Function to stack saved strip images vertically into one PNG, one strip in memory at a time
+# Strips narrower than the widest one are padded with black on the right. The image is written to
+# a .tmp file and only moved to output_path once complete, so a failure leaves no truncated PNG.
+@instrumentation.timed('consolidated_image')
+def write_consolidated_image(strip_paths, output_path):
+    sizes = []
+    for path in strip_paths:
+        with PILImage.open(path) as image:
+            sizes.append(image.size)  # Only reads the header
+    if not sizes:
+        return False
+
+    max_width = max(width for width, _ in sizes)
+    total_height = sum(height for _, height in sizes)
+    temp_path = output_path + '.tmp'
+    writer = StreamingPNGWriter(temp_path, max_width, total_height)
+    try:
+        for path, (width, height) in zip(strip_paths, sizes):
+            with PILImage.open(path) as image:
+                rows = np.asarray(image.convert('RGB'))
+            if width < max_width:
+                padded = np.zeros((height, max_width, 3), dtype=np.uint8)
+                padded[:, :width] = rows
+                rows = padded
+            writer.write_rows(rows)
+    except BaseException:
+        writer.abort()
+        os.remove(temp_path)
+        raise
+    writer.close()
+    os.replace(temp_path, output_path)
+    return True
@@ -0,0 +1,135 @@
+# Fast video duration probing for stage 7
+#
+# The duration is read straight from the MP4 container: the 'mvhd' box inside
+# 'moov' holds the timescale and duration, so only a few box headers have to be
+# read, no matter how large the file is. Files the parser cannot handle fall
+# back to ffprobe. Results are cached in a JSON file keyed by path, size and
+# mtime, and many files can be probed at once on a process pool.
+
+import os
+import json
+import struct
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+
+# Boxes that contain other boxes on the way to 'mvhd'
+_CONTAINER_BOXES = {b'moov'}
+
+
+# Function to read the duration (seconds) from the mvhd box of an MP4/MOV file
+# Returns None if the file has no readable mvhd box
+def mp4_duration(file_path):
+    with open(file_path, 'rb') as file:
+        file_size = os.fstat(file.fileno()).st_size
+        return _find_mvhd(file, 0, file_size)
+
+# Function to walk the boxes between start and end looking for mvhd
+def _find_mvhd(file, start, end):
+    position = start
+    while position + 8 <= end:
+        file.seek(position)
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            # 64-bit box size follows the type
+            size = struct.unpack('>Q', file.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # Box runs to the end of the file
+            size = end - position
+        if size < header_size:
+            return None
+
+        if box_type == b'mvhd':
+            version = file.read(1)
+            if not version:
+                return None
+            file.read(3)  # flags
+            if version[0] == 1:
+                _, _, timescale, duration = struct.unpack('>QQIQ', file.read(28))
+            else:
+                _, _, timescale, duration = struct.unpack('>IIII', file.read(16))
+            if not timescale:
+                return None
+            return duration / timescale
+        if box_type in _CONTAINER_BOXES:
+            return _find_mvhd(file, position + header_size, position + size)
+
+        position += size
+    return None
+
+# Function to read the duration with ffprobe (only reads the container headers)
+def ffprobe_duration(file_path):
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+               '-of', 'default=noprint_wrappers=1:nokey=1', file_path]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+# Function to get the duration of a video file, trying the MP4 header first
+@instrumentation.timed('probe')
+def probe_duration(file_path):
+    try:
+        duration = mp4_duration(file_path)
+        if duration:
+            return duration
+    except (OSError, struct.error):
+        pass
+    try:
+        return ffprobe_duration(file_path)
+    except Exception as e:
+        print(f"Error getting video duration for {file_path}: {e}")
+        return None
+
+# Function to load the duration cache ({path: [size, mtime, duration]})
+def load_cache(cache_path):
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+# Function to save the duration cache (written to a temp file and renamed)
+def save_cache(cache, cache_path):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(cache, file)
+    os.replace(tmp_path, cache_path)
+
+# Function to probe many files on a process pool, reusing cached results
+# Returns {file_path: duration or None}
+def probe_durations(file_paths, cache_path=None, workers=None):
+    cache = load_cache(cache_path)
+    durations = {}
+    to_probe = []
+
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            print(f"Error getting video duration for {file_path}: {e}")
+            durations[file_path] = None
+            continue
+        cached = cache.get(file_path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            durations[file_path] = cached[2]
+        else:
+            to_probe.append((file_path, stat.st_size, stat.st_mtime))
+
+    if to_probe:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            probed = executor.map(probe_duration, [item[0] for item in to_probe], chunksize=16)
+            for (file_path, size, mtime), duration in zip(to_probe, probed):
+                durations[file_path] = duration
+                if duration is not None:
+                    cache[file_path] = [size, mtime, duration]
+        if cache_path:
+            save_cache(cache, cache_path)
+
+    return durations